@@ -1,5 +1,5 @@
 # from ._version import __version__
-from .exceptions import ControlFailure, DispatchFailure  # noqa: F401
+from .exceptions import ControlFailure, DispatchFailure, SlowConsumer  # noqa: F401
 from .p2pclient import Client  # noqa: F401
 
 name = "p2pclient"
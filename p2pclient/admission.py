@@ -0,0 +1,94 @@
+from typing import NamedTuple, Optional
+
+import anyio
+
+
+class HandlerStats(NamedTuple):
+    max_concurrent: int
+    num_running: int
+    num_waiting: int
+    num_admitted: int
+    # turned away because the wait queue was full
+    num_rejected: int
+    # turned away after waiting `wait_timeout` seconds
+    num_timed_out: int
+    total_wait_time: float
+    max_wait_time: float
+
+
+class HandlerLimiter:
+    """
+    Admission control for the inbound streams of one protocol. At most
+    `max_concurrent` handlers run at once, up to `max_waiting` more streams wait for
+    their turn for at most `wait_timeout` seconds, and the streams beyond that are
+    rejected right away.
+    """
+
+    max_concurrent: int
+    max_waiting: int
+    wait_timeout: Optional[float]
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_waiting: int = 0,
+        wait_timeout: Optional[float] = None,
+    ) -> None:
+        if max_concurrent < 1:
+            raise ValueError(f"max_concurrent should be positive: {max_concurrent}")
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._slots = anyio.Semaphore(max_concurrent)
+        self.num_waiting = 0
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.num_timed_out = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def num_running(self) -> int:
+        return self.max_concurrent - self._slots.value
+
+    def stats(self) -> HandlerStats:
+        return HandlerStats(
+            max_concurrent=self.max_concurrent,
+            num_running=self.num_running,
+            num_waiting=self.num_waiting,
+            num_admitted=self.num_admitted,
+            num_rejected=self.num_rejected,
+            num_timed_out=self.num_timed_out,
+            total_wait_time=self.total_wait_time,
+            max_wait_time=self.max_wait_time,
+        )
+
+    async def acquire(self) -> bool:
+        """Wait for a handler slot, return `False` if the stream is rejected."""
+        try:
+            self._slots.acquire_nowait()
+        except anyio.WouldBlock:
+            pass
+        else:
+            self.num_admitted += 1
+            return True
+        if self.num_waiting >= self.max_waiting:
+            self.num_rejected += 1
+            return False
+        self.num_waiting += 1
+        started_at = anyio.current_time()
+        try:
+            with anyio.move_on_after(self.wait_timeout):
+                await self._slots.acquire()
+                self.num_admitted += 1
+                return True
+            self.num_timed_out += 1
+            return False
+        finally:
+            self.num_waiting -= 1
+            wait_time = anyio.current_time() - started_at
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def release(self) -> None:
+        self._slots.release()
@@ -0,0 +1,174 @@
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, Sequence
+
+import anyio
+from anyio.abc import TaskGroup
+from async_generator import asynccontextmanager
+
+from .datastructures import PubSubMessage
+from .pubsub import Publisher, PubSubClient
+from .serialization import decode_unsigned_varint, encode_unsigned_varint
+
+# starts the data of every envelope, unlikely to start anything else
+ENVELOPE_MAGIC = b"\x00p2pb\x01"
+
+
+def encode_envelope(items: Sequence[bytes]) -> bytes:
+    """Pack `items` into the data of one pubsub message."""
+    return ENVELOPE_MAGIC + b"".join(
+        encode_unsigned_varint(len(item)) + item for item in items
+    )
+
+
+def decode_envelope(data: bytes) -> Optional[List[bytes]]:
+    """The items packed in `data`, or `None` if it is not an envelope."""
+    if not data.startswith(ENVELOPE_MAGIC):
+        return None
+    items: List[bytes] = []
+    offset = len(ENVELOPE_MAGIC)
+    while offset < len(data):
+        try:
+            length, offset = decode_unsigned_varint(data, offset)
+        except ValueError:
+            return None
+        end = offset + length
+        if end > len(data):
+            return None
+        items.append(data[offset:end])
+        offset = end
+    return items
+
+
+def unpack(msg: PubSubMessage) -> List[PubSubMessage]:
+    """
+    The messages packed in `msg` by a `BatchingPublisher`, or just `msg` if it is not
+    an envelope. They share the sender, seqno and validity of the envelope, so
+    duplicates have to be dropped before unpacking.
+    """
+    items = decode_envelope(msg.data)
+    if items is None:
+        return [msg]
+    return [
+        PubSubMessage(
+            from_id=msg.from_id,
+            data=item,
+            seqno=msg.seqno,
+            topic_ids=msg.topic_ids,
+            valid=msg.valid,
+        )
+        for item in items
+    ]
+
+
+async def unpacked(
+    msgs: AsyncIterable[PubSubMessage],
+) -> AsyncIterator[PubSubMessage]:
+    """Iterate over `msgs`, e.g. a `Subscription`, with the envelopes unpacked."""
+    async for msg in msgs:
+        for item in unpack(msg):
+            yield item
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.items: List[bytes] = []
+        self.num_bytes = len(ENVELOPE_MAGIC)
+        # cancelled when the batch is published before `max_delay` passed
+        self.timer = anyio.CancelScope()
+
+
+class BatchingPublisher:
+    """
+    Packs the messages published to a topic into envelopes of up to
+    `max_envelope_bytes`, each published as one pubsub message once it is full or
+    `max_delay` seconds after its first message, whichever comes first. Subscribers
+    get the messages back with `unpack` or `unpacked`.
+
+    Envelopes go through a `Publisher`, which keeps them in order per topic; the
+    remaining options are passed to `PubSubClient.publisher`. Messages can only be
+    published while `run` is active.
+    """
+
+    pubsub: PubSubClient
+    max_delay: float
+    max_envelope_bytes: int
+
+    def __init__(
+        self,
+        pubsub: PubSubClient,
+        max_delay: float = 0.05,
+        max_envelope_bytes: int = 16 * 1024,
+        num_connections: int = 1,
+        max_in_flight: int = 256,
+    ) -> None:
+        self.pubsub = pubsub
+        self.max_delay = max_delay
+        self.max_envelope_bytes = max_envelope_bytes
+        self._num_connections = num_connections
+        self._max_in_flight = max_in_flight
+        self._batches: Dict[str, _Batch] = {}
+        self._publisher: Optional[Publisher] = None
+        self._task_group: Optional[TaskGroup] = None
+        self.num_messages = 0
+        self.num_envelopes = 0
+
+    @asynccontextmanager
+    async def run(self) -> AsyncIterator["BatchingPublisher"]:
+        """Publish envelopes while the context is active, flushing them on exit."""
+        async with self.pubsub.publisher(
+            num_connections=self._num_connections, max_in_flight=self._max_in_flight
+        ) as publisher:
+            async with anyio.create_task_group() as task_group:
+                self._publisher = publisher
+                self._task_group = task_group
+                try:
+                    yield self
+                    await self.flush()
+                finally:
+                    self._publisher = None
+                    self._task_group = None
+                    task_group.cancel_scope.cancel()
+
+    async def publish(self, topic: str, data: bytes) -> None:
+        """Add a message to the topic's envelope, publishing the envelope if full."""
+        if self._task_group is None:
+            raise RuntimeError("BatchingPublisher is not running")
+        item_size = len(encode_unsigned_varint(len(data))) + len(data)
+        batch = self._batches.get(topic)
+        while batch is not None and (
+            batch.num_bytes + item_size > self.max_envelope_bytes
+        ):
+            await self._publish_batch(topic)
+            # other tasks may have started the next envelope while this one was sent
+            batch = self._batches.get(topic)
+        if batch is None:
+            batch = self._batches[topic] = _Batch()
+            self._task_group.start_soon(self._publish_later, topic, batch)
+        batch.items.append(data)
+        batch.num_bytes += item_size
+        self.num_messages += 1
+        if batch.num_bytes >= self.max_envelope_bytes:
+            await self._publish_batch(topic)
+
+    async def flush(self) -> None:
+        """
+        Publish every envelope now and wait for them to be acknowledged. Raises
+        `ControlFailure` if any envelope failed since the last `flush`.
+        """
+        for topic in tuple(self._batches):
+            await self._publish_batch(topic)
+        if self._publisher is not None:
+            await self._publisher.flush()
+
+    async def _publish_later(self, topic: str, batch: _Batch) -> None:
+        with batch.timer:
+            await anyio.sleep(self.max_delay)
+        if self._batches.get(topic) is batch:
+            await self._publish_batch(topic)
+
+    async def _publish_batch(self, topic: str) -> None:
+        batch = self._batches.pop(topic, None)
+        if batch is None or self._publisher is None:
+            return
+        batch.timer.cancel()
+        await self._publisher.publish(topic, encode_envelope(batch.items))
+        self.num_envelopes += 1
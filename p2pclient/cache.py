@@ -0,0 +1,204 @@
+import time
+from collections import Counter, OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .exceptions import ControlFailure
+
+TValue = TypeVar("TValue")
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class _Entry(NamedTuple):
+    value: Any
+    expires_at: Optional[float]
+    size: int
+
+
+class LRUCache(Generic[TValue]):
+    """
+    Bounded LRU mapping with optional per-entry expiry.
+
+    Both the number of entries and the sum of the sizes given to `set` are bounded;
+    the least recently used entries are evicted first. Expired entries are dropped
+    lazily when they are looked up or evicted.
+    """
+
+    max_entries: int
+    max_bytes: Optional[int]
+
+    def __init__(
+        self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: Optional[int] = None
+    ) -> None:
+        if max_entries < 1:
+            raise ValueError(f"max_entries should be positive: {max_entries}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._num_bytes = 0
+        self.num_evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not None
+
+    @property
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def get(self, key: Hashable, default: Optional[TValue] = None) -> Optional[TValue]:
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+        return entry.value
+
+    def set(
+        self, key: Hashable, value: TValue, ttl: Optional[float] = None, size: int = 0
+    ) -> None:
+        """
+        Store `value` for `ttl` seconds, or until evicted if `ttl` is `None`.
+        Values larger than `max_bytes` are not stored at all.
+        """
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._entries[key] = _Entry(value, expires_at, size)
+        self._num_bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._num_bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.size
+            self.num_evicted += 1
+
+    def pop(self, key: Hashable) -> Optional[TValue]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._num_bytes -= entry.size
+        return entry.value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._num_bytes = 0
+
+    def _lookup(self, key: Hashable) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+            self.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+
+class _NegativeResult(NamedTuple):
+    msg: str
+
+
+class _Fetches:
+    """The fetches of one key in flight, and how often the key was invalidated."""
+
+    def __init__(self) -> None:
+        self.num_fetches = 0
+        self.generation = 0
+
+
+class DHTCache:
+    """
+    Client-side cache of DHT lookup results with a TTL per operation.
+
+    Failed lookups are remembered for `negative_ttl` seconds and raise the same
+    `ControlFailure` again, which keeps hot misses away from the daemon as well.
+    Setting a TTL to 0 disables caching for that operation.
+    """
+
+    GET_VALUE = "get_value"
+    FIND_PEER = "find_peer"
+    GET_PUBLIC_KEY = "get_public_key"
+    FIND_PROVIDERS = "find_providers"
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+        get_value_ttl: float = 60.0,
+        find_peer_ttl: float = 300.0,
+        get_public_key_ttl: float = 3600.0,
+        find_providers_ttl: float = 60.0,
+        negative_ttl: float = 5.0,
+    ) -> None:
+        self.ttls = {
+            self.GET_VALUE: get_value_ttl,
+            self.FIND_PEER: find_peer_ttl,
+            self.GET_PUBLIC_KEY: get_public_key_ttl,
+            self.FIND_PROVIDERS: find_providers_ttl,
+        }
+        self.negative_ttl = negative_ttl
+        self.entries: LRUCache[Any] = LRUCache(max_entries, max_bytes)
+        self.hits: "Counter[str]" = Counter()
+        self.misses: "Counter[str]" = Counter()
+        self._fetches: Dict[Tuple[str, Hashable], _Fetches] = {}
+
+    async def get_or_fetch(
+        self,
+        op: str,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[TValue]],
+        size_of: Callable[[TValue], int],
+    ) -> TValue:
+        ttl = self.ttls[op]
+        if ttl <= 0:
+            return await fetch()
+        cache_key: Tuple[str, Hashable] = (op, key)
+        cached = self.entries.get(cache_key)
+        if cached is not None:
+            self.hits[op] += 1
+            if isinstance(cached, _NegativeResult):
+                raise ControlFailure(cached.msg)
+            return cached
+        self.misses[op] += 1
+        fetches = self._fetches.setdefault(cache_key, _Fetches())
+        fetches.num_fetches += 1
+        generation = fetches.generation
+        try:
+            value = await fetch()
+        except ControlFailure as e:
+            # a result fetched before an invalidation may be stale, it is not kept
+            if self.negative_ttl > 0 and fetches.generation == generation:
+                self.entries.set(cache_key, _NegativeResult(str(e)), self.negative_ttl)
+            raise
+        finally:
+            fetches.num_fetches -= 1
+            if fetches.num_fetches == 0:
+                del self._fetches[cache_key]
+        if fetches.generation == generation:
+            self.entries.set(cache_key, value, ttl, size_of(value))
+        return value
+
+    def invalidate(self, op: str, key: Hashable) -> None:
+        """Drop the result of `key`, and keep the ones being fetched from replacing it."""
+        cache_key = (op, key)
+        self.entries.pop(cache_key)
+        fetches = self._fetches.get(cache_key)
+        if fetches is not None:
+            fetches.generation += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -2,7 +2,7 @@ from p2pclient.libp2p_stubs.peer.id import ID
 
 from .control import DaemonConnector
 from .pb import p2pd_pb2 as p2pd_pb
-from .utils import raise_if_failed, read_pbmsg_safe, write_pbmsg
+from .utils import raise_if_failed
 
 
 class ConnectionManagerClient:
@@ -20,11 +20,7 @@ class ConnectionManagerClient:
             weight=weight,
         )
         req = p2pd_pb.Request(type=p2pd_pb.Request.CONNMANAGER, connManager=connmgr_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
 
     async def untag_peer(self, peer_id: ID, tag: str) -> None:
@@ -33,20 +29,12 @@ class ConnectionManagerClient:
             type=p2pd_pb.ConnManagerRequest.UNTAG_PEER, peer=peer_id.to_bytes(), tag=tag
         )
         req = p2pd_pb.Request(type=p2pd_pb.Request.CONNMANAGER, connManager=connmgr_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
 
     async def trim(self) -> None:
         """TRIM"""
         connmgr_req = p2pd_pb.ConnManagerRequest(type=p2pd_pb.ConnManagerRequest.TRIM)
         req = p2pd_pb.Request(type=p2pd_pb.Request.CONNMANAGER, connManager=connmgr_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
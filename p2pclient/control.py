@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import logging
 import sys
 
@@ -8,11 +9,14 @@ if sys.version_info >= (3, 11):
 else:  # Python < 3.11
     from exceptiongroup import BaseExceptionGroup
 from typing import (
+    AsyncGenerator,
     AsyncIterator,
     Awaitable,
     Callable,
     Dict,
     Iterable,
+    List,
+    Mapping,
     Optional,
     Sequence,
     Tuple,
@@ -20,16 +24,30 @@ from typing import (
 
 import anyio
 from anyio.abc import ByteStream, Listener, TaskGroup
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from async_generator import asynccontextmanager
 from multiaddr import Multiaddr, protocols
 
 from p2pclient.libp2p_stubs.peer.id import ID
 
 from . import config
+from .admission import HandlerLimiter, HandlerStats
 from .datastructures import PeerInfo, StreamInfo
-from .exceptions import ControlFailure, DispatchFailure
+from .exceptions import ControlFailure
 from .pb import p2pd_pb2 as p2pd_pb
-from .utils import raise_if_failed, read_pbmsg_safe, write_pbmsg
+from .pipeline import PipelinedConnection, is_pipelinable, is_quick
+from .pool import ConnectionPool
+from .serialization import FramedStream
+from .singleflight import SingleFlight
+from .utils import (
+    deadline_after,
+    raise_if_failed,
+    read_pbmsg_safe,
+    read_timeout,
+    set_request_timeout,
+    time_left,
+    write_pbmsg,
+)
 
 # Type alias for compatibility
 SocketStream = ByteStream
@@ -47,6 +65,16 @@ _supported_conn_protocols = (
 )
 
 
+def is_reusable_response(resp: p2pd_pb.Response) -> bool:
+    """
+    Whether the connection that carried `resp` is back in the request/response state.
+    """
+    if resp.type == p2pd_pb.Response.ERROR:
+        return False
+    # a DHT BEGIN is followed by a stream of `DHTResponse`s up to END
+    return not (resp.HasField("dht") and resp.dht.type == p2pd_pb.DHTResponse.BEGIN)
+
+
 def parse_conn_protocol(maddr: Multiaddr) -> int:
     proto_codes = set(proto.code for proto in maddr.protocols())
     proto_cand = proto_codes.intersection(_supported_conn_protocols)
@@ -63,51 +91,193 @@ def parse_conn_protocol(maddr: Multiaddr) -> int:
 
 class DaemonConnector:
     control_maddr: Multiaddr
+    pool: Optional[ConnectionPool] = None
+    pipeline: Optional[PipelinedConnection] = None
+    # which of the pipelinable requests go through `pipeline`
+    pipeline_filter: Callable[[p2pd_pb.Request], bool]
+    single_flight: SingleFlight
+    timeout: Optional[float]
     logger = logging.getLogger("p2pclient.DaemonConnector")
 
-    def __init__(self, control_maddr: Optional[Multiaddr] = None) -> None:
+    def __init__(
+        self,
+        control_maddr: Optional[Multiaddr] = None,
+        pool_max_size: int = 0,
+        pool_min_size: int = 0,
+        pool_idle_timeout: float = 60.0,
+        pool_health_check: bool = True,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Pooling of control connections is disabled unless `pool_max_size` is positive,
+        since it relies on the daemon serving several requests per connection.
+
+        `timeout` is the default budget in seconds for a whole call, used when the
+        call itself is not given one. Without any, each read may stall for up to
+        `DEFAULT_READ_TIMEOUT` seconds.
+        """
         if control_maddr is None:
             control_maddr = Multiaddr(config.control_maddr_str)
         self.control_maddr = control_maddr
+        self.timeout = timeout
+        self.single_flight = SingleFlight()
+        self.pipeline_filter = is_quick
+        if pool_max_size > 0:
+            self.pool = ConnectionPool(
+                self.open_connection,
+                min_size=pool_min_size,
+                max_size=pool_max_size,
+                idle_timeout=pool_idle_timeout,
+                health_check=pool_health_check,
+            )
 
     async def open_connection(self) -> ByteStream:
+        """
+        Open a new control connection. It comes with a `FramedReader` buffer that has
+        to stay in front of the socket for the whole life of the connection.
+        """
         proto_code = parse_conn_protocol(self.control_maddr)
         if proto_code == protocols.P_UNIX:
             control_path = self.control_maddr.value_for_protocol(protocols.P_UNIX)
             self.logger.debug(
                 "DaemonConnector %s opens connection to %s", self, self.control_maddr
             )
-            return await anyio.connect_unix(control_path)
+            return FramedStream(await anyio.connect_unix(control_path))
         elif proto_code == protocols.P_IP4:
             host = self.control_maddr.value_for_protocol(protocols.P_IP4)
             port = int(self.control_maddr.value_for_protocol(protocols.P_TCP))
-            return await anyio.connect_tcp(host, port)
+            return FramedStream(await anyio.connect_tcp(host, port))
         else:
             raise ValueError(
                 f"protocol not supported: protocol={protocols.protocol_with_code(proto_code)}"
             )
 
+    async def acquire_connection(self) -> ByteStream:
+        """
+        Get a control connection for a request/response exchange, reusing an idle
+        one if pooling is enabled. Hand it back with `release_connection`.
+        """
+        if self.pool is None:
+            return await self.open_connection()
+        return await self.pool.acquire()
+
+    async def release_connection(self, stream: ByteStream, reusable: bool) -> None:
+        """
+        Return a connection obtained from `acquire_connection`. Connections that saw
+        an error or a streaming response must be released with `reusable=False`.
+        """
+        if self.pool is None:
+            await stream.aclose()
+        else:
+            await self.pool.release(stream, reusable=reusable)
+
+    def call_deadline(self, timeout: Optional[float] = None) -> float:
+        """Deadline of a call given `timeout`, falling back to the connector's."""
+        return deadline_after(self.timeout if timeout is None else timeout)
+
+    async def request(
+        self, req: p2pd_pb.Request, timeout: Optional[float] = None
+    ) -> p2pd_pb.Response:
+        """Send a request that is answered by exactly one `Response`."""
+        deadline = self.call_deadline(timeout)
+        set_request_timeout(req, deadline)
+        pipeline = self.pipeline
+        if pipeline is not None and not pipeline.usable:
+            # a failed pipeline stays failed, fall back to the other connections
+            pipeline = None
+        if pipeline is not None and is_pipelinable(req) and self.pipeline_filter(req):
+            with anyio.fail_after(time_left(deadline)):
+                return await pipeline.request(req, deadline=deadline)
+        with anyio.fail_after(time_left(deadline)):
+            stream = await self.acquire_connection()
+        resp = p2pd_pb.Response()
+        try:
+            with anyio.fail_after(time_left(deadline)):
+                await write_pbmsg(stream, req)
+                await read_pbmsg_safe(stream, resp, timeout=read_timeout(deadline))
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await self.release_connection(stream, reusable=False)
+            raise
+        await self.release_connection(stream, reusable=is_reusable_response(resp))
+        return resp
+
+    async def coalesced_request(
+        self, req: p2pd_pb.Request, timeout: Optional[float] = None
+    ) -> p2pd_pb.Response:
+        """
+        Like `request`, but identical requests in flight at the same time share one
+        daemon round trip. Only for requests that do not change the daemon's state.
+        """
+        with anyio.fail_after(time_left(self.call_deadline(timeout))):
+            return await self.single_flight.do(
+                req.SerializeToString(), functools.partial(self.request, req, timeout)
+            )
+
+    @asynccontextmanager
+    async def pipelined(
+        self,
+        max_in_flight: int = 64,
+        route: Callable[[p2pd_pb.Request], bool] = is_quick,
+    ) -> AsyncIterator[PipelinedConnection]:
+        """
+        Route the single-response requests of every client sharing this connector
+        for which `route` returns `True` through one pipelined connection while the
+        context is active. The daemon answers them one at a time, so by default only
+        the requests answered from its local state are routed, e.g. publishes and
+        connection manager tags, and not dials or DHT operations. The pending
+        responses are awaited before the connection is closed.
+        """
+        if self.pipeline is not None:
+            raise ControlFailure("DaemonConnector is already pipelined")
+        stream = await self.open_connection()
+        pipeline = PipelinedConnection(stream, max_in_flight=max_in_flight)
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(pipeline.read_responses)
+            self.pipeline = pipeline
+            self.pipeline_filter = route
+            try:
+                yield pipeline
+                await pipeline.drain()
+            finally:
+                self.pipeline = None
+                await pipeline.aclose()
+
+    async def aclose(self) -> None:
+        if self.pool is not None:
+            await self.pool.aclose()
+
+
+async def _close_stream(stream_info: StreamInfo, stream: ByteStream) -> None:
+    await stream.aclose()
+
 
 class ControlClient:
     listen_maddr: Multiaddr
     daemon_connector: DaemonConnector
     handlers: Dict[str, StreamHandler]
+    handler_limiters: Dict[str, HandlerLimiter]
     listener_tcp: Optional[Listener[ByteStream]] = None
     listener_unix: Optional[Listener[ByteStream]] = None
     listener: Optional[Listener[ByteStream]] = None
     task_group: Optional[TaskGroup] = None
+    # let several processes listen on the same TCP port, see `sharding`
+    reuse_port: bool
     logger = logging.getLogger("p2pclient.ControlClient")
 
     def __init__(
         self,
         daemon_connector: DaemonConnector,
         listen_maddr: Optional[Multiaddr] = None,
+        reuse_port: bool = False,
     ) -> None:
         if listen_maddr is None:
             listen_maddr = Multiaddr(config.listen_maddr_str)
         self.listen_maddr = listen_maddr
         self.daemon_connector = daemon_connector
+        self.reuse_port = reuse_port
         self.handlers = {}
+        self.handler_limiters = {}
 
     async def _accept_new_connections(self, listener: Listener[ByteStream]) -> None:
         try:
@@ -116,18 +286,32 @@ class ControlClient:
             # Expected when the listener is closed during teardown
             pass
 
-    async def _dispatcher(self, stream: ByteStream) -> None:
+    async def _dispatcher(self, raw_stream: ByteStream) -> None:
+        # payload read along with the header stays in the buffer for the handler
+        stream = FramedStream(raw_stream)
         pb_stream_info = p2pd_pb.StreamInfo()
         await read_pbmsg_safe(stream, pb_stream_info)
         stream_info = StreamInfo.from_pb(pb_stream_info)
         self.logger.info("New incoming stream: %s", stream_info)
-        try:
-            handler = self.handlers[stream_info.proto]
-        except KeyError as e:
-            # should never enter here... daemon should reject the stream for us.
+        handler = self.handlers.get(stream_info.proto)
+        if handler is None:
+            # the daemon still routes protocols whose handler was removed, raising
+            # here would stop the listener for every other protocol
+            self.logger.warning("No handler for %s, closing stream", stream_info.proto)
+            await stream.aclose()
+            return
+        limiter = self.handler_limiters.get(stream_info.proto)
+        if limiter is None:
+            await handler(stream_info, stream)
+            return
+        if not await limiter.acquire():
+            self.logger.debug("Rejecting stream, %s is saturated", stream_info.proto)
             await stream.aclose()
-            raise DispatchFailure(e)
-        await handler(stream_info, stream)
+            return
+        try:
+            await handler(stream_info, stream)
+        finally:
+            limiter.release()
 
     @asynccontextmanager
     async def listen(self) -> AsyncIterator["ControlClient"]:
@@ -142,7 +326,7 @@ class ControlClient:
             host = self.listen_maddr.value_for_protocol(protocols.P_IP4)
             port = int(self.listen_maddr.value_for_protocol(protocols.P_TCP))
             self.listener_tcp = await anyio.create_tcp_listener(
-                local_host=host, local_port=port
+                local_host=host, local_port=port, reuse_port=self.reuse_port
             )
             self.listener = self.listener_tcp
         else:
@@ -197,13 +381,8 @@ class ControlClient:
         self.logger.info("DaemonConnector %s closed", self)
 
     async def identify(self) -> Tuple[ID, Tuple[Multiaddr, ...]]:
-        stream = await self.daemon_connector.open_connection()
         req = p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY)
-        await write_pbmsg(stream, req)
-
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.coalesced_request(req)
         raise_if_failed(resp)
         peer_id_bytes = resp.identify.id
         maddrs_bytes = resp.identify.addrs
@@ -213,28 +392,23 @@ class ControlClient:
 
         return peer_id, maddrs
 
-    async def connect(self, peer_id: ID, maddrs: Iterable[Multiaddr]) -> None:
-        stream = await self.daemon_connector.open_connection()
-
+    async def connect(
+        self,
+        peer_id: ID,
+        maddrs: Iterable[Multiaddr],
+        timeout: Optional[float] = None,
+    ) -> None:
         maddrs_bytes = [i.to_bytes() for i in maddrs]
         connect_req = p2pd_pb.ConnectRequest(
             peer=peer_id.to_bytes(), addrs=maddrs_bytes
         )
         req = p2pd_pb.Request(type=p2pd_pb.Request.CONNECT, connect=connect_req)
-        await write_pbmsg(stream, req)
-
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req, timeout=timeout)
         raise_if_failed(resp)
 
     async def list_peers(self) -> Tuple[PeerInfo, ...]:
         req = p2pd_pb.Request(type=p2pd_pb.Request.LIST_PEERS)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.coalesced_request(req)
         raise_if_failed(resp)
 
         peers = tuple(PeerInfo.from_pb(pinfo) for pinfo in resp.peers)
@@ -245,17 +419,19 @@ class ControlClient:
         req = p2pd_pb.Request(
             type=p2pd_pb.Request.DISCONNECT, disconnect=disconnect_req
         )
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
 
     async def stream_open(
-        self, peer_id: ID, protocols: Sequence[str]
+        self,
+        peer_id: ID,
+        protocols: Sequence[str],
+        timeout: Optional[float] = None,
     ) -> Tuple[StreamInfo, ByteStream]:
-        stream = await self.daemon_connector.open_connection()
+        """`timeout` bounds opening the stream, not its later use."""
+        deadline = self.daemon_connector.call_deadline(timeout)
+        with anyio.fail_after(time_left(deadline)):
+            stream = await self.daemon_connector.open_connection()
 
         stream_open_req = p2pd_pb.StreamOpenRequest(
             peer=peer_id.to_bytes(), proto=list(protocols)
@@ -263,11 +439,17 @@ class ControlClient:
         req = p2pd_pb.Request(
             type=p2pd_pb.Request.STREAM_OPEN, streamOpen=stream_open_req
         )
-        await write_pbmsg(stream, req)
-
+        set_request_timeout(req, deadline)
         resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        raise_if_failed(resp)
+        try:
+            with anyio.fail_after(time_left(deadline)):
+                await write_pbmsg(stream, req)
+                await read_pbmsg_safe(stream, resp, timeout=read_timeout(deadline))
+            raise_if_failed(resp)
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await stream.aclose()
+            raise
 
         pb_stream_info = resp.streamInfo
         stream_info = StreamInfo.from_pb(pb_stream_info)
@@ -275,21 +457,136 @@ class ControlClient:
         return stream_info, stream
 
     async def stream_handler(self, proto: str, handler_cb: StreamHandler) -> None:
-        stream = await self.daemon_connector.open_connection()
+        await self._register_protocols([proto])
+
+        # if success, add the handler to the dict
+        self.handlers[proto] = handler_cb
 
+    async def stream_handlers(self, handlers: Mapping[str, StreamHandler]) -> None:
+        """
+        Register all the protocols of `handlers` in one STREAM_HANDLER request, or if
+        the daemon rejects it, in one request per protocol sent concurrently.
+
+        The handlers are installed before the requests are sent, so no stream routed
+        by the daemon finds its protocol without a handler. If some protocols are
+        rejected, the ones registered keep their new handler, the others get their
+        previous one back, and `ControlFailure` says which are which.
+        """
+        if not handlers:
+            return
+        protos = list(handlers)
+        previous = {proto: self.handlers.get(proto) for proto in protos}
+        self.handlers.update(handlers)
+        try:
+            await self._register_protocols(protos)
+        except ControlFailure as e:
+            if len(protos) == 1:
+                self._restore_handlers(previous, protos)
+                raise
+            self.logger.debug(
+                "Registering %d protocols at once failed, one by one now: %s",
+                len(protos),
+                e,
+            )
+            errors: Dict[str, ControlFailure] = {}
+
+            async def register(proto: str) -> None:
+                try:
+                    await self._register_protocols([proto])
+                except ControlFailure as e:
+                    errors[proto] = e
+
+            async with anyio.create_task_group() as task_group:
+                for proto in protos:
+                    task_group.start_soon(register, proto)
+            if errors:
+                self._restore_handlers(previous, list(errors))
+                registered = [proto for proto in protos if proto not in errors]
+                raise ControlFailure(
+                    f"registered {registered}, failed to register {list(errors)}: "
+                    f"{next(iter(errors.values()))}"
+                )
+
+    def _restore_handlers(
+        self,
+        previous: Mapping[str, Optional[StreamHandler]],
+        protos: List[str],
+    ) -> None:
+        for proto in protos:
+            handler = previous[proto]
+            if handler is None:
+                del self.handlers[proto]
+            else:
+                self.handlers[proto] = handler
+
+    async def _register_protocols(self, protos: List[str]) -> None:
         listen_path_maddr_bytes = self.listen_maddr.to_bytes()
         stream_handler_req = p2pd_pb.StreamHandlerRequest(
-            addr=listen_path_maddr_bytes, proto=[proto]
+            addr=listen_path_maddr_bytes, proto=protos
         )
         req = p2pd_pb.Request(
             type=p2pd_pb.Request.STREAM_HANDLER, streamHandler=stream_handler_req
         )
-        await write_pbmsg(stream, req)
-
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
 
-        # if success, add the handler to the dict
-        self.handlers[proto] = handler_cb
+    def limit_handlers(
+        self,
+        proto: str,
+        max_concurrent: int,
+        max_waiting: int = 0,
+        wait_timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Run at most `max_concurrent` handlers of `proto` at once. Up to `max_waiting`
+        more inbound streams wait at most `wait_timeout` seconds for their turn, the
+        others are closed right away.
+        """
+        self.handler_limiters[proto] = HandlerLimiter(
+            max_concurrent, max_waiting=max_waiting, wait_timeout=wait_timeout
+        )
+
+    def handler_stats(self) -> Dict[str, HandlerStats]:
+        return {
+            proto: limiter.stats() for proto, limiter in self.handler_limiters.items()
+        }
+
+    async def accept(
+        self, proto: str, max_pending: int = 16
+    ) -> AsyncGenerator[Tuple[StreamInfo, ByteStream], None]:
+        """
+        Register a handler for `proto` when iteration starts and yield its inbound
+        streams as they are pulled, instead of running a callback for each of them.
+        Once `max_pending` streams wait to be pulled, the next ones wait in their
+        handler task.
+
+        The streams pulled are the caller's to close. When the generator is closed,
+        the streams not pulled yet are closed, and so are the ones arriving later:
+        the daemon has no way to unregister `proto`.
+        """
+        send_stream: MemoryObjectSendStream[Tuple[StreamInfo, ByteStream]]
+        receive_stream: MemoryObjectReceiveStream[Tuple[StreamInfo, ByteStream]]
+        send_stream, receive_stream = anyio.create_memory_object_stream(max_pending)
+
+        async def handler(stream_info: StreamInfo, stream: ByteStream) -> None:
+            try:
+                await send_stream.send((stream_info, stream))
+            except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+                await stream.aclose()
+
+        await self.stream_handler(proto, handler)
+        try:
+            async for item in receive_stream:
+                yield item
+        finally:
+            if self.handlers.get(proto) is handler:
+                self.handlers[proto] = _close_stream
+            send_stream.close()
+            with anyio.CancelScope(shield=True):
+                while True:
+                    try:
+                        _, stream = receive_stream.receive_nowait()
+                    except (anyio.WouldBlock, anyio.EndOfStream):
+                        break
+                    await stream.aclose()
+            receive_stream.close()
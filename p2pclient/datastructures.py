@@ -1,3 +1,5 @@
+from typing import Optional, Sequence, Tuple
+
 from multiaddr import Multiaddr
 
 from p2pclient.libp2p_stubs.peer.id import ID
@@ -41,3 +43,63 @@ class PeerInfo(PeerInfoLibP2P):
         peer_id = ID(peer_info_pb.id)
         addrs = [Multiaddr(addr) for addr in peer_info_pb.addrs]
         return PeerInfoLibP2P(peer_id, addrs)
+
+
+class PubSubMessage:
+    from_id: ID
+    data: bytes
+    seqno: bytes
+    topic_ids: Tuple[str, ...]
+    signature: bytes
+    key: bytes
+    # whether the signature checked out, `None` if it was not verified
+    valid: Optional[bool]
+
+    def __init__(
+        self,
+        from_id: ID,
+        data: bytes,
+        seqno: bytes = b"",
+        topic_ids: Sequence[str] = (),
+        signature: bytes = b"",
+        key: bytes = b"",
+        valid: Optional[bool] = None,
+    ) -> None:
+        self.from_id = from_id
+        self.data = data
+        self.seqno = seqno
+        self.topic_ids = tuple(topic_ids)
+        self.signature = signature
+        self.key = key
+        self.valid = valid
+
+    def __repr__(self) -> str:
+        return (
+            f"<PubSubMessage from_id={self.from_id} seqno={self.seqno.hex()} "
+            f"topic_ids={self.topic_ids} valid={self.valid} data={self.data!r}>"
+        )
+
+    def to_pb(self) -> p2pd_pb2.PSMessage:
+        # empty optional fields are left unset, as the daemon does, which keeps the
+        # serialization identical to the one the signature was made over
+        pb_msg = p2pd_pb2.PSMessage(
+            data=self.data,
+            seqno=self.seqno or None,
+            topicIDs=self.topic_ids,
+            signature=self.signature or None,
+            key=self.key or None,
+        )
+        # `from` is a keyword
+        setattr(pb_msg, "from", self.from_id.to_bytes())
+        return pb_msg
+
+    @classmethod
+    def from_pb(cls, pb_msg: p2pd_pb2.PSMessage) -> "PubSubMessage":
+        return cls(
+            from_id=ID(getattr(pb_msg, "from")),
+            data=pb_msg.data,
+            seqno=pb_msg.seqno,
+            topic_ids=pb_msg.topicIDs,
+            signature=pb_msg.signature,
+            key=pb_msg.key,
+        )
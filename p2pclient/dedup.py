@@ -0,0 +1,36 @@
+from typing import Tuple
+
+from .cache import LRUCache
+from .datastructures import PubSubMessage
+
+
+class DuplicateFilter:
+    """
+    Recognizes pubsub messages seen before by their (`from`, `seqno`) pair.
+
+    Message IDs are remembered for `ttl` seconds, and at most `max_entries` of them
+    are kept, so memory stays bounded however many messages go through. One filter
+    can be shared by several subscriptions, e.g. to the same topic on different
+    daemons. Messages without a `seqno` are never considered duplicates.
+    """
+
+    ttl: float
+
+    def __init__(self, max_entries: int = 65536, ttl: float = 120.0) -> None:
+        self.ttl = ttl
+        self._seen: LRUCache[bool] = LRUCache(max_entries)
+        self.num_dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def is_duplicate(self, msg: PubSubMessage) -> bool:
+        """Record `msg` as seen and return whether it already was."""
+        if not msg.seqno:
+            return False
+        msg_id: Tuple[bytes, bytes] = (msg.from_id.to_bytes(), msg.seqno)
+        if msg_id in self._seen:
+            self.num_dropped += 1
+            return True
+        self._seen.set(msg_id, True, ttl=self.ttl)
+        return False
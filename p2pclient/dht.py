@@ -1,65 +1,156 @@
-from typing import AsyncGenerator, Tuple
+import functools
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
+import anyio
 from anyio.abc import ByteStream
+from async_generator import aclosing
 
 from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
 from p2pclient.libp2p_stubs.peer.id import ID
 
+from .cache import DHTCache, LRUCache
 from .control import DaemonConnector
 from .datastructures import PeerInfo
 from .exceptions import ControlFailure
 from .pb import p2pd_pb2 as p2pd_pb
-from .utils import raise_if_failed, read_pbmsg_safe, write_pbmsg
+from .utils import (
+    raise_if_failed,
+    read_pbmsg_safe,
+    read_timeout,
+    set_request_timeout,
+    time_left,
+    write_pbmsg,
+)
+
+TResult = TypeVar("TResult")
+
+
+def _peer_info_size(pinfo: PeerInfo) -> int:
+    return len(pinfo.peer_id.to_bytes()) + sum(
+        len(addr.to_bytes()) for addr in pinfo.addrs
+    )
 
 
 class DHTClient:
     daemon_connector: DaemonConnector
+    cache: Optional[DHTCache]
+    # peer IDs are derived from their keys, so a key never goes stale
+    public_keys: Optional[LRUCache[crypto_pb.PublicKey]]
 
-    def __init__(self, daemon_connector: DaemonConnector) -> None:
+    def __init__(
+        self,
+        daemon_connector: DaemonConnector,
+        cache: Optional[DHTCache] = None,
+        public_key_cache_size: int = 1024,
+    ) -> None:
         self.daemon_connector = daemon_connector
+        self.cache = cache
+        self.public_keys = (
+            LRUCache(public_key_cache_size) if public_key_cache_size > 0 else None
+        )
+
+    async def _cached(
+        self,
+        op: str,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[TResult]],
+        size_of: Callable[[TResult], int],
+    ) -> TResult:
+        if self.cache is None:
+            return await fetch()
+        return await self.cache.get_or_fetch(op, key, fetch, size_of)
 
     @staticmethod
     async def _read_dht_stream(
-        stream: ByteStream,
+        stream: ByteStream, deadline: float
     ) -> AsyncGenerator[p2pd_pb.DHTResponse, None]:
+        # `stream` is a `FramedStream`, items already buffered are decoded without I/O
         while True:
             dht_resp = p2pd_pb.DHTResponse()
-            await read_pbmsg_safe(stream, dht_resp)
+            await read_pbmsg_safe(stream, dht_resp, timeout=read_timeout(deadline))
             if dht_resp.type == dht_resp.END:
                 break
             yield dht_resp
 
     async def _do_dht(
-        self, dht_req: p2pd_pb.DHTRequest
+        self, dht_req: p2pd_pb.DHTRequest, timeout: Optional[float] = None
     ) -> Tuple[p2pd_pb.DHTResponse, ...]:
-        stream = await self.daemon_connector.open_connection()
+        # every query collected here is a read, so identical concurrent ones are shared
         req = p2pd_pb.Request(type=p2pd_pb.Request.DHT, dht=dht_req)
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        raise_if_failed(resp)
+        deadline = self.daemon_connector.call_deadline(timeout)
+        with anyio.fail_after(time_left(deadline)):
+            return await self.daemon_connector.single_flight.do(
+                req.SerializeToString(),
+                functools.partial(self._collect_dht, dht_req, timeout),
+            )
 
+    async def _collect_dht(
+        self, dht_req: p2pd_pb.DHTRequest, timeout: Optional[float]
+    ) -> Tuple[p2pd_pb.DHTResponse, ...]:
+        return tuple([i async for i in self._do_dht_iter(dht_req, timeout)])
+
+    async def _do_dht_iter(
+        self, dht_req: p2pd_pb.DHTRequest, timeout: Optional[float] = None
+    ) -> AsyncGenerator[p2pd_pb.DHTResponse, None]:
+        # one budget for the whole query, which the daemon is told about as well
+        deadline = self.daemon_connector.call_deadline(timeout)
+        with anyio.fail_after(time_left(deadline)):
+            stream = await self.daemon_connector.acquire_connection()
+        # only a single VALUE response leaves the connection ready for another request
+        reusable = False
         try:
-            dht_resp = resp.dht
-        except AttributeError as e:
-            raise ControlFailure(f"resp should contains dht: resp={resp}, e={e}")
+            req = p2pd_pb.Request(type=p2pd_pb.Request.DHT, dht=dht_req)
+            set_request_timeout(req, deadline)
+            resp = p2pd_pb.Response()
+            with anyio.fail_after(time_left(deadline)):
+                await write_pbmsg(stream, req)
+                await read_pbmsg_safe(stream, resp, timeout=read_timeout(deadline))
+            raise_if_failed(resp)
+
+            try:
+                dht_resp = resp.dht
+            except AttributeError as e:
+                raise ControlFailure(f"resp should contains dht: resp={resp}, e={e}")
 
-        if dht_resp.type == dht_resp.VALUE:
-            return (dht_resp,)
+            if dht_resp.type == dht_resp.VALUE:
+                yield dht_resp
+                reusable = True
+                return
 
-        if dht_resp.type != dht_resp.BEGIN:
-            raise ControlFailure(f"Type should be BEGIN instead of {dht_resp.type}")
-        # BEGIN/END stream
-        resps = tuple([i async for i in self._read_dht_stream(stream)])
-        await stream.aclose()
-        return resps
+            if dht_resp.type != dht_resp.BEGIN:
+                raise ControlFailure(f"Type should be BEGIN instead of {dht_resp.type}")
+            # BEGIN/END stream
+            async for i in self._read_dht_stream(stream, deadline):
+                yield i
+        finally:
+            # also reached when the consumer stops early, which tears the query down
+            with anyio.CancelScope(shield=True):
+                await self.daemon_connector.release_connection(
+                    stream, reusable=reusable
+                )
 
-    async def find_peer(self, peer_id: ID) -> PeerInfo:
+    async def find_peer(self, peer_id: ID, timeout: Optional[float] = None) -> PeerInfo:
         """FIND_PEER"""
+        return await self._cached(
+            DHTCache.FIND_PEER,
+            peer_id,
+            functools.partial(self._find_peer, peer_id, timeout),
+            _peer_info_size,
+        )
+
+    async def _find_peer(self, peer_id: ID, timeout: Optional[float]) -> PeerInfo:
         dht_req = p2pd_pb.DHTRequest(
             type=p2pd_pb.DHTRequest.FIND_PEER, peer=peer_id.to_bytes()
         )
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         if len(resps) != 1:
             raise ControlFailure(
                 f"should only get one response from `find_peer`, resps={resps}"
@@ -73,13 +164,15 @@ class DHTClient:
             )
         return PeerInfo.from_pb(pinfo)  # type: ignore
 
-    async def find_peers_connected_to_peer(self, peer_id: ID) -> Tuple[PeerInfo, ...]:
+    async def find_peers_connected_to_peer(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> Tuple[PeerInfo, ...]:
         """FIND_PEERS_CONNECTED_TO_PEER"""
         dht_req = p2pd_pb.DHTRequest(
             type=p2pd_pb.DHTRequest.FIND_PEERS_CONNECTED_TO_PEER,
             peer=peer_id.to_bytes(),
         )
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         try:
             pinfos = tuple(PeerInfo.from_pb(dht_resp.peer) for dht_resp in resps)
         except AttributeError as e:
@@ -88,15 +181,37 @@ class DHTClient:
             )
         return pinfos  # type: ignore
 
+    async def find_peers_connected_to_peer_iter(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> AsyncGenerator[PeerInfo, None]:
+        """FIND_PEERS_CONNECTED_TO_PEER, yielding peers as they are found"""
+        dht_req = p2pd_pb.DHTRequest(
+            type=p2pd_pb.DHTRequest.FIND_PEERS_CONNECTED_TO_PEER,
+            peer=peer_id.to_bytes(),
+        )
+        async with aclosing(self._do_dht_iter(dht_req, timeout)) as resps:
+            async for dht_resp in resps:
+                yield PeerInfo.from_pb(dht_resp.peer)  # type: ignore
+
     async def find_providers(
-        self, content_id_bytes: bytes, count: int
+        self, content_id_bytes: bytes, count: int, timeout: Optional[float] = None
     ) -> Tuple[PeerInfo, ...]:
         """FIND_PROVIDERS"""
+        return await self._cached(
+            DHTCache.FIND_PROVIDERS,
+            (content_id_bytes, count),
+            functools.partial(self._find_providers, content_id_bytes, count, timeout),
+            lambda pinfos: sum(_peer_info_size(pinfo) for pinfo in pinfos),
+        )
+
+    async def _find_providers(
+        self, content_id_bytes: bytes, count: int, timeout: Optional[float]
+    ) -> Tuple[PeerInfo, ...]:
         # TODO: should have another class ContendID
         dht_req = p2pd_pb.DHTRequest(
             type=p2pd_pb.DHTRequest.FIND_PROVIDERS, cid=content_id_bytes, count=count
         )
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         try:
             pinfos = tuple(PeerInfo.from_pb(dht_resp.peer) for dht_resp in resps)
         except AttributeError as e:
@@ -105,10 +220,23 @@ class DHTClient:
             )
         return pinfos  # type: ignore
 
-    async def get_closest_peers(self, key: bytes) -> Tuple[ID, ...]:
+    async def find_providers_iter(
+        self, content_id_bytes: bytes, count: int, timeout: Optional[float] = None
+    ) -> AsyncGenerator[PeerInfo, None]:
+        """FIND_PROVIDERS, yielding providers as they are found"""
+        dht_req = p2pd_pb.DHTRequest(
+            type=p2pd_pb.DHTRequest.FIND_PROVIDERS, cid=content_id_bytes, count=count
+        )
+        async with aclosing(self._do_dht_iter(dht_req, timeout)) as resps:
+            async for dht_resp in resps:
+                yield PeerInfo.from_pb(dht_resp.peer)  # type: ignore
+
+    async def get_closest_peers(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> Tuple[ID, ...]:
         """GET_CLOSEST_PEERS"""
         dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.GET_CLOSEST_PEERS, key=key)
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         try:
             peer_ids = tuple(ID(dht_resp.value) for dht_resp in resps)
         except AttributeError as e:
@@ -117,12 +245,47 @@ class DHTClient:
             )
         return peer_ids
 
-    async def get_public_key(self, peer_id: ID) -> crypto_pb.PublicKey:
-        """GET_PUBLIC_KEY"""
+    async def get_closest_peers_iter(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> AsyncGenerator[ID, None]:
+        """GET_CLOSEST_PEERS, yielding peers as they are found"""
+        dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.GET_CLOSEST_PEERS, key=key)
+        async with aclosing(self._do_dht_iter(dht_req, timeout)) as resps:
+            async for dht_resp in resps:
+                yield ID(dht_resp.value)
+
+    async def get_public_key(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> crypto_pb.PublicKey:
+        """
+        GET_PUBLIC_KEY
+
+        Keys inlined in identity-multihash peer IDs are decoded locally, without asking
+        the daemon.
+        """
+        if self.public_keys is not None:
+            public_key_pb = self.public_keys.get(peer_id)
+            if public_key_pb is not None:
+                return public_key_pb
+        public_key_pb = peer_id.extract_public_key()
+        if public_key_pb is None:
+            public_key_pb = await self._cached(
+                DHTCache.GET_PUBLIC_KEY,
+                peer_id,
+                functools.partial(self._get_public_key, peer_id, timeout),
+                lambda public_key_pb: public_key_pb.ByteSize(),
+            )
+        if self.public_keys is not None:
+            self.public_keys.set(peer_id, public_key_pb)
+        return public_key_pb
+
+    async def _get_public_key(
+        self, peer_id: ID, timeout: Optional[float]
+    ) -> crypto_pb.PublicKey:
         dht_req = p2pd_pb.DHTRequest(
             type=p2pd_pb.DHTRequest.GET_PUBLIC_KEY, peer=peer_id.to_bytes()
         )
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         if len(resps) != 1:
             raise ControlFailure(f"should only get one response, resps={resps}")
         try:
@@ -135,10 +298,18 @@ class DHTClient:
         public_key_pb.ParseFromString(public_key_pb_bytes)
         return public_key_pb
 
-    async def get_value(self, key: bytes) -> bytes:
+    async def get_value(self, key: bytes, timeout: Optional[float] = None) -> bytes:
         """GET_VALUE"""
+        return await self._cached(
+            DHTCache.GET_VALUE,
+            key,
+            functools.partial(self._get_value, key, timeout),
+            len,
+        )
+
+    async def _get_value(self, key: bytes, timeout: Optional[float]) -> bytes:
         dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.GET_VALUE, key=key)
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         if len(resps) != 1:
             raise ControlFailure(f"should only get one response, resps={resps}")
         try:
@@ -149,10 +320,12 @@ class DHTClient:
             )
         return value
 
-    async def search_value(self, key: bytes) -> Tuple[bytes, ...]:
+    async def search_value(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> Tuple[bytes, ...]:
         """SEARCH_VALUE"""
         dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.SEARCH_VALUE, key=key)
-        resps = await self._do_dht(dht_req)
+        resps = await self._do_dht(dht_req, timeout)
         try:
             values = tuple(resp.value for resp in resps)
         except AttributeError as e:
@@ -161,26 +334,33 @@ class DHTClient:
             )
         return values
 
-    async def put_value(self, key: bytes, value: bytes) -> None:
+    async def search_value_iter(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> AsyncGenerator[bytes, None]:
+        """SEARCH_VALUE, yielding values as they are found"""
+        dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.SEARCH_VALUE, key=key)
+        async with aclosing(self._do_dht_iter(dht_req, timeout)) as resps:
+            async for dht_resp in resps:
+                yield dht_resp.value
+
+    async def put_value(
+        self, key: bytes, value: bytes, timeout: Optional[float] = None
+    ) -> None:
         """PUT_VALUE"""
         dht_req = p2pd_pb.DHTRequest(
             type=p2pd_pb.DHTRequest.PUT_VALUE, key=key, value=value
         )
         req = p2pd_pb.Request(type=p2pd_pb.Request.DHT, dht=dht_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        try:
+            resp = await self.daemon_connector.request(req, timeout=timeout)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(DHTCache.GET_VALUE, key)
         raise_if_failed(resp)
 
-    async def provide(self, cid: bytes) -> None:
+    async def provide(self, cid: bytes, timeout: Optional[float] = None) -> None:
         """PROVIDE"""
         dht_req = p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.PROVIDE, cid=cid)
         req = p2pd_pb.Request(type=p2pd_pb.Request.DHT, dht=dht_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req, timeout=timeout)
         raise_if_failed(resp)
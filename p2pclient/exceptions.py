@@ -4,3 +4,7 @@ class ControlFailure(Exception):
 
 class DispatchFailure(Exception):
     pass
+
+
+class SlowConsumer(Exception):
+    pass
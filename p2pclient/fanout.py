@@ -0,0 +1,308 @@
+import logging
+from collections import deque
+from enum import Enum, unique
+from types import TracebackType
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Type,
+)
+
+import anyio
+from anyio.abc import TaskGroup
+from async_generator import asynccontextmanager
+
+from .datastructures import PubSubMessage
+from .exceptions import SlowConsumer
+from .pubsub import PubSubClient, Subscription
+
+
+@unique
+class OverflowPolicy(Enum):
+    """What a consumer does with a new message while its queue is full."""
+
+    # wait for room, which holds up every consumer of the topic
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    # drop the consumer, its next `receive` raises `SlowConsumer`
+    DISCONNECT = "disconnect"
+
+
+class ConsumerStats(NamedTuple):
+    name: str
+    topic: str
+    policy: OverflowPolicy
+    queue_depth: int
+    max_queue_depth: int
+    num_received: int
+    num_dropped: int
+    disconnected: bool
+
+
+class Consumer:
+    """
+    One consumer's bounded view of a topic shared through a
+    `TopicSubscriptionManager`. Messages are received in order, minus the ones the
+    overflow policy dropped.
+    """
+
+    topic: str
+    name: str
+    max_queue_size: int
+    policy: OverflowPolicy
+
+    def __init__(
+        self,
+        topic: str,
+        name: str,
+        max_queue_size: int,
+        policy: OverflowPolicy,
+        on_close: Callable[["Consumer"], None],
+    ) -> None:
+        if max_queue_size < 1:
+            raise ValueError(f"max_queue_size should be positive: {max_queue_size}")
+        self.topic = topic
+        self.name = name
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self._on_close = on_close
+        self._queue: Deque[PubSubMessage] = deque()
+        self._readable = anyio.Event()
+        self._writable = anyio.Event()
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self.max_queue_depth = 0
+        self.num_received = 0
+        self.num_dropped = 0
+        self.disconnected = False
+
+    def __repr__(self) -> str:
+        return f"<Consumer name={self.name} topic={self.topic}>"
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> ConsumerStats:
+        return ConsumerStats(
+            name=self.name,
+            topic=self.topic,
+            policy=self.policy,
+            queue_depth=self.queue_depth,
+            max_queue_depth=self.max_queue_depth,
+            num_received=self.num_received,
+            num_dropped=self.num_dropped,
+            disconnected=self.disconnected,
+        )
+
+    async def receive(self) -> PubSubMessage:
+        """
+        Wait for the next message. Raises `anyio.EndOfStream` once the topic's
+        subscription ended and every queued message was received.
+        """
+        while not self._queue:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise anyio.EndOfStream
+            self._readable = anyio.Event()
+            await self._readable.wait()
+        msg = self._queue.popleft()
+        self._writable.set()
+        return msg
+
+    def __aiter__(self) -> "Consumer":
+        return self
+
+    async def __anext__(self) -> PubSubMessage:
+        try:
+            return await self.receive()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        self._close()
+
+    async def __aenter__(self) -> "Consumer":
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        await self.aclose()
+
+    async def _put(self, msg: PubSubMessage) -> None:
+        if self._closed:
+            return
+        if len(self._queue) >= self.max_queue_size:
+            if self.policy is OverflowPolicy.DROP_NEWEST:
+                self.num_dropped += 1
+                return
+            elif self.policy is OverflowPolicy.DROP_OLDEST:
+                self._queue.popleft()
+                self.num_dropped += 1
+            elif self.policy is OverflowPolicy.DISCONNECT:
+                self._disconnect()
+                return
+            else:
+                while len(self._queue) >= self.max_queue_size and not self._closed:
+                    self._writable = anyio.Event()
+                    await self._writable.wait()
+                if self._closed:
+                    return
+        self._queue.append(msg)
+        self.num_received += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._readable.set()
+
+    def _disconnect(self) -> None:
+        self.disconnected = True
+        self.num_dropped += len(self._queue) + 1
+        self._queue.clear()
+        self._close(
+            SlowConsumer(
+                f"consumer {self.name} of topic {self.topic} fell behind by more "
+                f"than {self.max_queue_size} messages"
+            )
+        )
+
+    def _close(self, error: Optional[BaseException] = None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._error = error
+        self._readable.set()
+        self._writable.set()
+        self._on_close(self)
+
+
+class _TopicFeed:
+    def __init__(self, subscription: Subscription) -> None:
+        self.subscription = subscription
+        # in subscription order, which is the order messages are handed out in
+        self.consumers: List[Consumer] = []
+        self.cancel_scope = anyio.CancelScope()
+
+
+class TopicSubscriptionManager:
+    """
+    Shares one daemon subscription per topic between any number of local consumers,
+    each with its own bounded queue and `OverflowPolicy`. The daemon subscription is
+    made for the first consumer of a topic and closed when the last one leaves.
+
+    Consumers can only be added while `run` is active. The last `max_disconnected`
+    consumers dropped by the `DISCONNECT` policy stay in `stats`.
+    """
+
+    pubsub: PubSubClient
+    logger = logging.getLogger("p2pclient.TopicSubscriptionManager")
+
+    def __init__(self, pubsub: PubSubClient, max_disconnected: int = 100) -> None:
+        self.pubsub = pubsub
+        self._feeds: Dict[str, _TopicFeed] = {}
+        # set once the daemon subscription being made for a topic is in `_feeds`
+        self._subscribing: Dict[str, anyio.Event] = {}
+        self._disconnected: Deque[Consumer] = deque(maxlen=max_disconnected)
+        self._task_group: Optional[TaskGroup] = None
+        self._num_consumers = 0
+
+    @property
+    def topics(self) -> List[str]:
+        return list(self._feeds)
+
+    @asynccontextmanager
+    async def run(self) -> AsyncIterator["TopicSubscriptionManager"]:
+        """Forward messages to the consumers while the context is active."""
+        async with anyio.create_task_group() as task_group:
+            self._task_group = task_group
+            try:
+                yield self
+            finally:
+                self._task_group = None
+                for feed in self._feeds.values():
+                    feed.cancel_scope.cancel()
+
+    async def subscribe(
+        self,
+        topic: str,
+        max_queue_size: int = 128,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        name: Optional[str] = None,
+    ) -> Consumer:
+        task_group = self._task_group
+        if task_group is None:
+            raise RuntimeError("TopicSubscriptionManager is not running")
+        self._num_consumers += 1
+        if name is None:
+            name = f"consumer-{self._num_consumers}"
+        consumer = Consumer(topic, name, max_queue_size, policy, self._remove)
+        feed = self._feeds.get(topic)
+        while feed is None:
+            subscribing = self._subscribing.get(topic)
+            if subscribing is None:
+                feed = await self._subscribe_feed(topic, task_group)
+            else:
+                # only the first consumer of a topic waits for the daemon, and only
+                # the consumers of that topic wait for it
+                await subscribing.wait()
+                feed = self._feeds.get(topic)
+        feed.consumers.append(consumer)
+        return consumer
+
+    def stats(self) -> List[ConsumerStats]:
+        """The stats of the consumers, followed by the ones disconnected."""
+        return [
+            consumer.stats()
+            for feed in self._feeds.values()
+            for consumer in feed.consumers
+        ] + [consumer.stats() for consumer in self._disconnected]
+
+    async def _subscribe_feed(self, topic: str, task_group: TaskGroup) -> _TopicFeed:
+        subscribing = self._subscribing[topic] = anyio.Event()
+        try:
+            feed = _TopicFeed(await self.pubsub.subscribe(topic))
+            self._feeds[topic] = feed
+            task_group.start_soon(self._forward, topic, feed)
+        finally:
+            del self._subscribing[topic]
+            subscribing.set()
+        return feed
+
+    def _remove(self, consumer: Consumer) -> None:
+        if consumer.disconnected:
+            self._disconnected.append(consumer)
+        feed = self._feeds.get(consumer.topic)
+        if feed is None or consumer not in feed.consumers:
+            return
+        feed.consumers.remove(consumer)
+        if not feed.consumers:
+            # a consumer arriving from now on gets a fresh daemon subscription
+            del self._feeds[consumer.topic]
+            feed.cancel_scope.cancel()
+
+    async def _forward(self, topic: str, feed: _TopicFeed) -> None:
+        error: Optional[BaseException] = None
+        try:
+            with feed.cancel_scope:
+                async for msg in feed.subscription:
+                    for consumer in tuple(feed.consumers):
+                        await consumer._put(msg)
+        except Exception as e:
+            self.logger.debug("subscription to %s failed: %s", topic, e)
+            error = e
+        finally:
+            if self._feeds.get(topic) is feed:
+                del self._feeds[topic]
+            with anyio.CancelScope(shield=True):
+                await feed.subscription.aclose()
+            for consumer in tuple(feed.consumers):
+                consumer._close(error)
@@ -1,10 +1,12 @@
 import hashlib
-from typing import Union
+from typing import Optional, Union
 
 import base58
 import multihash
+from google.protobuf.message import DecodeError
 
 from p2pclient.libp2p_stubs.crypto.keys import PublicKey
+from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
 
 # NOTE: On inlining...
 # See: https://github.com/libp2p/specs/issues/138
@@ -55,6 +57,22 @@ class ID:
             self._b58_str = base58.b58encode(self._bytes).decode()
         return self._b58_str
 
+    def extract_public_key(self) -> Optional[crypto_pb.PublicKey]:
+        """
+        Return the public key inlined in an identity-multihash peer ID, or `None` when
+        the peer ID only holds a hash of the key.
+        """
+        try:
+            mh = multihash.decode(self._bytes)
+        except ValueError:
+            return None
+        if mh.func != IDENTITY_MULTIHASH_CODE:
+            return None
+        try:
+            return PublicKey.deserialize_from_protobuf(mh.digest)
+        except DecodeError:
+            return None
+
     def __repr__(self) -> str:
         return f"<libp2p.peer.id.ID ({self!s})>"
 
@@ -0,0 +1,162 @@
+import logging
+from typing import AsyncIterator, Dict, FrozenSet, List, NamedTuple, Set
+
+import anyio
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from async_generator import asynccontextmanager
+
+from p2pclient.libp2p_stubs.peer.id import ID
+
+from .pubsub import PubSubClient
+
+_NO_PEERS: FrozenSet[ID] = frozenset()
+
+
+class PeerEvent(NamedTuple):
+    topic: str
+    peer_id: ID
+    joined: bool
+
+
+class TopicPeerTracker:
+    """
+    In-memory view of the daemon's topics and of the peers of each topic, for reads
+    that do not wait for the daemon.
+
+    The topics of `get_topics` and the ones passed to `track` are polled in the
+    background while `run` is active. Polls are `min_interval` seconds apart after a
+    change, and the interval doubles up to `max_interval` while nothing changes.
+    Changes are also sent as `PeerEvent`s to the streams opened with `events`.
+    """
+
+    pubsub: PubSubClient
+    min_interval: float
+    max_interval: float
+    logger = logging.getLogger("p2pclient.TopicPeerTracker")
+
+    def __init__(
+        self,
+        pubsub: PubSubClient,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        max_concurrent_polls: int = 8,
+    ) -> None:
+        self.pubsub = pubsub
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._limiter = anyio.CapacityLimiter(max_concurrent_polls)
+        self._tracked: Set[str] = set()
+        self._topics: FrozenSet[str] = frozenset()
+        # replaced rather than updated, so a snapshot handed out never changes
+        self._peers: Dict[str, FrozenSet[ID]] = {}
+        self._event_streams: List[MemoryObjectSendStream[PeerEvent]] = []
+        self._wakeup = anyio.Event()
+        self.num_polls = 0
+        self.num_dropped_events = 0
+
+    @property
+    def topics(self) -> FrozenSet[str]:
+        """The topics the daemon is subscribed to, as of the last poll."""
+        return self._topics
+
+    def peers(self, topic: str) -> FrozenSet[ID]:
+        """The peers of `topic` as of the last poll."""
+        return self._peers.get(topic, _NO_PEERS)
+
+    def has_peers(self, topic: str) -> bool:
+        return bool(self._peers.get(topic))
+
+    def track(self, topic: str) -> None:
+        """Poll the peers of `topic` even if the daemon is not subscribed to it."""
+        if topic not in self._tracked:
+            self._tracked.add(topic)
+            self.refresh_soon()
+
+    def untrack(self, topic: str) -> None:
+        self._tracked.discard(topic)
+
+    def refresh_soon(self) -> None:
+        """Poll now instead of waiting for the interval to pass."""
+        self._wakeup.set()
+
+    @asynccontextmanager
+    async def run(self) -> AsyncIterator["TopicPeerTracker"]:
+        """Poll the daemon while the context is active, starting with one poll."""
+        await self.poll()
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(self._poll_forever)
+            try:
+                yield self
+            finally:
+                task_group.cancel_scope.cancel()
+
+    @asynccontextmanager
+    async def events(
+        self, max_queued: int = 128
+    ) -> AsyncIterator[MemoryObjectReceiveStream[PeerEvent]]:
+        """
+        Yield a stream of the joins and leaves seen from now on. Events that do not
+        fit in a stream with `max_queued` of them queued are dropped, `peers` still
+        has the current state.
+        """
+        send_stream: MemoryObjectSendStream[PeerEvent]
+        receive_stream: MemoryObjectReceiveStream[PeerEvent]
+        send_stream, receive_stream = anyio.create_memory_object_stream(max_queued)
+        self._event_streams.append(send_stream)
+        try:
+            with receive_stream:
+                yield receive_stream
+        finally:
+            self._event_streams.remove(send_stream)
+            send_stream.close()
+
+    async def poll(self) -> bool:
+        """Poll the daemon once, return whether anything changed."""
+        topics = frozenset(await self.pubsub.get_topics())
+        polled = topics | self._tracked
+        peers: Dict[str, FrozenSet[ID]] = {}
+
+        async def poll_topic(topic: str) -> None:
+            async with self._limiter:
+                peers[topic] = frozenset(await self.pubsub.list_peers(topic))
+
+        async with anyio.create_task_group() as task_group:
+            for topic in polled:
+                task_group.start_soon(poll_topic, topic)
+        self.num_polls += 1
+
+        changed = topics != self._topics
+        old_peers, self._peers, self._topics = self._peers, peers, topics
+        for topic in old_peers.keys() | peers.keys():
+            old, new = old_peers.get(topic, _NO_PEERS), peers.get(topic, _NO_PEERS)
+            if old == new:
+                continue
+            changed = True
+            for peer_id in new - old:
+                self._emit(PeerEvent(topic, peer_id, True))
+            for peer_id in old - new:
+                self._emit(PeerEvent(topic, peer_id, False))
+        return changed
+
+    def _emit(self, event: PeerEvent) -> None:
+        for send_stream in self._event_streams:
+            try:
+                send_stream.send_nowait(event)
+            except anyio.WouldBlock:
+                self.num_dropped_events += 1
+
+    async def _poll_forever(self) -> None:
+        while True:
+            with anyio.move_on_after(self.interval):
+                await self._wakeup.wait()
+            self._wakeup = anyio.Event()
+            try:
+                changed = await self.poll()
+            except Exception as e:
+                self.logger.debug("polling topic peers failed: %s", e)
+                changed = False
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(2 * self.interval, self.max_interval)
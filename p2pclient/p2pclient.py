@@ -1,4 +1,4 @@
-from typing import AsyncIterator, Iterable, Optional, Sequence, Tuple
+from typing import AsyncIterator, Dict, Iterable, Mapping, Optional, Sequence, Tuple
 
 from anyio.abc import ByteStream
 from async_generator import asynccontextmanager
@@ -7,17 +7,21 @@ from multiaddr import Multiaddr
 from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
 from p2pclient.libp2p_stubs.peer.id import ID
 
+from .admission import HandlerStats
+from .cache import DHTCache
 from .connmgr import ConnectionManagerClient
 from .control import ControlClient, DaemonConnector, StreamHandler
 from .datastructures import PeerInfo, StreamInfo
+from .dedup import DuplicateFilter
 from .dht import DHTClient
-from .pubsub import PubSubClient
+from .pubsub import PubSubClient, Subscription
 
 # Type alias for compatibility
 SocketStream = ByteStream
 
 
 class Client:
+    daemon_connector: DaemonConnector
     control: ControlClient
     connmgr: ConnectionManagerClient
     dht: DHTClient
@@ -27,13 +31,17 @@ class Client:
         self,
         control_maddr: Optional[Multiaddr] = None,
         listen_maddr: Optional[Multiaddr] = None,
+        daemon_connector: Optional[DaemonConnector] = None,
+        dht_cache: Optional[DHTCache] = None,
     ) -> None:
-        daemon_connector = DaemonConnector(control_maddr=control_maddr)
+        if daemon_connector is None:
+            daemon_connector = DaemonConnector(control_maddr=control_maddr)
+        self.daemon_connector = daemon_connector
         self.control = ControlClient(
             daemon_connector=daemon_connector, listen_maddr=listen_maddr
         )
         self.connmgr = ConnectionManagerClient(daemon_connector=daemon_connector)
-        self.dht = DHTClient(daemon_connector=daemon_connector)
+        self.dht = DHTClient(daemon_connector=daemon_connector, cache=dht_cache)
         self.pubsub = PubSubClient(daemon_connector=daemon_connector)
 
     @asynccontextmanager
@@ -41,11 +49,19 @@ class Client:
         async with self.control.listen():
             yield self
 
+    async def aclose(self) -> None:
+        await self.daemon_connector.aclose()
+
     async def identify(self) -> Tuple[ID, Tuple[Multiaddr, ...]]:
         return await self.control.identify()
 
-    async def connect(self, peer_id: ID, maddrs: Iterable[Multiaddr]) -> None:
-        await self.control.connect(peer_id=peer_id, maddrs=maddrs)
+    async def connect(
+        self,
+        peer_id: ID,
+        maddrs: Iterable[Multiaddr],
+        timeout: Optional[float] = None,
+    ) -> None:
+        await self.control.connect(peer_id=peer_id, maddrs=maddrs, timeout=timeout)
 
     async def list_peers(self) -> Tuple[PeerInfo, ...]:
         return await self.control.list_peers()
@@ -54,13 +70,43 @@ class Client:
         await self.control.disconnect(peer_id=peer_id)
 
     async def stream_open(
-        self, peer_id: ID, protocols: Sequence[str]
+        self,
+        peer_id: ID,
+        protocols: Sequence[str],
+        timeout: Optional[float] = None,
     ) -> Tuple[StreamInfo, SocketStream]:
-        return await self.control.stream_open(peer_id=peer_id, protocols=protocols)
+        return await self.control.stream_open(
+            peer_id=peer_id, protocols=protocols, timeout=timeout
+        )
 
     async def stream_handler(self, proto: str, handler_cb: StreamHandler) -> None:
         await self.control.stream_handler(proto=proto, handler_cb=handler_cb)
 
+    async def stream_handlers(self, handlers: Mapping[str, StreamHandler]) -> None:
+        await self.control.stream_handlers(handlers=handlers)
+
+    def limit_handlers(
+        self,
+        proto: str,
+        max_concurrent: int,
+        max_waiting: int = 0,
+        wait_timeout: Optional[float] = None,
+    ) -> None:
+        self.control.limit_handlers(
+            proto=proto,
+            max_concurrent=max_concurrent,
+            max_waiting=max_waiting,
+            wait_timeout=wait_timeout,
+        )
+
+    def handler_stats(self) -> Dict[str, HandlerStats]:
+        return self.control.handler_stats()
+
+    def accept(
+        self, proto: str, max_pending: int = 16
+    ) -> AsyncIterator[Tuple[StreamInfo, ByteStream]]:
+        return self.control.accept(proto=proto, max_pending=max_pending)
+
     async def connmgr_tag_peer(self, peer_id: ID, tag: str, weight: int) -> None:
         await self.connmgr.tag_peer(peer_id=peer_id, tag=tag, weight=weight)
 
@@ -70,38 +116,74 @@ class Client:
     async def connmgr_trim(self) -> None:
         await self.connmgr.trim()
 
-    async def dht_find_peer(self, peer_id: ID) -> PeerInfo:
-        return await self.dht.find_peer(peer_id=peer_id)
+    async def dht_find_peer(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> PeerInfo:
+        return await self.dht.find_peer(peer_id=peer_id, timeout=timeout)
 
     async def dht_find_peers_connected_to_peer(
-        self, peer_id: ID
+        self, peer_id: ID, timeout: Optional[float] = None
     ) -> Tuple[PeerInfo, ...]:
-        return await self.dht.find_peers_connected_to_peer(peer_id=peer_id)
+        return await self.dht.find_peers_connected_to_peer(
+            peer_id=peer_id, timeout=timeout
+        )
+
+    def dht_find_peers_connected_to_peer_iter(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> AsyncIterator[PeerInfo]:
+        return self.dht.find_peers_connected_to_peer_iter(
+            peer_id=peer_id, timeout=timeout
+        )
 
     async def dht_find_providers(
-        self, content_id_bytes: bytes, count: int
+        self, content_id_bytes: bytes, count: int, timeout: Optional[float] = None
     ) -> Tuple[PeerInfo, ...]:
         return await self.dht.find_providers(
-            content_id_bytes=content_id_bytes, count=count
+            content_id_bytes=content_id_bytes, count=count, timeout=timeout
         )
 
-    async def dht_get_closest_peers(self, key: bytes) -> Tuple[ID, ...]:
-        return await self.dht.get_closest_peers(key=key)
+    def dht_find_providers_iter(
+        self, content_id_bytes: bytes, count: int, timeout: Optional[float] = None
+    ) -> AsyncIterator[PeerInfo]:
+        return self.dht.find_providers_iter(
+            content_id_bytes=content_id_bytes, count=count, timeout=timeout
+        )
+
+    async def dht_get_closest_peers(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> Tuple[ID, ...]:
+        return await self.dht.get_closest_peers(key=key, timeout=timeout)
+
+    def dht_get_closest_peers_iter(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> AsyncIterator[ID]:
+        return self.dht.get_closest_peers_iter(key=key, timeout=timeout)
 
-    async def dht_get_public_key(self, peer_id: ID) -> crypto_pb.PublicKey:
-        return await self.dht.get_public_key(peer_id=peer_id)
+    async def dht_get_public_key(
+        self, peer_id: ID, timeout: Optional[float] = None
+    ) -> crypto_pb.PublicKey:
+        return await self.dht.get_public_key(peer_id=peer_id, timeout=timeout)
 
-    async def dht_get_value(self, key: bytes) -> bytes:
-        return await self.dht.get_value(key=key)
+    async def dht_get_value(self, key: bytes, timeout: Optional[float] = None) -> bytes:
+        return await self.dht.get_value(key=key, timeout=timeout)
 
-    async def dht_search_value(self, key: bytes) -> Tuple[bytes, ...]:
-        return await self.dht.search_value(key=key)
+    async def dht_search_value(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> Tuple[bytes, ...]:
+        return await self.dht.search_value(key=key, timeout=timeout)
 
-    async def dht_put_value(self, key: bytes, value: bytes) -> None:
-        await self.dht.put_value(key=key, value=value)
+    def dht_search_value_iter(
+        self, key: bytes, timeout: Optional[float] = None
+    ) -> AsyncIterator[bytes]:
+        return self.dht.search_value_iter(key=key, timeout=timeout)
+
+    async def dht_put_value(
+        self, key: bytes, value: bytes, timeout: Optional[float] = None
+    ) -> None:
+        await self.dht.put_value(key=key, value=value, timeout=timeout)
 
-    async def dht_provide(self, cid: bytes) -> None:
-        await self.dht.provide(cid=cid)
+    async def dht_provide(self, cid: bytes, timeout: Optional[float] = None) -> None:
+        await self.dht.provide(cid=cid, timeout=timeout)
 
     async def pubsub_get_topics(self) -> Tuple[str, ...]:
         return await self.pubsub.get_topics()
@@ -112,5 +194,7 @@ class Client:
     async def pubsub_publish(self, topic: str, data: bytes) -> None:
         return await self.pubsub.publish(topic=topic, data=data)
 
-    async def pubsub_subscribe(self, topic: str) -> ByteStream:
-        return await self.pubsub.subscribe(topic=topic)
+    async def pubsub_subscribe(
+        self, topic: str, dedup: Optional[DuplicateFilter] = None
+    ) -> Subscription:
+        return await self.pubsub.subscribe(topic=topic, dedup=dedup)
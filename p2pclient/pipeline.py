@@ -0,0 +1,266 @@
+import logging
+import math
+from collections import deque
+from typing import Callable, Deque, List, Optional, Sequence
+
+import anyio
+from anyio.abc import ByteStream
+
+from .exceptions import ControlFailure
+from .pb import p2pd_pb2 as p2pd_pb
+from .serialization import FramedReader
+from .utils import DEFAULT_READ_TIMEOUT, read_pbmsg_safe, write_pbmsgs
+
+# DHT queries answered with a BEGIN/VALUE.../END stream instead of a single response
+_STREAMING_DHT_TYPES = frozenset(
+    (
+        p2pd_pb.DHTRequest.FIND_PEERS_CONNECTED_TO_PEER,
+        p2pd_pb.DHTRequest.FIND_PROVIDERS,
+        p2pd_pb.DHTRequest.GET_CLOSEST_PEERS,
+        p2pd_pb.DHTRequest.SEARCH_VALUE,
+    )
+)
+
+
+def is_pipelinable(req: p2pd_pb.Request) -> bool:
+    """
+    Whether `req` is answered by exactly one `Response` and leaves the connection
+    ready for the next request, which is what pipelining relies on.
+    """
+    if req.type == p2pd_pb.Request.STREAM_OPEN:
+        return False
+    if req.type == p2pd_pb.Request.PUBSUB:
+        return req.pubsub.type != p2pd_pb.PSRequest.SUBSCRIBE
+    if req.type == p2pd_pb.Request.DHT:
+        return req.dht.type not in _STREAMING_DHT_TYPES
+    return True
+
+
+def is_quick(req: p2pd_pb.Request) -> bool:
+    """
+    Whether the daemon answers `req` from its local state. Dials and DHT operations
+    can take long, and on a pipeline they would hold up every request behind them.
+    """
+    if req.type in (p2pd_pb.Request.IDENTIFY, p2pd_pb.Request.LIST_PEERS):
+        return True
+    if req.type == p2pd_pb.Request.CONNMANAGER:
+        return req.connManager.type in (
+            p2pd_pb.ConnManagerRequest.TAG_PEER,
+            p2pd_pb.ConnManagerRequest.UNTAG_PEER,
+        )
+    if req.type == p2pd_pb.Request.PUBSUB:
+        return req.pubsub.type in (
+            p2pd_pb.PSRequest.PUBLISH,
+            p2pd_pb.PSRequest.GET_TOPICS,
+            p2pd_pb.PSRequest.LIST_PEERS,
+        )
+    return False
+
+
+class PendingResponse:
+    """The not yet received `Response` to a request written on a pipeline."""
+
+    _response: Optional[p2pd_pb.Response] = None
+    _error: Optional[BaseException] = None
+    # the deadline of the call waiting for the response
+    deadline: float = math.inf
+
+    def __init__(self) -> None:
+        self._event = anyio.Event()
+        self._callbacks: List[Callable[["PendingResponse"], None]] = []
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def add_done_callback(self, callback: Callable[["PendingResponse"], None]) -> None:
+        """Call `callback` once the response or an error is in, right away if it is."""
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self) -> p2pd_pb.Response:
+        """The response of a request that is `done`, raising its error if it failed."""
+        if not self.done():
+            raise anyio.WouldBlock
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+    async def wait(self) -> p2pd_pb.Response:
+        await self._event.wait()
+        return self.result()
+
+    def _set_response(self, response: p2pd_pb.Response) -> None:
+        self._response = response
+        self._set_done()
+
+    def _set_error(self, error: BaseException) -> None:
+        self._error = error
+        self._set_done()
+
+    def _set_done(self) -> None:
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class PipelinedConnection:
+    """
+    Writes requests back-to-back on one control connection and matches the in-order
+    responses to their callers. At most `max_in_flight` requests wait for a response
+    at any time; `submit` blocks once the window is full.
+
+    `read_responses` has to run in a background task for responses to be delivered.
+    """
+
+    stream: ByteStream
+    max_in_flight: int
+    logger = logging.getLogger("p2pclient.PipelinedConnection")
+
+    def __init__(self, stream: ByteStream, max_in_flight: int = 64) -> None:
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight should be positive: {max_in_flight}")
+        self.stream = stream
+        self.max_in_flight = max_in_flight
+        self._reader = (
+            stream if isinstance(stream, FramedReader) else FramedReader(stream)
+        )
+        self._window = anyio.Semaphore(max_in_flight)
+        self._send_lock = anyio.Lock()
+        self._pending: Deque[PendingResponse] = deque()
+        self._has_pending = anyio.Event()
+        self._error: Optional[BaseException] = None
+        self._closed = False
+
+    @property
+    def num_in_flight(self) -> int:
+        return len(self._pending)
+
+    @property
+    def usable(self) -> bool:
+        """Whether requests can still be submitted, i.e. it neither failed nor closed."""
+        return self._error is None and not self._closed
+
+    async def submit(
+        self, req: p2pd_pb.Request, deadline: float = math.inf
+    ) -> PendingResponse:
+        """Write `req` without waiting for its response."""
+        (pending,) = await self.submit_many((req,), deadline=deadline)
+        return pending
+
+    async def submit_many(
+        self,
+        reqs: Sequence[p2pd_pb.Request],
+        pendings: Optional[Sequence[PendingResponse]] = None,
+        deadline: float = math.inf,
+    ) -> List[PendingResponse]:
+        """
+        Write `reqs` in as few sends as the in-flight window allows. The responses are
+        delivered to `pendings` if given, or to new `PendingResponse`s otherwise.
+        Responses are waited for until the latest `deadline` of the requests pending.
+        """
+        for req in reqs:
+            if not is_pipelinable(req):
+                raise ValueError(f"request can not be pipelined: type={req.type}")
+        if pendings is None:
+            pendings = [PendingResponse() for _ in reqs]
+        elif len(pendings) != len(reqs):
+            raise ValueError("there should be exactly one pending response per request")
+        for pending in pendings:
+            pending.deadline = deadline
+        for start in range(0, len(reqs), self.max_in_flight):
+            end = start + self.max_in_flight
+            await self._submit_batch(reqs[start:end], pendings[start:end])
+        return list(pendings)
+
+    async def _submit_batch(
+        self, reqs: Sequence[p2pd_pb.Request], pendings: Sequence[PendingResponse]
+    ) -> None:
+        num_acquired = 0
+        try:
+            for _ in reqs:
+                await self._window.acquire()
+                num_acquired += 1
+            async with self._send_lock:
+                self._raise_if_unusable()
+                self._pending.extend(pendings)
+                # the window slots are given back when the responses arrive
+                num_acquired = 0
+                self._has_pending.set()
+                try:
+                    await write_pbmsgs(self.stream, reqs)
+                except BaseException as e:
+                    # a partially written batch leaves the connection out of sync
+                    self._fail(e)
+                    raise
+        finally:
+            for _ in range(num_acquired):
+                self._window.release()
+
+    async def request(
+        self, req: p2pd_pb.Request, deadline: float = math.inf
+    ) -> p2pd_pb.Response:
+        pending = await self.submit(req, deadline=deadline)
+        return await pending.wait()
+
+    async def read_responses(self) -> None:
+        try:
+            while not self._closed:
+                if not self._pending:
+                    self._has_pending = anyio.Event()
+                    await self._has_pending.wait()
+                    continue
+                resp = p2pd_pb.Response()
+                await read_pbmsg_safe(self._reader, resp, timeout=self._read_timeout())
+                self._pending.popleft()._set_response(resp)
+                self._window.release()
+        except Exception as e:
+            if not self._closed:
+                self.logger.debug("PipelinedConnection %s failed: %s", self, e)
+                self._fail(e)
+
+    async def drain(self) -> None:
+        """Wait until every submitted request got its response or failed."""
+        while self._pending and self._error is None:
+            await self._pending[-1]._event.wait()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._has_pending.set()
+        self._fail_pending(ControlFailure("pipelined connection is closed"))
+        with anyio.CancelScope(shield=True):
+            await self.stream.aclose()
+
+    def _read_timeout(self) -> float:
+        """
+        How long the next response may take before the connection is considered
+        stalled: the default stall timeout, or longer while a request waiting has a
+        later deadline. A caller whose deadline passes gives up on its own, and its
+        response is still read and dropped when it arrives.
+        """
+        now = anyio.current_time()
+        timeout = DEFAULT_READ_TIMEOUT
+        for pending in self._pending:
+            if pending.deadline != math.inf:
+                timeout = max(timeout, pending.deadline - now)
+        return timeout
+
+    def _raise_if_unusable(self) -> None:
+        if self._error is not None:
+            raise ControlFailure(f"pipelined connection failed: {self._error!r}")
+        if self._closed:
+            raise anyio.ClosedResourceError
+
+    def _fail(self, error: BaseException) -> None:
+        if self._error is None:
+            self._error = error
+        self._fail_pending(error)
+
+    def _fail_pending(self, error: BaseException) -> None:
+        while self._pending:
+            self._pending.popleft()._set_error(error)
+            self._window.release()
@@ -0,0 +1,141 @@
+import socket
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Tuple
+
+import anyio
+from anyio import TypedAttributeLookupError
+from anyio.abc import ByteStream, SocketAttribute
+
+from .serialization import FramedReader
+
+# Non-blocking peek used by the health check. `MSG_DONTWAIT` is missing on Windows,
+# where the sockets handed out by anyio are non-blocking anyway.
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def is_connection_alive(stream: ByteStream) -> bool:
+    """
+    Cheap liveness probe for an idle control connection.
+
+    An idle connection must have nothing to read: EOF means the daemon hung up and
+    unsolicited bytes mean the protocol is out of sync, so both make it unusable.
+    Streams that do not expose their raw socket are assumed to be alive.
+    """
+    if isinstance(stream, FramedReader) and stream.num_buffered:
+        return False
+    try:
+        sock = stream.extra(SocketAttribute.raw_socket)
+    except TypedAttributeLookupError:
+        return True
+    if not isinstance(sock, socket.socket):
+        # asyncio only exposes a restricted `TransportSocket` wrapper
+        with socket.fromfd(sock.fileno(), sock.family, sock.type) as dup:
+            return _peek_is_empty(dup)
+    return _peek_is_empty(sock)
+
+
+def _peek_is_empty(sock: socket.socket) -> bool:
+    try:
+        sock.recv(1, _PEEK_FLAGS)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+    return False
+
+
+async def _close_quietly(stream: ByteStream) -> None:
+    with anyio.CancelScope(shield=True):
+        try:
+            await stream.aclose()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Pool of idle daemon control connections.
+
+    `max_size` bounds the number of idle connections kept around; connections in use
+    are not counted, so `acquire` never blocks on the pool. Idle connections older than
+    `idle_timeout` seconds are closed, except for the `min_size` most recently used.
+    """
+
+    min_size: int
+    max_size: int
+    idle_timeout: float
+    health_check: bool
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[ByteStream]],
+        min_size: int = 0,
+        max_size: int = 8,
+        idle_timeout: float = 60.0,
+        health_check: bool = True,
+    ) -> None:
+        if max_size < 0 or min_size < 0:
+            raise ValueError("pool sizes must not be negative")
+        if min_size > max_size:
+            raise ValueError(
+                f"min_size={min_size} should not be larger than max_size={max_size}"
+            )
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        # (stream, released_at) pairs, most recently released on the right
+        self._idle: Deque[Tuple[ByteStream, float]] = deque()
+        self._closed = False
+        self.num_created = 0
+        self.num_reused = 0
+        self.num_discarded = 0
+
+    @property
+    def num_idle(self) -> int:
+        return len(self._idle)
+
+    async def acquire(self) -> ByteStream:
+        if self._closed:
+            raise anyio.ClosedResourceError
+        now = time.monotonic()
+        while self._idle:
+            stream, released_at = self._idle.pop()
+            if self._is_reusable(stream, released_at, now):
+                self.num_reused += 1
+                return stream
+            self.num_discarded += 1
+            await _close_quietly(stream)
+        stream = await self._connect()
+        self.num_created += 1
+        return stream
+
+    async def release(self, stream: ByteStream, reusable: bool = True) -> None:
+        if self._closed or not reusable or len(self._idle) >= self.max_size:
+            if not reusable:
+                self.num_discarded += 1
+            await _close_quietly(stream)
+            return
+        self._idle.append((stream, time.monotonic()))
+        await self._prune_expired()
+
+    async def aclose(self) -> None:
+        self._closed = True
+        while self._idle:
+            stream, _ = self._idle.popleft()
+            await _close_quietly(stream)
+
+    def _is_reusable(self, stream: ByteStream, released_at: float, now: float) -> bool:
+        expired = now - released_at > self.idle_timeout
+        if expired and len(self._idle) >= self.min_size:
+            return False
+        return not self.health_check or is_connection_alive(stream)
+
+    async def _prune_expired(self) -> None:
+        deadline = time.monotonic() - self.idle_timeout
+        while len(self._idle) > self.min_size and self._idle[0][1] < deadline:
+            stream, _ = self._idle.popleft()
+            self.num_discarded += 1
+            await _close_quietly(stream)
@@ -1,12 +1,338 @@
-from typing import Tuple
+from collections import deque
+from types import TracebackType
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple, Type
 
-from anyio.abc import ByteStream
+import anyio
+from anyio.abc import ByteStream, TaskGroup
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from async_generator import asynccontextmanager
 
 from p2pclient.libp2p_stubs.peer.id import ID
 
 from .control import DaemonConnector
+from .datastructures import PubSubMessage
+from .dedup import DuplicateFilter
+from .exceptions import ControlFailure
 from .pb import p2pd_pb2 as p2pd_pb
-from .utils import raise_if_failed, read_pbmsg_safe, write_pbmsg
+from .pipeline import PendingResponse, PipelinedConnection
+from .serialization import FramedReader
+from .utils import decode_pbmsg, raise_if_failed, read_pbmsg_safe, write_pbmsg
+
+
+class Subscription:
+    """
+    Messages received on a topic, decoded as they are read from the connection that
+    made the PUBSUB SUBSCRIBE request. Iterating stops when the daemon closes the
+    connection; closing the subscription unsubscribes from the topic.
+
+    The connection is read through one buffer, so a single socket read can carry
+    several messages, which `receive_buffered` hands out without waiting. With a
+    `dedup` filter, messages it has seen before are skipped.
+    """
+
+    topic: str
+    stream: ByteStream
+    dedup: Optional[DuplicateFilter]
+
+    def __init__(
+        self,
+        topic: str,
+        stream: ByteStream,
+        dedup: Optional[DuplicateFilter] = None,
+    ) -> None:
+        self.topic = topic
+        self.stream = stream
+        self.dedup = dedup
+        self._reader = (
+            stream if isinstance(stream, FramedReader) else FramedReader(stream)
+        )
+
+    def __repr__(self) -> str:
+        return f"<Subscription topic={self.topic}>"
+
+    async def receive(self) -> PubSubMessage:
+        """Wait for the next message. Raises `anyio.EndOfStream` once unsubscribed."""
+        while True:
+            try:
+                msg_bytes = await self._reader.read_frame()
+            except anyio.IncompleteRead:
+                raise anyio.EndOfStream
+            msg = self._decode(msg_bytes)
+            if self.dedup is None or not self.dedup.is_duplicate(msg):
+                return msg
+
+    async def receive_frame(self) -> bytes:
+        """
+        Wait for the next message and return it undecoded, a marshaled `PSMessage`.
+        The `dedup` filter is not applied.
+        """
+        try:
+            return await self._reader.read_frame()
+        except anyio.IncompleteRead:
+            raise anyio.EndOfStream
+
+    def receive_buffered(self) -> List[PubSubMessage]:
+        """Decode the messages that are already buffered, without any I/O."""
+        msgs: List[PubSubMessage] = []
+        while True:
+            msg_bytes = self._reader.read_buffered_frame()
+            if msg_bytes is None:
+                return msgs
+            msg = self._decode(msg_bytes)
+            if self.dedup is None or not self.dedup.is_duplicate(msg):
+                msgs.append(msg)
+
+    @staticmethod
+    def _decode(msg_bytes: bytes) -> PubSubMessage:
+        pb_msg = p2pd_pb.PSMessage()
+        decode_pbmsg(msg_bytes, pb_msg)
+        return PubSubMessage.from_pb(pb_msg)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> PubSubMessage:
+        try:
+            return await self.receive()
+        except (anyio.EndOfStream, anyio.ClosedResourceError):
+            raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+    async def __aenter__(self) -> "Subscription":
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        with anyio.CancelScope(shield=True):
+            await self.aclose()
+
+
+class MultiTopicSubscription:
+    """
+    Messages of any number of topics, received as `(topic, message)` pairs through
+    one iterator, obtained from `PubSubClient.subscribe_many`. Topics can be added
+    and removed while receiving.
+
+    Every topic still has its own daemon connection, but reading one only hands the
+    raw chunks over to a shared queue. Frames are decoded by the receiving task, all
+    the messages of a chunk at once, so a message costs a decode rather than a task
+    switch. Topics the daemon stops sending on are dropped.
+    """
+
+    pubsub: "PubSubClient"
+    dedup: Optional[DuplicateFilter]
+
+    def __init__(
+        self,
+        pubsub: "PubSubClient",
+        task_group: TaskGroup,
+        dedup: Optional[DuplicateFilter] = None,
+        max_queued_chunks: int = 64,
+    ) -> None:
+        self.pubsub = pubsub
+        self.dedup = dedup
+        self._task_group = task_group
+        self._subscriptions: Dict[str, Subscription] = {}
+        self._cancel_scopes: Dict[str, anyio.CancelScope] = {}
+        self._chunk_send: MemoryObjectSendStream[Tuple[Subscription, bytes]]
+        self._chunk_receive: MemoryObjectReceiveStream[Tuple[Subscription, bytes]]
+        self._chunk_send, self._chunk_receive = anyio.create_memory_object_stream(
+            max_queued_chunks
+        )
+        self._decoded: Deque[Tuple[str, PubSubMessage]] = deque()
+
+    def __repr__(self) -> str:
+        return f"<MultiTopicSubscription topics={len(self._subscriptions)}>"
+
+    @property
+    def topics(self) -> List[str]:
+        return list(self._subscriptions)
+
+    async def add_topic(self, topic: str) -> None:
+        """Subscribe to `topic`, if not subscribed yet."""
+        if topic in self._subscriptions:
+            return
+        subscription = await self.pubsub.subscribe(topic, dedup=self.dedup)
+        if topic in self._subscriptions:
+            # added by another task in the meantime
+            with anyio.CancelScope(shield=True):
+                await subscription.aclose()
+            return
+        self._subscriptions[topic] = subscription
+        self._cancel_scopes[topic] = anyio.CancelScope()
+        # messages that arrived along with the response
+        self._decode_buffered(subscription)
+        self._task_group.start_soon(
+            self._read_chunks, subscription, self._cancel_scopes[topic]
+        )
+
+    async def remove_topic(self, topic: str) -> None:
+        """Unsubscribe from `topic`, dropping its messages not received yet."""
+        subscription = self._subscriptions.pop(topic, None)
+        if subscription is None:
+            return
+        self._cancel_scopes.pop(topic).cancel()
+        self._decoded = deque(item for item in self._decoded if item[0] != topic)
+        with anyio.CancelScope(shield=True):
+            await subscription.aclose()
+
+    async def receive(self) -> Tuple[str, PubSubMessage]:
+        """
+        Wait for the next message of any topic. Raises `anyio.EndOfStream` once the
+        subscription is closed.
+        """
+        while not self._decoded:
+            subscription, chunk = await self._chunk_receive.receive()
+            if self._subscriptions.get(subscription.topic) is not subscription:
+                # chunk of a removed topic
+                continue
+            if not chunk:
+                await self.remove_topic(subscription.topic)
+                continue
+            subscription._reader.feed(chunk)
+            self._decode_buffered(subscription)
+        return self._decoded.popleft()
+
+    def __aiter__(self) -> "MultiTopicSubscription":
+        return self
+
+    async def __anext__(self) -> Tuple[str, PubSubMessage]:
+        try:
+            return await self.receive()
+        except (anyio.EndOfStream, anyio.ClosedResourceError):
+            raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        """Unsubscribe from every topic."""
+        for topic in self.topics:
+            await self.remove_topic(topic)
+        self._chunk_send.close()
+        self._chunk_receive.close()
+
+    def _decode_buffered(self, subscription: Subscription) -> None:
+        topic = subscription.topic
+        self._decoded.extend((topic, msg) for msg in subscription.receive_buffered())
+
+    async def _read_chunks(
+        self, subscription: Subscription, cancel_scope: anyio.CancelScope
+    ) -> None:
+        reader = subscription._reader
+        with cancel_scope:
+            try:
+                while True:
+                    chunk = await reader.receive_stream.receive(reader.chunk_size)
+                    await self._chunk_send.send((subscription, chunk))
+            except (anyio.EndOfStream, anyio.BrokenResourceError):
+                pass
+            except anyio.ClosedResourceError:
+                return
+            # an empty chunk tells the receiving task the topic ended
+            try:
+                await self._chunk_send.send((subscription, b""))
+            except anyio.ClosedResourceError:
+                pass
+
+
+class Publisher:
+    """
+    Publishes messages from any number of tasks over long-lived pipelined control
+    connections, obtained from `PubSubClient.publisher`.
+
+    Queued messages are written in batches of up to `max_batch_size` PUBLISH requests
+    per send, and acknowledged asynchronously through the `PendingResponse` returned
+    by `publish`. `publish` blocks while `max_queued` messages wait to be written;
+    each connection has at most `max_in_flight` unacknowledged messages. Messages are
+    only published in order with a single connection.
+    """
+
+    max_batch_size: int
+
+    def __init__(self, max_batch_size: int = 64, max_queued: int = 1024) -> None:
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size should be positive: {max_batch_size}")
+        self.max_batch_size = max_batch_size
+        self._send_stream: MemoryObjectSendStream[
+            Tuple[p2pd_pb.Request, PendingResponse]
+        ]
+        self._receive_stream: MemoryObjectReceiveStream[
+            Tuple[p2pd_pb.Request, PendingResponse]
+        ]
+        self._send_stream, self._receive_stream = anyio.create_memory_object_stream(
+            max_queued
+        )
+        self._idle = anyio.Event()
+        self._idle.set()
+        self._first_error: Optional[BaseException] = None
+        self.num_outstanding = 0
+        self.num_published = 0
+        self.num_failed = 0
+
+    async def publish(self, topic: str, data: bytes) -> PendingResponse:
+        """Queue a message and return without waiting for its acknowledgement."""
+        pubsub_req = p2pd_pb.PSRequest(
+            type=p2pd_pb.PSRequest.PUBLISH, topic=topic, data=data
+        )
+        req = p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
+        pending = PendingResponse()
+        await self._send_stream.send((req, pending))
+        if self.num_outstanding == 0:
+            self._idle = anyio.Event()
+        self.num_outstanding += 1
+        pending.add_done_callback(self._on_done)
+        return pending
+
+    async def flush(self) -> None:
+        """
+        Wait for every message published so far to be acknowledged. Raises
+        `ControlFailure` if any of the messages acknowledged since the last `flush`
+        failed.
+        """
+        while self.num_outstanding:
+            await self._idle.wait()
+        if self._first_error is not None:
+            error, self._first_error = self._first_error, None
+            raise ControlFailure(f"failed to publish: {error}")
+
+    async def aclose(self) -> None:
+        """Stop taking messages and wait for the queued ones to be acknowledged."""
+        await self._send_stream.aclose()
+        await self.flush()
+
+    def _on_done(self, pending: PendingResponse) -> None:
+        try:
+            raise_if_failed(pending.result())
+        except Exception as e:
+            self.num_failed += 1
+            if self._first_error is None:
+                self._first_error = e
+        else:
+            self.num_published += 1
+        self.num_outstanding -= 1
+        if self.num_outstanding == 0:
+            self._idle.set()
+
+    async def _write_batches(self, pipeline: PipelinedConnection) -> None:
+        async for req, pending in self._receive_stream:
+            reqs, pendings = [req], [pending]
+            while len(reqs) < self.max_batch_size:
+                try:
+                    req, pending = self._receive_stream.receive_nowait()
+                except (anyio.WouldBlock, anyio.EndOfStream):
+                    break
+                reqs.append(req)
+                pendings.append(pending)
+            try:
+                await pipeline.submit_many(reqs, pendings)
+            except Exception as e:
+                for pending in pendings:
+                    if not pending.done():
+                        pending._set_error(e)
 
 
 class PubSubClient:
@@ -19,11 +345,7 @@ class PubSubClient:
         """PUBSUB GET_TOPICS"""
         pubsub_req = p2pd_pb.PSRequest(type=p2pd_pb.PSRequest.GET_TOPICS)
         req = p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.coalesced_request(req)
         raise_if_failed(resp)
 
         topics = tuple(resp.pubsub.topics)
@@ -33,11 +355,7 @@ class PubSubClient:
         """PUBSUB LIST_PEERS"""
         pubsub_req = p2pd_pb.PSRequest(type=p2pd_pb.PSRequest.LIST_PEERS, topic=topic)
         req = p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.coalesced_request(req)
         raise_if_failed(resp)
 
         return tuple(ID(peer_id_bytes) for peer_id_bytes in resp.pubsub.peerIDs)
@@ -48,21 +366,83 @@ class PubSubClient:
             type=p2pd_pb.PSRequest.PUBLISH, topic=topic, data=data
         )
         req = p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
-        stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        await stream.aclose()
+        resp = await self.daemon_connector.request(req)
         raise_if_failed(resp)
 
-    async def subscribe(self, topic: str) -> ByteStream:
+    @asynccontextmanager
+    async def publisher(
+        self,
+        num_connections: int = 1,
+        max_in_flight: int = 256,
+        max_batch_size: int = 64,
+        max_queued: int = 1024,
+    ) -> AsyncIterator[Publisher]:
+        """
+        Open a `Publisher` on `num_connections` dedicated control connections. The
+        outstanding messages are awaited before the connections are closed.
+        """
+        if num_connections < 1:
+            raise ValueError(f"num_connections should be positive: {num_connections}")
+        publisher = Publisher(max_batch_size=max_batch_size, max_queued=max_queued)
+        pipelines: List[PipelinedConnection] = []
+        with publisher._receive_stream:
+            async with anyio.create_task_group() as task_group:
+                try:
+                    for _ in range(num_connections):
+                        stream = await self.daemon_connector.open_connection()
+                        pipeline = PipelinedConnection(
+                            stream, max_in_flight=max_in_flight
+                        )
+                        pipelines.append(pipeline)
+                        task_group.start_soon(pipeline.read_responses)
+                        task_group.start_soon(publisher._write_batches, pipeline)
+                    yield publisher
+                    await publisher.aclose()
+                finally:
+                    # whatever is still queued fails on the closed connections
+                    with anyio.CancelScope(shield=True):
+                        await publisher._send_stream.aclose()
+                        for pipeline in pipelines:
+                            await pipeline.aclose()
+
+    @asynccontextmanager
+    async def subscribe_many(
+        self,
+        topics: Iterable[str] = (),
+        dedup: Optional[DuplicateFilter] = None,
+        max_queued_chunks: int = 64,
+    ) -> AsyncIterator[MultiTopicSubscription]:
+        """
+        Subscribe to `topics` and yield a `MultiTopicSubscription` receiving all of
+        them, which more topics can be added to. Every topic is unsubscribed on exit.
+        """
+        async with anyio.create_task_group() as task_group:
+            subscription = MultiTopicSubscription(
+                self, task_group, dedup=dedup, max_queued_chunks=max_queued_chunks
+            )
+            try:
+                for topic in topics:
+                    await subscription.add_topic(topic)
+                yield subscription
+            finally:
+                with anyio.CancelScope(shield=True):
+                    await subscription.aclose()
+
+    async def subscribe(
+        self, topic: str, dedup: Optional[DuplicateFilter] = None
+    ) -> Subscription:
         """PUBSUB SUBSCRIBE"""
         pubsub_req = p2pd_pb.PSRequest(type=p2pd_pb.PSRequest.SUBSCRIBE, topic=topic)
         req = p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
         stream = await self.daemon_connector.open_connection()
-        await write_pbmsg(stream, req)
-        resp = p2pd_pb.Response()
-        await read_pbmsg_safe(stream, resp)
-        raise_if_failed(resp)
+        try:
+            await write_pbmsg(stream, req)
+            resp = p2pd_pb.Response()
+            await read_pbmsg_safe(stream, resp)
+            raise_if_failed(resp)
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await stream.aclose()
+            raise
 
-        return stream
+        return Subscription(topic, stream, dedup=dedup)
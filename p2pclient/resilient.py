@@ -0,0 +1,168 @@
+import logging
+import random
+from collections import deque
+from types import TracebackType
+from typing import Deque, List, NamedTuple, Optional, Type
+
+import anyio
+
+from .datastructures import PubSubMessage
+from .dedup import DuplicateFilter
+from .exceptions import ControlFailure
+from .pubsub import PubSubClient, Subscription
+
+# what a daemon connection going away looks like
+_CONNECTION_ERRORS = (
+    anyio.EndOfStream,
+    anyio.BrokenResourceError,
+    anyio.IncompleteRead,
+    OSError,
+)
+
+
+class Outage(NamedTuple):
+    # on the event loop clock
+    started_at: float
+    duration: float
+    num_attempts: int
+    error: str
+
+
+class ResilientSubscription:
+    """
+    Subscription to `topic` that outlives its daemon connections: when one ends or
+    fails, `receive` subscribes again and goes on with the new one. Attempts are
+    spaced by a random backoff of up to `min_backoff` seconds, doubling per failed
+    attempt up to `max_backoff`.
+
+    Messages published while no connection was up are missed. The last `max_outages`
+    outages are kept in `outages` and their total time in `downtime`. A `dedup`
+    filter drops the messages delivered again around a reconnect.
+    """
+
+    pubsub: PubSubClient
+    topic: str
+    dedup: Optional[DuplicateFilter]
+    min_backoff: float
+    max_backoff: float
+    logger = logging.getLogger("p2pclient.ResilientSubscription")
+
+    def __init__(
+        self,
+        pubsub: PubSubClient,
+        topic: str,
+        dedup: Optional[DuplicateFilter] = None,
+        min_backoff: float = 0.1,
+        max_backoff: float = 30.0,
+        max_outages: int = 100,
+    ) -> None:
+        self.pubsub = pubsub
+        self.topic = topic
+        self.dedup = dedup
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.outages: Deque[Outage] = deque(maxlen=max_outages)
+        self.downtime = 0.0
+        self.num_resubscribes = 0
+        self._subscription: Optional[Subscription] = None
+        self._down_since: Optional[float] = None
+        self._last_error = ""
+        self._closed = False
+
+    def __repr__(self) -> str:
+        return f"<ResilientSubscription topic={self.topic}>"
+
+    @property
+    def connected(self) -> bool:
+        return self._subscription is not None
+
+    async def receive(self) -> PubSubMessage:
+        """Wait for the next message, subscribing again as long as it takes."""
+        while True:
+            subscription = await self._get_subscription()
+            try:
+                return await subscription.receive()
+            except _CONNECTION_ERRORS as e:
+                await self._lost(subscription, e)
+
+    def receive_buffered(self) -> List[PubSubMessage]:
+        """Decode the messages that are already buffered, without any I/O."""
+        if self._subscription is None:
+            return []
+        return self._subscription.receive_buffered()
+
+    def __aiter__(self) -> "ResilientSubscription":
+        return self
+
+    async def __anext__(self) -> PubSubMessage:
+        try:
+            return await self.receive()
+        except anyio.ClosedResourceError:
+            raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        self._closed = True
+        if self._subscription is not None:
+            subscription, self._subscription = self._subscription, None
+            await subscription.aclose()
+
+    async def __aenter__(self) -> "ResilientSubscription":
+        await self._get_subscription()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        with anyio.CancelScope(shield=True):
+            await self.aclose()
+
+    async def _get_subscription(self) -> Subscription:
+        num_attempts = 0
+        while True:
+            if self._closed:
+                raise anyio.ClosedResourceError
+            if self._subscription is not None:
+                return self._subscription
+            if num_attempts:
+                backoff = min(
+                    self.min_backoff * 2 ** (num_attempts - 1), self.max_backoff
+                )
+                await anyio.sleep(random.uniform(0, backoff))
+            num_attempts += 1
+            try:
+                subscription = await self.pubsub.subscribe(self.topic, dedup=self.dedup)
+            except (ControlFailure,) + _CONNECTION_ERRORS as e:
+                self.logger.debug("subscribing to %s failed: %s", self.topic, e)
+                if self._down_since is None:
+                    self._down_since = anyio.current_time()
+                self._last_error = str(e) or type(e).__name__
+                continue
+            if self._closed:
+                with anyio.CancelScope(shield=True):
+                    await subscription.aclose()
+                raise anyio.ClosedResourceError
+            self._subscription = subscription
+            if self._down_since is not None:
+                self._recovered(num_attempts)
+            return subscription
+
+    async def _lost(self, subscription: Subscription, error: BaseException) -> None:
+        self.logger.debug("subscription to %s lost: %s", self.topic, error)
+        self._subscription = None
+        self._down_since = anyio.current_time()
+        self._last_error = str(error) or type(error).__name__
+        with anyio.CancelScope(shield=True):
+            await subscription.aclose()
+
+    def _recovered(self, num_attempts: int) -> None:
+        assert self._down_since is not None
+        duration = anyio.current_time() - self._down_since
+        self.outages.append(
+            Outage(self._down_since, duration, num_attempts, self._last_error)
+        )
+        self.downtime += duration
+        self.num_resubscribes += 1
+        self._down_since = None
@@ -1,13 +1,11 @@
-import logging
-from typing import Union
+from typing import Any, Callable, Mapping, Optional, Tuple, Union
 
-from anyio import IncompleteRead
-from anyio.abc import ByteReceiveStream, ByteSendStream, SocketStream
+from anyio import EndOfStream, IncompleteRead
+from anyio.abc import ByteReceiveStream, ByteSendStream, ByteStream, SocketStream
 from anyio.streams.buffered import BufferedByteReceiveStream
 
-logger = logging.getLogger(__name__)
-
 DEFAULT_MAX_BITS: int = 64
+DEFAULT_CHUNK_SIZE: int = 65536
 
 
 def _ensure_buffered(stream: ByteReceiveStream) -> BufferedByteReceiveStream:
@@ -45,15 +43,138 @@ async def _recv_exactly(
     raise TypeError(f"Stream {stream!r} has no compatible receive API")
 
 
-def _hexdump(b: bytes, width: int = 16) -> str:
-    return " ".join(f"{x:02x}" for x in b)
+class FramedReader(ByteReceiveStream):
+    """
+    Buffered reader bound to a connection for its whole life.
 
+    Data is received in chunks of up to `chunk_size` bytes and varints and frames are
+    decoded straight from the buffer, so bytes read past a frame are kept for the
+    next read instead of being lost with a throwaway wrapper.
+    """
 
-async def write_unsigned_varint(
-    stream: ByteSendStream,
-    integer: int,
-    max_bits: int = DEFAULT_MAX_BITS,
-) -> None:
+    receive_stream: ByteReceiveStream
+    chunk_size: int
+
+    def __init__(
+        self, receive_stream: ByteReceiveStream, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> None:
+        self.receive_stream = receive_stream
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    @property
+    def num_buffered(self) -> int:
+        return len(self._buffer) - self._offset
+
+    @property
+    def buffer(self) -> bytes:
+        """The bytes received but not consumed yet."""
+        return bytes(self._buffer[self._offset :])  # noqa: E203
+
+    @property
+    def extra_attributes(self) -> Mapping[Any, Callable[[], Any]]:
+        return self.receive_stream.extra_attributes
+
+    async def aclose(self) -> None:
+        await self.receive_stream.aclose()
+
+    async def receive(self, max_bytes: int = DEFAULT_CHUNK_SIZE) -> bytes:
+        if self.num_buffered:
+            return self._consume(min(max_bytes, self.num_buffered))
+        return await self.receive_stream.receive(max_bytes)
+
+    async def receive_exactly(self, nbytes: int) -> bytes:
+        while self.num_buffered < nbytes:
+            await self._fill()
+        return self._consume(nbytes)
+
+    async def read_unsigned_varint(self, max_bits: int = DEFAULT_MAX_BITS) -> int:
+        while True:
+            result = self._decode_unsigned_varint(max_bits)
+            if result is not None:
+                return result
+            await self._fill()
+
+    async def read_frame(self) -> bytes:
+        """Read a varint length-prefixed frame and return its payload."""
+        length = await self.read_unsigned_varint()
+        return await self.receive_exactly(length)
+
+    def read_buffered_frame(self) -> Optional[bytes]:
+        """
+        Return the payload of the next frame if it is already buffered, or `None`
+        without waiting for more data.
+        """
+        start = self._offset
+        length = self._decode_unsigned_varint(DEFAULT_MAX_BITS)
+        if length is None:
+            return None
+        if self.num_buffered < length:
+            self._offset = start
+            return None
+        return self._consume(length)
+
+    def feed(self, data: bytes) -> None:
+        """Append `data` received from the underlying stream by someone else."""
+        if self._offset:
+            del self._buffer[: self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    def _decode_unsigned_varint(self, max_bits: int) -> Optional[int]:
+        max_int: int = 1 << max_bits
+        result: int = 0
+        shift: int = 0
+        buffer = self._buffer
+        for i in range(self._offset, len(buffer)):
+            c = buffer[i]
+            result |= (c & 0x7F) << shift
+            if result >= max_int:
+                raise ValueError(f"varint overflowed: {result}")
+            if not c & 0x80:
+                self._offset = i + 1
+                return result
+            shift += 7
+        return None
+
+    def _consume(self, nbytes: int) -> bytes:
+        start = self._offset
+        with memoryview(self._buffer) as view:
+            data = bytes(view[start : start + nbytes])  # noqa: E203
+        self._offset = start + nbytes
+        if self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        return data
+
+    async def _fill(self) -> None:
+        try:
+            chunk = await self.receive_stream.receive(self.chunk_size)
+        except EndOfStream as e:
+            raise IncompleteRead from e
+        self.feed(chunk)
+
+
+class FramedStream(FramedReader, ByteStream):
+    """`FramedReader` over a bidirectional stream, sends go straight to the stream."""
+
+    stream: ByteStream
+
+    def __init__(
+        self, stream: ByteStream, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> None:
+        super().__init__(stream, chunk_size)
+        self.stream = stream
+
+    async def send(self, item: bytes) -> None:
+        await self.stream.send(item)
+
+    async def send_eof(self) -> None:
+        await self.stream.send_eof()
+
+
+def encode_unsigned_varint(integer: int, max_bits: int = DEFAULT_MAX_BITS) -> bytes:
     max_int: int = 1 << max_bits
     if integer < 0:
         raise ValueError(f"negative integer: {integer}")
@@ -61,32 +182,57 @@ async def write_unsigned_varint(
         raise ValueError(f"integer too large: {integer}")
 
     # Emit bytes little-endian 7-bit groups with MSB as continuation flag
+    buf = bytearray()
     while True:
         value: int = integer & 0x7F
         integer >>= 7
         if integer != 0:
             value |= 0x80
-        byte = value.to_bytes(1, "big")
-        await stream.send(byte)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("write_unsigned_varint -> %s", _hexdump(byte))
+        buf.append(value)
         if integer == 0:
             break
+    return bytes(buf)
+
+
+def decode_unsigned_varint(
+    data: bytes, offset: int = 0, max_bits: int = DEFAULT_MAX_BITS
+) -> Tuple[int, int]:
+    """Decode the varint at `offset` of `data`, return it and the offset past it."""
+    max_int: int = 1 << max_bits
+    result: int = 0
+    shift: int = 0
+    for i in range(offset, len(data)):
+        c = data[i]
+        result |= (c & 0x7F) << shift
+        if result >= max_int:
+            raise ValueError(f"varint overflowed: {result}")
+        if not c & 0x80:
+            return result, i + 1
+        shift += 7
+    raise ValueError("truncated varint")
+
+
+async def write_unsigned_varint(
+    stream: ByteSendStream,
+    integer: int,
+    max_bits: int = DEFAULT_MAX_BITS,
+) -> None:
+    await stream.send(encode_unsigned_varint(integer, max_bits))
 
 
 async def read_unsigned_varint(
     stream: ByteReceiveStream,
     max_bits: int = DEFAULT_MAX_BITS,
 ) -> int:
+    if isinstance(stream, FramedReader):
+        return await stream.read_unsigned_varint(max_bits)
+
     max_int: int = 1 << max_bits
     iteration: int = 0
     result: int = 0
 
     while True:
         data = await _recv_exactly(stream, 1)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("read_unsigned_varint <- %s", _hexdump(data))
-
         c = data[0]
         value = c & 0x7F
         result |= value << (iteration * 7)
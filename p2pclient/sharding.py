@@ -0,0 +1,274 @@
+import logging
+import multiprocessing
+import os
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import AsyncIterator, Dict, List, Mapping, Optional
+
+import anyio
+import anyio.to_thread
+from async_generator import asynccontextmanager
+from multiaddr import Multiaddr, protocols
+
+from .control import ControlClient, DaemonConnector, StreamHandler, parse_conn_protocol
+
+# how often the supervisor checks whether a worker is alive
+POLL_INTERVAL = 0.1
+# how long a worker gets to exit by itself before it is terminated
+STOP_TIMEOUT = 5.0
+# how long a worker, possibly still starting, gets to acknowledge new handlers
+ACK_TIMEOUT = 30.0
+
+
+def _run_worker(
+    control_maddr: str,
+    listen_maddr: str,
+    handlers: Dict[str, StreamHandler],
+    conn: Connection,
+    backend: str,
+) -> None:
+    anyio.run(
+        _serve_worker, control_maddr, listen_maddr, handlers, conn, backend=backend
+    )
+
+
+async def _serve_worker(
+    control_maddr: str,
+    listen_maddr: str,
+    handlers: Dict[str, StreamHandler],
+    conn: Connection,
+) -> None:
+    control = ControlClient(
+        DaemonConnector(Multiaddr(control_maddr)),
+        Multiaddr(listen_maddr),
+        reuse_port=True,
+    )
+    control.handlers.update(handlers)
+    async with control.listen():
+        # handler updates, `None` to remove one, until the supervisor closes the
+        # connection; each is acknowledged once the handlers are in place
+        while True:
+            try:
+                updates = await anyio.to_thread.run_sync(conn.recv)
+            except EOFError:
+                return
+            for proto, handler in updates.items():
+                if handler is None:
+                    control.handlers.pop(proto, None)
+                else:
+                    control.handlers[proto] = handler
+            conn.send(True)
+
+
+def _wait_ack(conn: Connection) -> bool:
+    try:
+        if not conn.poll(ACK_TIMEOUT):
+            return False
+        conn.recv()
+    except (EOFError, OSError):
+        return False
+    return True
+
+
+class _Worker:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Optional[BaseProcess] = None
+        self.conn: Optional[Connection] = None
+        self.num_restarts = 0
+
+
+class ShardedListener:
+    """
+    Runs the stream handlers of `control` in `num_workers` worker processes, so
+    CPU-heavy handlers are not held back by the GIL. Every worker listens on the TCP
+    `listen_maddr` of `control` with `SO_REUSEPORT`, and the kernel spreads the
+    inbound streams of the daemon across them.
+
+    Handlers are replicated to every worker, including the ones started later, before
+    they are registered with the daemon, so no worker gets a stream it has no handler
+    for. They have to be picklable, e.g. module level functions. Workers that exit
+    are restarted after `restart_delay` seconds, doubling up to `max_restart_delay`
+    while they keep exiting within `min_uptime` seconds.
+    """
+
+    control: ControlClient
+    num_workers: int
+    backend: str
+    handlers: Dict[str, StreamHandler]
+    logger = logging.getLogger("p2pclient.ShardedListener")
+
+    def __init__(
+        self,
+        control: ControlClient,
+        num_workers: Optional[int] = None,
+        backend: str = "asyncio",
+        restart_delay: float = 0.5,
+        max_restart_delay: float = 30.0,
+        min_uptime: float = 5.0,
+    ) -> None:
+        if parse_conn_protocol(control.listen_maddr) != protocols.P_IP4:
+            raise ValueError(
+                f"sharding needs a TCP listen_maddr: {control.listen_maddr}"
+            )
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers < 1:
+            raise ValueError(f"num_workers should be positive: {num_workers}")
+        self.control = control
+        self.num_workers = num_workers
+        self.backend = backend
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.handlers = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = []
+        # one update at a time, so the acknowledgements match the updates
+        self._replicate_lock = anyio.Lock()
+        self.num_restarts = 0
+
+    @property
+    def pids(self) -> List[int]:
+        """The process IDs of the workers alive."""
+        processes = [worker.process for worker in self._workers]
+        return [
+            process.pid
+            for process in processes
+            if process is not None and process.pid is not None and process.is_alive()
+        ]
+
+    async def stream_handler(self, proto: str, handler_cb: StreamHandler) -> None:
+        previous = await self._replicate({proto: handler_cb})
+        try:
+            await self.control.stream_handler(proto, handler_cb)
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await self._replicate(previous)
+            raise
+
+    async def stream_handlers(self, handlers: Mapping[str, StreamHandler]) -> None:
+        previous = await self._replicate(handlers)
+        try:
+            await self.control.stream_handlers(handlers)
+        except BaseException:
+            # the protocols the daemon registered keep their new handler
+            rejected = {
+                proto: previous[proto]
+                for proto, handler_cb in handlers.items()
+                if self.control.handlers.get(proto) is not handler_cb
+            }
+            with anyio.CancelScope(shield=True):
+                await self._replicate(rejected)
+            raise
+
+    async def _replicate(
+        self, updates: Mapping[str, Optional[StreamHandler]]
+    ) -> Dict[str, Optional[StreamHandler]]:
+        """
+        Apply `updates`, where `None` removes a handler, here and in every worker alive,
+        and wait for the workers to acknowledge them. Return the handlers replaced.
+        """
+        if not updates:
+            return {}
+        async with self._replicate_lock:
+            previous = {proto: self.handlers.get(proto) for proto in updates}
+            for proto, handler_cb in updates.items():
+                if handler_cb is None:
+                    self.handlers.pop(proto, None)
+                else:
+                    self.handlers[proto] = handler_cb
+            async with anyio.create_task_group() as task_group:
+                for worker in self._workers:
+                    if worker.conn is not None:
+                        task_group.start_soon(self._send_updates, worker, dict(updates))
+        return previous
+
+    async def _send_updates(
+        self, worker: _Worker, updates: Dict[str, Optional[StreamHandler]]
+    ) -> None:
+        conn = worker.conn
+        assert conn is not None
+        try:
+            conn.send(updates)
+        except OSError:
+            # the worker is gone, it gets every handler when restarted
+            return
+        if not await anyio.to_thread.run_sync(_wait_ack, conn):
+            self.logger.warning(
+                "worker %d did not acknowledge handlers %s", worker.index, list(updates)
+            )
+
+    @asynccontextmanager
+    async def listen(self) -> AsyncIterator["ShardedListener"]:
+        """Run the workers while the context is active."""
+        async with anyio.create_task_group() as task_group:
+            for index in range(self.num_workers):
+                worker = _Worker(index)
+                self._workers.append(worker)
+                task_group.start_soon(self._supervise, worker)
+            try:
+                yield self
+            finally:
+                task_group.cancel_scope.cancel()
+        self._workers = []
+
+    def _start(self, worker: _Worker) -> None:
+        conn, worker_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                str(self.control.daemon_connector.control_maddr),
+                str(self.control.listen_maddr),
+                dict(self.handlers),
+                worker_conn,
+                self.backend,
+            ),
+            name=f"p2pclient-worker-{worker.index}",
+            daemon=True,
+        )
+        process.start()
+        # the worker holds its end now
+        worker_conn.close()
+        worker.process, worker.conn = process, conn
+
+    @staticmethod
+    def _stop(worker: _Worker) -> None:
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+        process = worker.process
+        if process is None:
+            return
+        process.join(STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join(STOP_TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    async def _supervise(self, worker: _Worker) -> None:
+        delay = self.restart_delay
+        try:
+            while True:
+                started_at = anyio.current_time()
+                self._start(worker)
+                assert worker.process is not None
+                while worker.process.is_alive():
+                    await anyio.sleep(POLL_INTERVAL)
+                self.logger.warning(
+                    "worker %d exited with code %s, restarting it",
+                    worker.index,
+                    worker.process.exitcode,
+                )
+                self._stop(worker)
+                if anyio.current_time() - started_at >= self.min_uptime:
+                    delay = self.restart_delay
+                await anyio.sleep(delay)
+                delay = min(2 * delay, self.max_restart_delay)
+                worker.num_restarts += 1
+                self.num_restarts += 1
+        finally:
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(self._stop, worker)
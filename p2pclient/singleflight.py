@@ -0,0 +1,68 @@
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+import anyio
+
+TResult = TypeVar("TResult")
+
+
+class _Call:
+    result: Any = None
+    error: Optional[Exception] = None
+    # the leader went away without a result, so a follower has to take over
+    abandoned: bool = False
+
+    def __init__(self) -> None:
+        self.done = anyio.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key into one call of the underlying function.
+
+    The first caller (the leader) runs the function; callers arriving while it is in
+    flight wait for it and get the same result or exception. Nothing is remembered
+    once the call finished. If the leader is cancelled, the call is abandoned and one
+    of the waiting callers runs the function again, so a caller never sees another
+    task's cancellation. Only use this for idempotent reads.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, _Call] = {}
+        self.num_calls = 0
+        self.num_coalesced = 0
+
+    @property
+    def num_in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[TResult]]) -> TResult:
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                return await self._lead(key, fn)
+            self.num_coalesced += 1
+            await call.done.wait()
+            if call.abandoned:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    async def _lead(
+        self, key: Hashable, fn: Callable[[], Awaitable[TResult]]
+    ) -> TResult:
+        call = _Call()
+        self._calls[key] = call
+        self.num_calls += 1
+        try:
+            call.result = await fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
@@ -0,0 +1,285 @@
+import logging
+import mmap
+import os
+import struct
+from typing import AsyncIterator, Optional
+
+import anyio
+import anyio.to_thread
+from async_generator import asynccontextmanager
+
+from .datastructures import PubSubMessage
+from .exceptions import SlowConsumer
+from .fanout import OverflowPolicy
+from .pb import p2pd_pb2 as p2pd_pb
+from .pubsub import Subscription
+from .utils import decode_pbmsg
+
+SPOOL_MAGIC = b"P2PSPOOL"
+# magic, capacity, then the write and committed read offsets; the offsets count
+# every byte ever appended, their position in the ring is the offset modulo capacity
+_HEADER = struct.Struct("<8sQQQ")
+_TAIL_OFFSET = 16
+_COMMITTED_OFFSET = 24
+HEADER_SIZE = mmap.PAGESIZE
+_LENGTH = struct.Struct("<I")
+
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+
+
+class _RingFile:
+    """
+    Append-only ring of length-prefixed records in a memory-mapped file.
+
+    A record becomes visible once the write offset in the header is moved past it,
+    and the space of the records before the committed read offset is reused, so
+    reopening the file after a crash resumes after the last committed record.
+    """
+
+    def __init__(self, path: str, capacity: int) -> None:
+        if capacity <= _LENGTH.size:
+            raise ValueError(f"capacity is too small: {capacity}")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                os.ftruncate(fd, HEADER_SIZE + capacity)
+            elif size != HEADER_SIZE + capacity:
+                raise ValueError(
+                    f"spool file {path} does not have a capacity of {capacity} bytes"
+                )
+            self._mmap = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        magic, file_capacity, tail, committed = _HEADER.unpack_from(self._mmap)
+        if size == 0:
+            _HEADER.pack_into(self._mmap, 0, SPOOL_MAGIC, capacity, 0, 0)
+            tail = committed = 0
+        elif magic != SPOOL_MAGIC or file_capacity != capacity or committed > tail:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a spool file")
+        self.capacity = capacity
+        self.tail = tail
+        self.committed = committed
+        # the next record to read, records between it and `committed` were read but
+        # not committed yet
+        self.read_offset = committed
+
+    @property
+    def num_bytes(self) -> int:
+        return self.tail - self.committed
+
+    def fits(self, record_size: int) -> bool:
+        return self.num_bytes + _LENGTH.size + record_size <= self.capacity
+
+    def append(self, record: bytes) -> None:
+        self._write(self.tail, _LENGTH.pack(len(record)) + record)
+        self.tail += _LENGTH.size + len(record)
+        struct.pack_into("<Q", self._mmap, _TAIL_OFFSET, self.tail)
+
+    def read(self) -> Optional[bytes]:
+        """The next unread record, or `None` if every record was read."""
+        if self.read_offset == self.tail:
+            return None
+        (length,) = _LENGTH.unpack(self._read(self.read_offset, _LENGTH.size))
+        record = self._read(self.read_offset + _LENGTH.size, length)
+        self.read_offset += _LENGTH.size + length
+        return record
+
+    def drop_oldest(self) -> None:
+        (length,) = _LENGTH.unpack(self._read(self.committed, _LENGTH.size))
+        self.commit(self.committed + _LENGTH.size + length)
+        self.read_offset = max(self.read_offset, self.committed)
+
+    def commit(self, offset: int) -> None:
+        self.committed = offset
+        struct.pack_into("<Q", self._mmap, _COMMITTED_OFFSET, offset)
+
+    def flush(self) -> None:
+        self._mmap.flush()
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def _write(self, offset: int, data: bytes) -> None:
+        start = HEADER_SIZE + offset % self.capacity
+        first = min(len(data), HEADER_SIZE + self.capacity - start)
+        self._mmap[start : start + first] = data[:first]  # noqa: E203
+        if first < len(data):
+            rest = len(data) - first
+            self._mmap[HEADER_SIZE : HEADER_SIZE + rest] = data[first:]  # noqa: E203
+
+    def _read(self, offset: int, length: int) -> bytes:
+        start = HEADER_SIZE + offset % self.capacity
+        first = min(length, HEADER_SIZE + self.capacity - start)
+        data = self._mmap[start : start + first]  # noqa: E203
+        if first < length:
+            rest = length - first
+            data += self._mmap[HEADER_SIZE : HEADER_SIZE + rest]  # noqa: E203
+        return data
+
+
+class Spool:
+    """
+    Drains a subscription as fast as the daemon sends into a ring file of at most
+    `capacity` bytes at `path`, for a consumer to read at its own pace. When the file
+    is full, `policy` decides between waiting for the consumer (`BLOCK`), dropping
+    messages (`DROP_OLDEST`, `DROP_NEWEST`) and closing the subscription
+    (`DISCONNECT`).
+
+    The space of messages is only reused once the consumer committed them with
+    `commit`, and messages received after the last commit are received again when the
+    file is reopened, e.g. after a crash. With `sync`, commits wait for the file to be
+    written to disk.
+    """
+
+    path: str
+    capacity: int
+    policy: OverflowPolicy
+    sync: bool
+    logger = logging.getLogger("p2pclient.Spool")
+
+    def __init__(
+        self,
+        path: str,
+        capacity: int = DEFAULT_CAPACITY,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        sync: bool = False,
+    ) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.policy = policy
+        self.sync = sync
+        self._ring: Optional[_RingFile] = None
+        self._subscription: Optional[Subscription] = None
+        self._readable = anyio.Event()
+        self._writable = anyio.Event()
+        self._error: Optional[BaseException] = None
+        self._ended = False
+        self.num_spooled = 0
+        self.num_dropped = 0
+
+    def __repr__(self) -> str:
+        return f"<Spool path={self.path}>"
+
+    @property
+    def num_bytes(self) -> int:
+        """Bytes taken by the messages not committed yet."""
+        return 0 if self._ring is None else self._ring.num_bytes
+
+    @asynccontextmanager
+    async def run(self, subscription: Subscription) -> AsyncIterator["Spool"]:
+        """
+        Open the file and drain `subscription` into it while the context is active.
+        Messages left in the file from a previous run come first.
+        """
+        self._ring = _RingFile(self.path, self.capacity)
+        self._subscription = subscription
+        self._error = None
+        self._ended = False
+        try:
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(self._drain, subscription)
+                try:
+                    yield self
+                finally:
+                    task_group.cancel_scope.cancel()
+        finally:
+            self._ring.close()
+            self._ring = None
+
+    async def receive(self) -> PubSubMessage:
+        """
+        Wait for the next message. Raises `anyio.EndOfStream` once the subscription
+        ended and every message was received, or `SlowConsumer` if the subscription
+        was dropped because the file was full.
+        """
+        while True:
+            if self._ring is None:
+                raise anyio.ClosedResourceError
+            record = self._ring.read()
+            if record is not None:
+                msg = self._decode(record)
+                if msg is not None:
+                    return msg
+                continue
+            if self._error is not None:
+                raise self._error
+            if self._ended:
+                raise anyio.EndOfStream
+            self._readable = anyio.Event()
+            await self._readable.wait()
+
+    async def commit(self) -> None:
+        """Mark every message received so far as processed, freeing their space."""
+        if self._ring is None:
+            raise anyio.ClosedResourceError
+        ring = self._ring
+        ring.commit(ring.read_offset)
+        self._writable.set()
+        if self.sync:
+            await anyio.to_thread.run_sync(ring.flush)
+
+    def __aiter__(self) -> "Spool":
+        return self
+
+    async def __anext__(self) -> PubSubMessage:
+        try:
+            return await self.receive()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration
+
+    def _decode(self, record: bytes) -> Optional[PubSubMessage]:
+        pb_msg = p2pd_pb.PSMessage()
+        decode_pbmsg(record, pb_msg)
+        msg = PubSubMessage.from_pb(pb_msg)
+        dedup = None if self._subscription is None else self._subscription.dedup
+        if dedup is not None and dedup.is_duplicate(msg):
+            return None
+        return msg
+
+    async def _drain(self, subscription: Subscription) -> None:
+        try:
+            while True:
+                try:
+                    record = await subscription.receive_frame()
+                except (anyio.EndOfStream, anyio.ClosedResourceError):
+                    self._ended = True
+                    return
+                if not await self._append(record):
+                    return
+        except Exception as e:
+            self.logger.debug("spooling %s failed: %s", subscription, e)
+            self._error = e
+        finally:
+            self._readable.set()
+
+    async def _append(self, record: bytes) -> bool:
+        """Append a record as the policy says, return whether to go on draining."""
+        ring, subscription = self._ring, self._subscription
+        assert ring is not None and subscription is not None
+        if _LENGTH.size + len(record) > ring.capacity:
+            self.num_dropped += 1
+            return True
+        while not ring.fits(len(record)):
+            if self.policy is OverflowPolicy.DROP_NEWEST:
+                self.num_dropped += 1
+                return True
+            elif self.policy is OverflowPolicy.DROP_OLDEST:
+                ring.drop_oldest()
+                self.num_dropped += 1
+            elif self.policy is OverflowPolicy.DISCONNECT:
+                self._error = SlowConsumer(
+                    f"consumer of {self.path} fell behind by more than "
+                    f"{ring.capacity} bytes"
+                )
+                with anyio.CancelScope(shield=True):
+                    await subscription.aclose()
+                return False
+            else:
+                self._writable = anyio.Event()
+                await self._writable.wait()
+        ring.append(record)
+        self.num_spooled += 1
+        self._readable.set()
+        return True
@@ -0,0 +1,65 @@
+"""
+Opt-in tracing of the protobuf frames exchanged with the daemon.
+
+Nothing is traced unless an observer is installed with `install_frame_observer`;
+until then the framing code only pays for one `is None` check per frame.
+"""
+
+import logging
+import random
+from typing import Callable, Optional
+
+# (direction, message size, message bytes truncated to `max_bytes`)
+FrameObserver = Callable[[str, int, bytes], None]
+
+SEND = "send"
+RECEIVE = "receive"
+
+logger = logging.getLogger("p2pclient.wire")
+
+
+class FrameTracer:
+    observer: FrameObserver
+    sample_rate: float
+    max_bytes: int
+
+    def __init__(
+        self, observer: FrameObserver, sample_rate: float = 1.0, max_bytes: int = 256
+    ) -> None:
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"sample_rate should be within [0, 1]: {sample_rate}")
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes should not be negative: {max_bytes}")
+        self.observer = observer
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+
+    def trace(self, direction: str, msg_bytes: bytes) -> None:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self.observer(direction, len(msg_bytes), msg_bytes[: self.max_bytes])
+
+
+frame_tracer: Optional[FrameTracer] = None
+
+
+def install_frame_observer(
+    observer: FrameObserver, sample_rate: float = 1.0, max_bytes: int = 256
+) -> FrameTracer:
+    """
+    Call `observer` for a `sample_rate` fraction of the frames sent to and received
+    from the daemon, with at most `max_bytes` of each message.
+    """
+    global frame_tracer
+    frame_tracer = FrameTracer(observer, sample_rate=sample_rate, max_bytes=max_bytes)
+    return frame_tracer
+
+
+def uninstall_frame_observer() -> None:
+    global frame_tracer
+    frame_tracer = None
+
+
+def log_frame(direction: str, size: int, data: bytes) -> None:
+    """Observer logging a hex dump of each frame at the DEBUG level."""
+    logger.debug("%s pbmsg (%d bytes): %s", direction, size, data.hex())
@@ -1,24 +1,26 @@
-import logging
+import math
 import socket
 from contextlib import closing
+from typing import Iterable, Optional
 
 import anyio
-from anyio.abc import ByteStream
+from anyio.abc import ByteReceiveStream, ByteStream
 from google.protobuf.message import Message as PBMessage
 
+from . import tracing
 from .exceptions import ControlFailure
 from .pb import p2pd_pb2 as p2pd_pb
 from .serialization import (
     _recv_exactly,
+    encode_unsigned_varint,
     read_unsigned_varint,
-    write_unsigned_varint,
 )
 
 # Type alias for compatibility
 SocketStream = ByteStream
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+# How long a single read may stall when the caller did not set a deadline
+DEFAULT_READ_TIMEOUT = 60.0
 
 
 def raise_if_failed(response: p2pd_pb.Response) -> None:
@@ -26,30 +28,85 @@ def raise_if_failed(response: p2pd_pb.Response) -> None:
         raise ControlFailure(f"connect failed. msg={response.error.msg}")
 
 
-async def write_pbmsg(stream: SocketStream, pbmsg: PBMessage) -> None:
-    size = pbmsg.ByteSize()
-    await write_unsigned_varint(stream, size)
+def encode_pbmsg(pbmsg: PBMessage) -> bytes:
+    """Serialize `pbmsg` together with its varint length prefix."""
     msg_bytes: bytes = pbmsg.SerializeToString()
-    await stream.send(msg_bytes)
-    if logger.isEnabledFor(logging.DEBUG):
-        logger.debug("write_pbmsg (%d bytes): %s", size, msg_bytes.hex())
+    tracer = tracing.frame_tracer
+    if tracer is not None:
+        tracer.trace(tracing.SEND, msg_bytes)
+    return encode_unsigned_varint(len(msg_bytes)) + msg_bytes
 
 
-async def read_pbmsg_safe(stream: SocketStream, pbmsg: PBMessage) -> None:
-    # Length prefix
-    # length = await read_unsigned_varint(stream)
-    # msg_bytes = await _recv_exactly(stream, length)
+def decode_pbmsg(msg_bytes: bytes, pbmsg: PBMessage) -> None:
+    """Parse the payload of a received frame into `pbmsg`."""
+    tracer = tracing.frame_tracer
+    if tracer is not None:
+        tracer.trace(tracing.RECEIVE, msg_bytes)
+    pbmsg.ParseFromString(msg_bytes)
 
-    with anyio.fail_after(60):
-        length = await read_unsigned_varint(stream)
 
-    with anyio.fail_after(60):
-        msg_bytes = await _recv_exactly(stream, length)
+async def write_pbmsg(stream: SocketStream, pbmsg: PBMessage) -> None:
+    await stream.send(encode_pbmsg(pbmsg))
 
-    if logger.isEnabledFor(logging.DEBUG):
-        logger.debug("read_pbmsg (%d bytes): %s", length, msg_bytes.hex())
 
-    pbmsg.ParseFromString(msg_bytes)
+async def write_pbmsgs(stream: SocketStream, pbmsgs: Iterable[PBMessage]) -> None:
+    """Frame all of `pbmsgs` into a single `send`."""
+    data = b"".join(encode_pbmsg(pbmsg) for pbmsg in pbmsgs)
+    if data:
+        await stream.send(data)
+
+
+async def read_pbmsg_safe(
+    stream: ByteReceiveStream,
+    pbmsg: PBMessage,
+    timeout: Optional[float] = DEFAULT_READ_TIMEOUT,
+) -> None:
+    """Read one length-prefixed message, giving up after `timeout` seconds."""
+    with anyio.fail_after(timeout):
+        length = await read_unsigned_varint(stream)
+        msg_bytes = await _recv_exactly(stream, length)
+    decode_pbmsg(msg_bytes, pbmsg)
+
+
+def deadline_after(timeout: Optional[float]) -> float:
+    """Absolute deadline on the event loop clock, `math.inf` for no deadline."""
+    if timeout is None:
+        return math.inf
+    return anyio.current_time() + timeout
+
+
+def time_left(deadline: float) -> Optional[float]:
+    """Seconds left until `deadline`, in the form `anyio.fail_after` takes."""
+    if deadline == math.inf:
+        return None
+    return max(deadline - anyio.current_time(), 0.0)
+
+
+def read_timeout(deadline: float) -> Optional[float]:
+    """
+    Timeout for the next read of a call: whatever is left of its deadline, or the
+    default stall timeout for calls without a deadline.
+    """
+    if deadline == math.inf:
+        return DEFAULT_READ_TIMEOUT
+    return time_left(deadline)
+
+
+def set_request_timeout(req: p2pd_pb.Request, deadline: float) -> None:
+    """
+    Pass `deadline` on to the daemon for the request types that carry a timeout, so
+    that it abandons the operation when the client does. The field is in whole
+    seconds and rounded up, so the daemon never gives up first.
+    """
+    if deadline == math.inf:
+        return
+    seconds = max(math.ceil(deadline - anyio.current_time()), 1)
+    if req.type == p2pd_pb.Request.CONNECT:
+        req.connect.timeout = seconds
+    elif req.type == p2pd_pb.Request.STREAM_OPEN:
+        req.streamOpen.timeout = seconds
+    elif req.type == p2pd_pb.Request.DHT:
+        req.dht.timeout = seconds
 
 
 def get_unused_tcp_port() -> int:
@@ -0,0 +1,279 @@
+import functools
+import os
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
+
+import anyio
+import anyio.to_process
+import anyio.to_thread
+import multihash
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from async_generator import asynccontextmanager
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS, eddsa
+from google.protobuf.message import DecodeError
+
+from p2pclient.libp2p_stubs.crypto.keys import KeyType, PublicKey
+from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
+from p2pclient.libp2p_stubs.crypto.rsa import RSAPublicKey
+from p2pclient.libp2p_stubs.peer.id import (
+    ID,
+    IDENTITY_MULTIHASH_CODE,
+    MAX_INLINE_KEY_LENGTH,
+)
+
+from .datastructures import PubSubMessage
+from .pubsub import Subscription
+
+# prepended to the marshaled message before signing, see the libp2p pubsub spec
+SIGNATURE_PREFIX = b"libp2p-pubsub:"
+# parsed public keys kept per worker thread pool or worker process
+KEY_CACHE_SIZE = 4096
+
+# (from, signed bytes, signature, key) of a message, cheap to send to a worker process
+_VerifyItem = Tuple[bytes, bytes, bytes, bytes]
+# `valid` of a message: `None` if its key type is not supported
+_VerifyResult = Optional[bool]
+
+
+class _Ed25519PublicKey(PublicKey):
+    def __init__(self, key_bytes: bytes) -> None:
+        self.impl = eddsa.import_public_key(key_bytes)
+
+    def to_bytes(self) -> bytes:
+        return self.impl.export_key(format="raw")
+
+    def get_type(self) -> KeyType:
+        return KeyType.Ed25519
+
+    def verify(self, data: bytes, signature: bytes) -> bool:
+        try:
+            eddsa.new(self.impl, "rfc8032").verify(data, signature)
+        except ValueError:
+            return False
+        return True
+
+
+class _ECDSAPublicKey(PublicKey):
+    def __init__(self, key_bytes: bytes) -> None:
+        # DER encoded PKIX structure
+        self.impl = ECC.import_key(key_bytes)
+
+    def to_bytes(self) -> bytes:
+        return self.impl.export_key(format="DER")
+
+    def get_type(self) -> KeyType:
+        return KeyType.ECDSA
+
+    def verify(self, data: bytes, signature: bytes) -> bool:
+        try:
+            DSS.new(self.impl, "fips-186-3", encoding="der").verify(
+                SHA256.new(data), signature
+            )
+        except ValueError:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _load_public_key(key_pb_bytes: bytes) -> Optional[PublicKey]:
+    """
+    Parse a marshaled `PublicKey`, or return `None` if its type is not supported.
+    Raises `ValueError` if it is malformed.
+    """
+    try:
+        key_pb = crypto_pb.PublicKey.FromString(key_pb_bytes)
+        if key_pb.key_type == crypto_pb.RSA:
+            return RSAPublicKey.from_bytes(key_pb.data)
+        if key_pb.key_type == crypto_pb.Ed25519:
+            return _Ed25519PublicKey(key_pb.data)
+        if key_pb.key_type == crypto_pb.ECDSA:
+            return _ECDSAPublicKey(key_pb.data)
+    except (DecodeError, IndexError, TypeError) as e:
+        raise ValueError(f"malformed public key: {e}") from e
+    # secp256k1, which pycryptodome does not implement
+    return None
+
+
+def _peer_id_bytes_from_key(key_pb_bytes: bytes) -> bytes:
+    algo = multihash.Func.sha2_256
+    if len(key_pb_bytes) <= MAX_INLINE_KEY_LENGTH:
+        algo = IDENTITY_MULTIHASH_CODE
+    return multihash.digest(key_pb_bytes, algo).encode()
+
+
+def _verify_one(item: _VerifyItem) -> _VerifyResult:
+    from_bytes, data, signature, key_pb_bytes = item
+    if not signature:
+        return False
+    if key_pb_bytes:
+        # the key has to belong to the peer the message claims to come from
+        if _peer_id_bytes_from_key(key_pb_bytes) != from_bytes:
+            return False
+    else:
+        key_pb = ID(from_bytes).extract_public_key()
+        if key_pb is None:
+            return False
+        key_pb_bytes = key_pb.SerializeToString()
+    try:
+        public_key = _load_public_key(key_pb_bytes)
+    except ValueError:
+        return False
+    if public_key is None:
+        return None
+    return public_key.verify(data, signature)
+
+
+def _verify_batch(items: Sequence[_VerifyItem]) -> List[_VerifyResult]:
+    return [_verify_one(item) for item in items]
+
+
+def signed_bytes(msg: PubSubMessage) -> bytes:
+    """The bytes the sender of `msg` signed."""
+    pb_msg = msg.to_pb()
+    pb_msg.ClearField("signature")
+    pb_msg.ClearField("key")
+    return SIGNATURE_PREFIX + pb_msg.SerializeToString()
+
+
+class SignatureVerifier:
+    """
+    Verifies pubsub message signatures off the event loop, in batches of up to
+    `max_batch_size` messages handed to a pool of `max_workers` worker threads, or
+    worker processes if `use_processes` is set. Threads keep the event loop responsive,
+    but much of a verify holds the GIL, so processes are needed to use several cores.
+
+    Unsigned messages are reported as invalid, and the messages signed with a key of
+    an unsupported type, i.e. secp256k1, get a `valid` of `None`: not verified.
+    """
+
+    use_processes: bool
+    max_workers: int
+    max_batch_size: int
+    max_pending_batches: int
+
+    def __init__(
+        self,
+        use_processes: bool = False,
+        max_workers: Optional[int] = None,
+        max_batch_size: int = 64,
+        max_pending_batches: Optional[int] = None,
+    ) -> None:
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_workers < 1 or max_batch_size < 1:
+            raise ValueError("max_workers and max_batch_size should be positive")
+        self.use_processes = use_processes
+        self.max_workers = max_workers
+        self.max_batch_size = max_batch_size
+        self.max_pending_batches = (
+            2 * max_workers if max_pending_batches is None else max_pending_batches
+        )
+        self._limiter = anyio.CapacityLimiter(max_workers)
+        self.num_valid = 0
+        self.num_invalid = 0
+        self.num_unverified = 0
+
+    async def verify_many(self, msgs: Sequence[PubSubMessage]) -> None:
+        """Set `valid` on each of `msgs`, verifying their batches in parallel."""
+        async with anyio.create_task_group() as task_group:
+            for start in range(0, len(msgs), self.max_batch_size):
+                end = start + self.max_batch_size
+                task_group.start_soon(self._verify_batch, msgs[start:end])
+
+    @asynccontextmanager
+    async def verified(
+        self, subscription: Subscription
+    ) -> AsyncIterator[MemoryObjectReceiveStream[PubSubMessage]]:
+        """
+        Verify the messages of `subscription` while the context is active. They come
+        out of the yielded stream in the order they arrived, with `valid` set, and
+        the stream ends with the subscription.
+        """
+        send_stream: MemoryObjectSendStream[PubSubMessage]
+        receive_stream: MemoryObjectReceiveStream[PubSubMessage]
+        send_stream, receive_stream = anyio.create_memory_object_stream(
+            self.max_batch_size
+        )
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(self._verify_subscription, subscription, send_stream)
+            try:
+                yield receive_stream
+            finally:
+                task_group.cancel_scope.cancel()
+                receive_stream.close()
+
+    async def _verify_batch(self, msgs: Sequence[PubSubMessage]) -> None:
+        items = [
+            (msg.from_id.to_bytes(), signed_bytes(msg), msg.signature, msg.key)
+            for msg in msgs
+        ]
+        if self.use_processes:
+            results = await anyio.to_process.run_sync(
+                _verify_batch, items, limiter=self._limiter
+            )
+        else:
+            results = await anyio.to_thread.run_sync(
+                _verify_batch, items, limiter=self._limiter
+            )
+        for msg, valid in zip(msgs, results):
+            msg.valid = valid
+            if valid is None:
+                self.num_unverified += 1
+            elif valid:
+                self.num_valid += 1
+            else:
+                self.num_invalid += 1
+
+    async def _verify_subscription(
+        self,
+        subscription: Subscription,
+        send_stream: MemoryObjectSendStream[PubSubMessage],
+    ) -> None:
+        # batches being verified, in arrival order; bounds the work in flight
+        batch_send: MemoryObjectSendStream[Tuple[List[PubSubMessage], anyio.Event]]
+        batch_receive: MemoryObjectReceiveStream[
+            Tuple[List[PubSubMessage], anyio.Event]
+        ]
+        batch_send, batch_receive = anyio.create_memory_object_stream(
+            self.max_pending_batches
+        )
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(self._deliver_in_order, batch_receive, send_stream)
+            async with batch_send:
+                while True:
+                    try:
+                        msgs = [await subscription.receive()]
+                    except (anyio.EndOfStream, anyio.ClosedResourceError):
+                        return
+                    msgs.extend(subscription.receive_buffered())
+                    for start in range(0, len(msgs), self.max_batch_size):
+                        batch = msgs[start : start + self.max_batch_size]  # noqa: E203
+                        done = anyio.Event()
+                        task_group.start_soon(self._verify_batch_and_set, batch, done)
+                        await batch_send.send((batch, done))
+
+    async def _verify_batch_and_set(
+        self, msgs: Sequence[PubSubMessage], done: anyio.Event
+    ) -> None:
+        try:
+            await self._verify_batch(msgs)
+        finally:
+            done.set()
+
+    @staticmethod
+    async def _deliver_in_order(
+        batch_receive: MemoryObjectReceiveStream[
+            Tuple[List[PubSubMessage], anyio.Event]
+        ],
+        send_stream: MemoryObjectSendStream[PubSubMessage],
+    ) -> None:
+        async with batch_receive, send_stream:
+            try:
+                async for batch, done in batch_receive:
+                    await done.wait()
+                    for msg in batch:
+                        await send_stream.send(msg)
+            except anyio.BrokenResourceError:
+                # the consumer went away
+                pass
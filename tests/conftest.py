@@ -1,4 +1,8 @@
+import anyio
 import pytest
+from anyio.abc import SocketAttribute
+from helpers import FakeDaemon
+from multiaddr import Multiaddr
 
 
 def pytest_addoption(parser):
@@ -30,3 +34,16 @@ def pytest_collection_modifyitems(config, items):
         for mark, reason in skip_reasons.items():
             if mark in item.keywords:
                 item.add_marker(pytest.mark.skip(reason=reason))
+
+
+@pytest.fixture
+async def fake_daemon(anyio_backend):
+    daemon = FakeDaemon()
+    listener = await anyio.create_tcp_listener(local_host="127.0.0.1")
+    port = listener.extra(SocketAttribute.local_port)
+    daemon.control_maddr = Multiaddr(f"/ip4/127.0.0.1/tcp/{port}")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(listener.serve, daemon.serve)
+        yield daemon
+        tg.cancel_scope.cancel()
+    await listener.aclose()
@@ -0,0 +1,121 @@
+"""Fakes and helpers shared by the test modules."""
+
+import anyio
+from multiaddr import Multiaddr
+
+from p2pclient.datastructures import PubSubMessage
+from p2pclient.libp2p_stubs.peer.id import ID
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.serialization import FramedReader
+from p2pclient.utils import encode_pbmsg, read_pbmsg_safe, write_pbmsg
+
+PEER_ID = ID.from_base58("QmcgpsyWgH8Y8ajJz1Cu72KnS5uo2Aa2LpzU7kinSupNK1")
+
+
+class FakeDaemon:
+    """
+    In-process stand-in for the daemon control socket. Every request is recorded and
+    answered by `handler`, which writes the response(s) and returns whether the
+    connection should stay open for further requests.
+    """
+
+    def __init__(self):
+        self.control_maddr = None
+        self.num_connections = 0
+        self.requests = []
+        self.handler = self.reply_ok
+
+    @staticmethod
+    async def write_response(stream, resp):
+        await write_pbmsg(stream, resp)
+
+    async def reply_ok(self, req, stream):
+        await self.write_response(stream, p2pd_pb.Response(type=p2pd_pb.Response.OK))
+        return True
+
+    async def serve(self, stream):
+        self.num_connections += 1
+        reader = FramedReader(stream)
+        async with stream:
+            try:
+                while True:
+                    req = p2pd_pb.Request()
+                    await read_pbmsg_safe(reader, req)
+                    self.requests.append(req)
+                    if not await self.handler(req, stream):
+                        return
+            except (
+                anyio.EndOfStream,
+                anyio.IncompleteRead,
+                anyio.BrokenResourceError,
+                anyio.ClosedResourceError,
+            ):
+                # the client went away
+                return
+
+
+class PublishRecorder:
+    """Acknowledges PUBLISH requests, counting the sends they arrived in."""
+
+    def __init__(self, fake_daemon, fail_data=None):
+        self.fake_daemon = fake_daemon
+        self.fail_data = fail_data
+        self.published = []
+        fake_daemon.handler = self.handle
+
+    async def handle(self, req, stream):
+        self.published.append(req.pubsub.data)
+        if req.pubsub.data == self.fail_data:
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="failed")
+            )
+        else:
+            resp = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        await self.fake_daemon.write_response(stream, resp)
+        return True
+
+
+def make_msgs(topic, num_msgs):
+    return [
+        PubSubMessage(
+            from_id=PEER_ID, data=b"data%d" % i, seqno=bytes([i]), topic_ids=[topic]
+        )
+        for i in range(num_msgs)
+    ]
+
+
+def make_subscribe_handler(fake_daemon, msgs, unsubscribed=None):
+    async def handler(req, stream):
+        ok = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        # the response and every message arrive in a single segment
+        await stream.send(
+            encode_pbmsg(ok) + b"".join(encode_pbmsg(msg.to_pb()) for msg in msgs)
+        )
+        if unsubscribed is None:
+            return False
+        try:
+            await stream.receive()
+        except (anyio.EndOfStream, anyio.BrokenResourceError):
+            unsubscribed.set()
+        return False
+
+    return handler
+
+
+async def open_inbound_stream(port, proto, payload=b""):
+    """Act as the daemon handing over an inbound stream of `proto`."""
+    stream_info = p2pd_pb.StreamInfo(
+        peer=PEER_ID.to_bytes(),
+        addr=Multiaddr("/ip4/1.2.3.4/tcp/1").to_bytes(),
+        proto=proto,
+    )
+    stream = await anyio.connect_tcp("127.0.0.1", port)
+    # the header and the payload arrive in one segment
+    await stream.send(encode_pbmsg(stream_info) + payload)
+    return stream
+
+
+async def wait_until(predicate):
+    with anyio.fail_after(5):
+        while not predicate():
+            await anyio.sleep(0.01)
@@ -4,6 +4,7 @@ import base58
 import multihash
 
 import p2pclient.libp2p_stubs.peer.id as PeerID
+from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
 from p2pclient.libp2p_stubs.crypto.rsa import create_new_key_pair
 from p2pclient.libp2p_stubs.peer.id import ID
 
@@ -104,3 +105,15 @@ def test_id_from_public_key():
     actual = ID.from_pubkey(public_key)
 
     assert actual == expected
+
+
+def test_extract_public_key():
+    key_pair = create_new_key_pair()
+    # RSA keys are too large to be inlined
+    assert ID.from_pubkey(key_pair.public_key).extract_public_key() is None
+
+    public_key_pb = crypto_pb.PublicKey(key_type=crypto_pb.Ed25519, data=b"\x01" * 32)
+    mh_digest = multihash.digest(
+        public_key_pb.SerializeToString(), PeerID.IDENTITY_MULTIHASH_CODE
+    )
+    assert ID(mh_digest.encode()).extract_public_key() == public_key_pb
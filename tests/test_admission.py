@@ -0,0 +1,61 @@
+import anyio
+import pytest
+
+from p2pclient.admission import HandlerLimiter
+
+
+@pytest.mark.anyio
+async def test_limiter_admits_up_to_max_concurrent():
+    limiter = HandlerLimiter(2)
+    assert await limiter.acquire()
+    assert await limiter.acquire()
+    assert limiter.num_running == 2
+    # no wait queue
+    assert not await limiter.acquire()
+    limiter.release()
+    assert await limiter.acquire()
+    stats = limiter.stats()
+    assert stats.num_admitted == 3
+    assert stats.num_rejected == 1
+
+
+@pytest.mark.anyio
+async def test_limiter_wait_queue():
+    limiter = HandlerLimiter(1, max_waiting=1)
+    results = []
+
+    async def run_handler(hold):
+        admitted = await limiter.acquire()
+        results.append(admitted)
+        if admitted:
+            await hold.wait()
+            limiter.release()
+
+    hold = anyio.Event()
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(run_handler, hold)
+        await anyio.sleep(0.01)
+        tg.start_soon(run_handler, hold)
+        await anyio.sleep(0.01)
+        assert limiter.num_waiting == 1
+        # the queue is full
+        assert not await limiter.acquire()
+        hold.set()
+    assert results == [True, True]
+    assert limiter.num_rejected == 1
+    assert limiter.max_wait_time > 0
+
+
+@pytest.mark.anyio
+async def test_limiter_wait_timeout():
+    limiter = HandlerLimiter(1, max_waiting=1, wait_timeout=0.01)
+    assert await limiter.acquire()
+    assert not await limiter.acquire()
+    assert limiter.num_timed_out == 1
+    assert limiter.num_waiting == 0
+    assert limiter.total_wait_time >= 0.01
+
+
+def test_limiter_invalid():
+    with pytest.raises(ValueError):
+        HandlerLimiter(0)
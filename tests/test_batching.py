@@ -0,0 +1,120 @@
+import anyio
+import pytest
+from helpers import PEER_ID, PublishRecorder, make_subscribe_handler
+
+from p2pclient.batching import (
+    ENVELOPE_MAGIC,
+    BatchingPublisher,
+    decode_envelope,
+    encode_envelope,
+    unpack,
+    unpacked,
+)
+from p2pclient.control import DaemonConnector
+from p2pclient.datastructures import PubSubMessage
+from p2pclient.pubsub import PubSubClient
+
+
+@pytest.mark.parametrize("items", ([], [b""], [b"a", b"bb", b"c" * 300]))
+def test_envelope_roundtrip(items):
+    assert decode_envelope(encode_envelope(items)) == items
+
+
+@pytest.mark.parametrize(
+    "data", (b"", b"plain data", ENVELOPE_MAGIC + b"\x05abc", ENVELOPE_MAGIC + b"\x80")
+)
+def test_decode_envelope_not_an_envelope(data):
+    assert decode_envelope(data) is None
+
+
+def test_unpack():
+    msg = PubSubMessage(from_id=PEER_ID, data=b"plain", seqno=b"\x01")
+    assert unpack(msg) == [msg]
+    envelope = PubSubMessage(
+        from_id=PEER_ID,
+        data=encode_envelope([b"a", b"b"]),
+        seqno=b"\x02",
+        topic_ids=("topic",),
+    )
+    msgs = unpack(envelope)
+    assert [msg.data for msg in msgs] == [b"a", b"b"]
+    assert all(msg.seqno == b"\x02" and msg.topic_ids == ("topic",) for msg in msgs)
+
+
+@pytest.mark.anyio
+async def test_batching_publisher_fills_envelopes(fake_daemon):
+    recorder = PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    batcher = BatchingPublisher(pubsub, max_delay=60, max_envelope_bytes=64)
+    data = [b"%02d" % i * 4 for i in range(20)]
+    async with batcher.run():
+        for item in data:
+            await batcher.publish("topic", item)
+    # every envelope but the last one is full
+    assert batcher.num_envelopes == len(recorder.published) == 4
+    assert all(len(envelope) <= 64 for envelope in recorder.published)
+    items = [item for env in recorder.published for item in decode_envelope(env)]
+    assert items == data
+    assert batcher.num_messages == 20
+
+
+@pytest.mark.anyio
+async def test_batching_publisher_concurrent_publishers(fake_daemon):
+    recorder = PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    batcher = BatchingPublisher(pubsub, max_delay=60, max_envelope_bytes=40)
+
+    async def publish_many(publisher_index):
+        for i in range(20):
+            await batcher.publish("topic", b"%d-%02d" % (publisher_index, i))
+
+    async with batcher.run():
+        async with anyio.create_task_group() as task_group:
+            for publisher_index in range(3):
+                task_group.start_soon(publish_many, publisher_index)
+    items = [item for env in recorder.published for item in decode_envelope(env)]
+    assert batcher.num_messages == len(items) == 60
+    assert sorted(items) == sorted(
+        b"%d-%02d" % (publisher_index, i)
+        for publisher_index in range(3)
+        for i in range(20)
+    )
+
+
+@pytest.mark.anyio
+async def test_batching_publisher_max_delay(fake_daemon):
+    recorder = PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with BatchingPublisher(pubsub, max_delay=0.01).run() as batcher:
+        await batcher.publish("a", b"1")
+        await batcher.publish("b", b"2")
+        await batcher.publish("a", b"3")
+        with anyio.fail_after(5):
+            while len(recorder.published) < 2:
+                await anyio.sleep(0.01)
+        assert sorted(decode_envelope(env) for env in recorder.published) == [
+            [b"1", b"3"],
+            [b"2"],
+        ]
+
+
+@pytest.mark.anyio
+async def test_batching_publisher_not_running(fake_daemon):
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    with pytest.raises(RuntimeError):
+        await BatchingPublisher(pubsub).publish("topic", b"data")
+
+
+@pytest.mark.anyio
+async def test_unpacked_subscription(fake_daemon):
+    msgs = [
+        PubSubMessage(from_id=PEER_ID, data=b"plain", seqno=b"\x01"),
+        PubSubMessage(
+            from_id=PEER_ID, data=encode_envelope([b"a", b"b"]), seqno=b"\x02"
+        ),
+    ]
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with await pubsub.subscribe("topic") as sub:
+        received = [msg.data async for msg in unpacked(sub)]
+    assert received == [b"plain", b"a", b"b"]
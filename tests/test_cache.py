@@ -0,0 +1,190 @@
+import anyio
+import pytest
+
+from p2pclient.cache import DHTCache, LRUCache
+from p2pclient.control import DaemonConnector
+from p2pclient.dht import DHTClient
+from p2pclient.exceptions import ControlFailure
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr("p2pclient.cache.time.monotonic", fake_clock)
+    return fake_clock
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.num_evicted == 1
+
+
+def test_lru_cache_bounds_bytes():
+    cache = LRUCache(max_entries=10, max_bytes=10)
+    cache.set("a", b"aaaa", size=4)
+    cache.set("b", b"bbbb", size=4)
+    cache.set("c", b"cccc", size=4)
+    assert "a" not in cache
+    assert cache.num_bytes == 8
+    # values that can never fit are not stored
+    cache.set("d", b"d" * 11, size=11)
+    assert "d" not in cache
+    assert cache.num_bytes == 8
+    cache.pop("b")
+    assert cache.num_bytes == 4
+
+
+def test_lru_cache_expiry(clock):
+    cache = LRUCache()
+    cache.set("a", 1, ttl=10)
+    cache.set("b", 2)
+    clock.now += 9
+    assert cache.get("a") == 1
+    clock.now += 2
+    assert cache.get("a") is None
+    assert len(cache) == 1
+    assert cache.get("b") == 2
+
+
+@pytest.mark.anyio
+async def test_dht_cache_get_or_fetch(clock):
+    cache = DHTCache(get_value_ttl=10)
+    num_fetches = 0
+
+    async def fetch():
+        nonlocal num_fetches
+        num_fetches += 1
+        return b"value"
+
+    for _ in range(3):
+        assert await cache.get_or_fetch(DHTCache.GET_VALUE, b"key", fetch, len) == (
+            b"value"
+        )
+    assert num_fetches == 1
+    assert cache.hits[DHTCache.GET_VALUE] == 2
+    assert cache.misses[DHTCache.GET_VALUE] == 1
+    clock.now += 11
+    await cache.get_or_fetch(DHTCache.GET_VALUE, b"key", fetch, len)
+    assert num_fetches == 2
+
+
+@pytest.mark.anyio
+async def test_dht_cache_negative_results(clock):
+    cache = DHTCache(negative_ttl=5)
+    num_fetches = 0
+
+    async def fetch():
+        nonlocal num_fetches
+        num_fetches += 1
+        raise ControlFailure("not found")
+
+    for _ in range(2):
+        with pytest.raises(ControlFailure, match="not found"):
+            await cache.get_or_fetch(DHTCache.FIND_PEER, b"peer", fetch, len)
+    assert num_fetches == 1
+    clock.now += 6
+    with pytest.raises(ControlFailure):
+        await cache.get_or_fetch(DHTCache.FIND_PEER, b"peer", fetch, len)
+    assert num_fetches == 2
+
+
+@pytest.mark.anyio
+async def test_dht_cache_zero_ttl_disables_caching():
+    cache = DHTCache(find_providers_ttl=0)
+    num_fetches = 0
+
+    async def fetch():
+        nonlocal num_fetches
+        num_fetches += 1
+        return ()
+
+    for _ in range(2):
+        await cache.get_or_fetch(DHTCache.FIND_PROVIDERS, b"cid", fetch, len)
+    assert num_fetches == 2
+    assert len(cache.entries) == 0
+
+
+@pytest.mark.anyio
+async def test_dht_client_get_value_is_cached_and_put_value_invalidates(fake_daemon):
+    values = {}
+
+    async def handler(req, stream):
+        if req.dht.type == p2pd_pb.DHTRequest.PUT_VALUE:
+            values[req.dht.key] = req.dht.value
+            resp = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        else:
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.OK,
+                dht=p2pd_pb.DHTResponse(
+                    type=p2pd_pb.DHTResponse.VALUE, value=values[req.dht.key]
+                ),
+            )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = handler
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr), cache=DHTCache())
+    await dht.put_value(b"key", b"v1")
+    assert await dht.get_value(b"key") == b"v1"
+    assert await dht.get_value(b"key") == b"v1"
+    assert len(fake_daemon.requests) == 2
+    await dht.put_value(b"key", b"v2")
+    assert await dht.get_value(b"key") == b"v2"
+    assert len(fake_daemon.requests) == 4
+
+
+@pytest.mark.anyio
+async def test_dht_client_put_value_during_get_value(fake_daemon):
+    values = {b"key": b"old"}
+    get_started = anyio.Event()
+    put_done = anyio.Event()
+
+    async def handler(req, stream):
+        if req.dht.type == p2pd_pb.DHTRequest.PUT_VALUE:
+            values[req.dht.key] = req.dht.value
+            resp = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        else:
+            value = values[req.dht.key]
+            if not get_started.is_set():
+                # the first lookup is answered after the put
+                get_started.set()
+                await put_done.wait()
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.OK,
+                dht=p2pd_pb.DHTResponse(type=p2pd_pb.DHTResponse.VALUE, value=value),
+            )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = handler
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr), cache=DHTCache())
+    results = []
+
+    async def get_value():
+        results.append(await dht.get_value(b"key"))
+
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(get_value)
+        with anyio.fail_after(5):
+            await get_started.wait()
+        await dht.put_value(b"key", b"new")
+        put_done.set()
+    assert results == [b"old"]
+    # the value looked up before the put is not cached
+    assert await dht.get_value(b"key") == b"new"
+    assert len(dht.cache._fetches) == 0
@@ -2,7 +2,7 @@ import pytest
 from multiaddr import Multiaddr
 
 import p2pclient.pb.p2pd_pb2 as p2pd_pb
-from p2pclient.datastructures import PeerInfo, StreamInfo
+from p2pclient.datastructures import PeerInfo, PubSubMessage, StreamInfo
 from p2pclient.libp2p_stubs.peer.id import ID
 
 
@@ -70,3 +70,27 @@ def test_peer_info(peer_id, maddr):
     pi_1 = PeerInfo.from_pb(pi_pb)
     assert pi.peer_id == pi_1.peer_id
     assert pi.addrs == pi_1.addrs
+
+
+def test_pubsub_message(peer_id):
+    msg = PubSubMessage(
+        from_id=peer_id,
+        data=b"data",
+        seqno=b"\x00\x01",
+        topic_ids=["topic"],
+        signature=b"signature",
+        key=b"key",
+    )
+    # test case: `PubSubMessage.to_pb`
+    pb_msg = msg.to_pb()
+    assert getattr(pb_msg, "from") == peer_id.to_bytes()
+    assert pb_msg.data == msg.data
+    assert list(pb_msg.topicIDs) == ["topic"]
+    # test case: `PubSubMessage.from_pb`
+    msg_1 = PubSubMessage.from_pb(pb_msg)
+    assert msg_1.from_id == peer_id
+    assert msg_1.data == msg.data
+    assert msg_1.seqno == msg.seqno
+    assert msg_1.topic_ids == ("topic",)
+    assert msg_1.signature == msg.signature
+    assert msg_1.key == msg.key
@@ -0,0 +1,66 @@
+import anyio
+import pytest
+from helpers import PEER_ID, make_msgs, make_subscribe_handler
+
+from p2pclient.control import DaemonConnector
+from p2pclient.datastructures import PubSubMessage
+from p2pclient.dedup import DuplicateFilter
+from p2pclient.pubsub import PubSubClient
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr("p2pclient.cache.time.monotonic", fake_clock)
+    return fake_clock
+
+
+def test_duplicate_filter_drops_repeats():
+    dedup = DuplicateFilter()
+    msgs = make_msgs("topic", 3)
+    assert [dedup.is_duplicate(msg) for msg in msgs] == [False] * 3
+    assert [dedup.is_duplicate(msg) for msg in msgs] == [True] * 3
+    assert dedup.num_dropped == 3
+    assert len(dedup) == 3
+
+
+def test_duplicate_filter_keeps_messages_without_seqno():
+    dedup = DuplicateFilter()
+    msg = PubSubMessage(from_id=PEER_ID, data=b"data")
+    assert not dedup.is_duplicate(msg)
+    assert not dedup.is_duplicate(msg)
+    assert dedup.num_dropped == 0
+
+
+def test_duplicate_filter_bounded(clock):
+    dedup = DuplicateFilter(max_entries=2, ttl=10)
+    msgs = make_msgs("topic", 3)
+    for msg in msgs:
+        dedup.is_duplicate(msg)
+    assert len(dedup) == 2
+    # the oldest ID was forgotten
+    assert not dedup.is_duplicate(msgs[0])
+    clock.now += 11
+    assert not dedup.is_duplicate(msgs[2])
+
+
+@pytest.mark.anyio
+async def test_subscription_drops_duplicates(fake_daemon):
+    msgs = make_msgs("topic", 3)
+    fake_daemon.handler = make_subscribe_handler(
+        fake_daemon, msgs + msgs[1:], anyio.Event()
+    )
+    dedup = DuplicateFilter()
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with await pubsub.subscribe("topic", dedup=dedup) as sub:
+        received = [await sub.receive()] + sub.receive_buffered()
+    assert [msg.seqno for msg in received] == [msg.seqno for msg in msgs]
+    assert dedup.num_dropped == 2
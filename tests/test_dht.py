@@ -0,0 +1,218 @@
+import anyio
+import pytest
+from async_generator import aclosing
+
+from p2pclient.control import DaemonConnector
+from p2pclient.dht import DHTClient
+from p2pclient.exceptions import ControlFailure
+from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
+from p2pclient.libp2p_stubs.peer.id import ID, IDENTITY_MULTIHASH_CODE
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+
+PEER_IDS = tuple(
+    ID.from_base58(peer_id_str)
+    for peer_id_str in (
+        "QmcgpsyWgH8Y8ajJz1Cu72KnS5uo2Aa2LpzU7kinSupNK1",
+        "QmbHVEEepCi7rn7VL7Exxpd2Ci9NNB6ifvqwhsrbRMgQFP",
+        "QmNnooDu7bfjPFoTZYxMNLWUQJyrVwtbZg5gBMjTezGAJN",
+    )
+)
+
+
+def dht_response(dht_type, **kwargs):
+    return p2pd_pb.Response(
+        type=p2pd_pb.Response.OK,
+        dht=p2pd_pb.DHTResponse(type=dht_type, **kwargs),
+    )
+
+
+def make_streaming_handler(fake_daemon, peer_ids, first_sent=None, proceed=None):
+    async def handler(req, stream):
+        await fake_daemon.write_response(
+            stream, dht_response(p2pd_pb.DHTResponse.BEGIN)
+        )
+        for i, peer_id in enumerate(peer_ids):
+            pinfo = p2pd_pb.PeerInfo(id=peer_id.to_bytes())
+            await fake_daemon.write_response(
+                stream, p2pd_pb.DHTResponse(type=p2pd_pb.DHTResponse.VALUE, peer=pinfo)
+            )
+            if i == 0 and first_sent is not None:
+                first_sent.set()
+                await proceed.wait()
+        await fake_daemon.write_response(
+            stream, p2pd_pb.DHTResponse(type=p2pd_pb.DHTResponse.END)
+        )
+        return True
+
+    return handler
+
+
+@pytest.mark.anyio
+async def test_find_providers(fake_daemon):
+    fake_daemon.handler = make_streaming_handler(fake_daemon, PEER_IDS)
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    pinfos = await dht.find_providers(b"cid", 10)
+    assert [pinfo.peer_id for pinfo in pinfos] == list(PEER_IDS)
+
+
+@pytest.mark.anyio
+async def test_find_providers_iter_yields_before_the_walk_ends(fake_daemon):
+    first_sent, proceed = anyio.Event(), anyio.Event()
+    fake_daemon.handler = make_streaming_handler(
+        fake_daemon, PEER_IDS, first_sent, proceed
+    )
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    peer_ids = []
+    async with aclosing(dht.find_providers_iter(b"cid", 10)) as pinfos:
+        async for pinfo in pinfos:
+            peer_ids.append(pinfo.peer_id)
+            # the daemon only sends the remaining providers after the first arrived
+            proceed.set()
+    assert peer_ids == list(PEER_IDS)
+
+
+@pytest.mark.anyio
+async def test_find_providers_iter_aclose_tears_down_the_connection(fake_daemon):
+    first_sent, proceed = anyio.Event(), anyio.Event()
+    fake_daemon.handler = make_streaming_handler(
+        fake_daemon, PEER_IDS, first_sent, proceed
+    )
+    connector = DaemonConnector(fake_daemon.control_maddr, pool_max_size=2)
+    dht = DHTClient(connector)
+    async with aclosing(dht.find_providers_iter(b"cid", 10)) as pinfos:
+        async for pinfo in pinfos:
+            assert pinfo.peer_id == PEER_IDS[0]
+            break
+    proceed.set()
+    # the streaming connection is not handed back to the pool
+    assert connector.pool.num_idle == 0
+
+
+@pytest.mark.anyio
+async def test_get_closest_peers_iter_error(fake_daemon):
+    async def reply_error(req, stream):
+        resp = p2pd_pb.Response(
+            type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="not found")
+        )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = reply_error
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    with pytest.raises(ControlFailure):
+        async with aclosing(dht.get_closest_peers_iter(b"key")) as peer_ids:
+            async for _ in peer_ids:
+                pass
+
+
+@pytest.mark.anyio
+async def test_find_peer_reuses_pooled_connection(fake_daemon):
+    async def reply_peer(req, stream):
+        pinfo = p2pd_pb.PeerInfo(id=req.dht.peer)
+        await fake_daemon.write_response(
+            stream, dht_response(p2pd_pb.DHTResponse.VALUE, peer=pinfo)
+        )
+        return True
+
+    fake_daemon.handler = reply_peer
+    connector = DaemonConnector(fake_daemon.control_maddr, pool_max_size=2)
+    dht = DHTClient(connector)
+    for peer_id in PEER_IDS:
+        assert (await dht.find_peer(peer_id)).peer_id == peer_id
+    assert fake_daemon.num_connections == 1
+
+
+def make_public_key_pb(data):
+    return crypto_pb.PublicKey(key_type=crypto_pb.Ed25519, data=data)
+
+
+@pytest.mark.anyio
+async def test_get_public_key_from_inlined_peer_id(fake_daemon):
+    public_key_pb = make_public_key_pb(b"\x01" * 32)
+    serialized = public_key_pb.SerializeToString()
+    peer_id = ID(bytes([IDENTITY_MULTIHASH_CODE, len(serialized)]) + serialized)
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    assert await dht.get_public_key(peer_id) == public_key_pb
+    assert fake_daemon.requests == []
+
+
+@pytest.mark.anyio
+async def test_get_public_key_caches_queried_keys(fake_daemon):
+    public_key_pb = make_public_key_pb(b"\x02" * 256)
+
+    async def reply_public_key(req, stream):
+        await fake_daemon.write_response(
+            stream,
+            dht_response(
+                p2pd_pb.DHTResponse.VALUE, value=public_key_pb.SerializeToString()
+            ),
+        )
+        return True
+
+    fake_daemon.handler = reply_public_key
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    for _ in range(2):
+        assert await dht.get_public_key(PEER_IDS[0]) == public_key_pb
+    assert len(fake_daemon.requests) == 1
+
+
+@pytest.mark.anyio
+async def test_dht_concurrent_find_peer_is_coalesced(fake_daemon):
+    proceed = anyio.Event()
+
+    async def reply_peer(req, stream):
+        await proceed.wait()
+        pinfo = p2pd_pb.PeerInfo(id=req.dht.peer)
+        await fake_daemon.write_response(
+            stream, dht_response(p2pd_pb.DHTResponse.VALUE, peer=pinfo)
+        )
+        return True
+
+    fake_daemon.handler = reply_peer
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    pinfos = []
+
+    async def find_peer():
+        pinfos.append(await dht.find_peer(PEER_IDS[0]))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(5):
+            tg.start_soon(find_peer)
+        while not fake_daemon.requests:
+            await anyio.sleep(0.01)
+        await anyio.sleep(0.01)
+        proceed.set()
+    assert [pinfo.peer_id for pinfo in pinfos] == [PEER_IDS[0]] * 5
+    assert len(fake_daemon.requests) == 1
+
+
+@pytest.mark.anyio
+async def test_dht_timeout_is_sent_to_the_daemon(fake_daemon):
+    async def reply_value(req, stream):
+        await fake_daemon.write_response(
+            stream, dht_response(p2pd_pb.DHTResponse.VALUE, value=b"value")
+        )
+        return True
+
+    fake_daemon.handler = reply_value
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr))
+    assert await dht.get_value(b"key", timeout=2.5) == b"value"
+    assert fake_daemon.requests[-1].dht.timeout == 3
+    assert await dht.get_value(b"other-key") == b"value"
+    assert not fake_daemon.requests[-1].dht.HasField("timeout")
+
+
+@pytest.mark.anyio
+async def test_dht_timeout_bounds_the_whole_query(fake_daemon):
+    fake_daemon.handler = make_streaming_handler(
+        fake_daemon, PEER_IDS, anyio.Event(), anyio.Event()
+    )
+    # the connector default applies when the call does not set a timeout
+    dht = DHTClient(DaemonConnector(fake_daemon.control_maddr, timeout=0.2))
+    peer_ids = []
+    with pytest.raises(TimeoutError):
+        async with aclosing(dht.find_providers_iter(b"cid", 10)) as pinfos:
+            async for pinfo in pinfos:
+                peer_ids.append(pinfo.peer_id)
+    assert peer_ids == [PEER_IDS[0]]
+    assert fake_daemon.requests[-1].dht.timeout == 1
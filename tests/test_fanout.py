@@ -0,0 +1,176 @@
+import anyio
+import pytest
+from helpers import make_msgs
+
+from p2pclient.control import DaemonConnector
+from p2pclient.exceptions import SlowConsumer
+from p2pclient.fanout import OverflowPolicy, TopicSubscriptionManager
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pubsub import PubSubClient
+from p2pclient.utils import encode_pbmsg
+
+
+class FakeTopic:
+    """Answers SUBSCRIBE requests and publishes messages to every subscriber."""
+
+    def __init__(self, fake_daemon):
+        self.fake_daemon = fake_daemon
+        self.streams = []
+        self.num_unsubscribed = 0
+        fake_daemon.handler = self.handle
+
+    async def handle(self, req, stream):
+        await stream.send(encode_pbmsg(p2pd_pb.Response(type=p2pd_pb.Response.OK)))
+        self.streams.append(stream)
+        try:
+            await stream.receive()
+        except (anyio.EndOfStream, anyio.BrokenResourceError):
+            pass
+        self.streams.remove(stream)
+        self.num_unsubscribed += 1
+        return False
+
+    async def publish(self, msgs):
+        # the client may see the OK before `handle` is done sending it
+        await wait_until(lambda: self.streams)
+        data = b"".join(encode_pbmsg(msg.to_pb()) for msg in msgs)
+        for stream in self.streams:
+            await stream.send(data)
+
+
+async def wait_until(predicate):
+    with anyio.fail_after(5):
+        while not predicate():
+            await anyio.sleep(0.01)
+
+
+@pytest.fixture
+def fake_topic(fake_daemon):
+    return FakeTopic(fake_daemon)
+
+
+@pytest.fixture
+def pubsub(fake_daemon):
+    return PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+
+
+@pytest.mark.anyio
+async def test_fanout_shares_one_daemon_subscription(fake_topic, pubsub):
+    msgs = make_msgs("topic", 3)
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        consumer_0 = await manager.subscribe("topic")
+        consumer_1 = await manager.subscribe("topic")
+        assert len(fake_topic.streams) == 1
+        await fake_topic.publish(msgs)
+        for consumer in (consumer_0, consumer_1):
+            for msg in msgs:
+                assert (await consumer.receive()).data == msg.data
+        await consumer_0.aclose()
+        assert manager.topics == ["topic"]
+        await consumer_1.aclose()
+        assert manager.topics == []
+        await wait_until(lambda: fake_topic.num_unsubscribed == 1)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "policy, expected_seqnos",
+    (
+        (OverflowPolicy.DROP_OLDEST, [3, 4]),
+        (OverflowPolicy.DROP_NEWEST, [0, 1]),
+    ),
+)
+async def test_fanout_drop_policies(fake_topic, pubsub, policy, expected_seqnos):
+    msgs = make_msgs("topic", 5)
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        slow = await manager.subscribe("topic", max_queue_size=2, policy=policy)
+        fast = await manager.subscribe("topic", max_queue_size=10)
+        await fake_topic.publish(msgs)
+        await wait_until(lambda: fast.queue_depth == 5)
+        assert slow.queue_depth == 2
+        assert [(await slow.receive()).seqno[0] for _ in range(2)] == expected_seqnos
+        stats = {stats.name: stats for stats in manager.stats()}
+        assert stats[slow.name].num_dropped == 3
+        assert stats[slow.name].max_queue_depth == 2
+        assert stats[fast.name].num_dropped == 0
+        assert stats[fast.name].num_received == 5
+
+
+@pytest.mark.anyio
+async def test_fanout_disconnects_slow_consumer(fake_topic, pubsub):
+    msgs = make_msgs("topic", 3)
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        slow = await manager.subscribe(
+            "topic", max_queue_size=2, policy=OverflowPolicy.DISCONNECT
+        )
+        fast = await manager.subscribe("topic")
+        await fake_topic.publish(msgs)
+        await wait_until(lambda: fast.queue_depth == 3)
+        assert slow.disconnected
+        with pytest.raises(SlowConsumer):
+            await slow.receive()
+        stats = manager.stats()
+    assert [stats.name for stats in stats] == [fast.name, slow.name]
+    assert stats[1].disconnected
+    assert stats[1].num_dropped == 3
+
+
+@pytest.mark.anyio
+async def test_fanout_slow_subscribe_holds_up_its_topic_only(
+    fake_daemon, fake_topic, pubsub
+):
+    release = anyio.Event()
+
+    async def handle(req, stream):
+        if req.pubsub.topic == "slow":
+            await release.wait()
+        return await fake_topic.handle(req, stream)
+
+    fake_daemon.handler = handle
+    consumers = []
+
+    async def subscribe_slow():
+        consumers.append(await manager.subscribe("slow"))
+
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(subscribe_slow)
+            task_group.start_soon(subscribe_slow)
+            await wait_until(lambda: fake_daemon.requests)
+            with anyio.fail_after(5):
+                await manager.subscribe("other")
+            release.set()
+        # the consumers of the slow topic share the daemon subscription
+        assert len(consumers) == 2
+        assert [req.pubsub.topic for req in fake_daemon.requests].count("slow") == 1
+
+
+@pytest.mark.anyio
+async def test_fanout_block_applies_backpressure(fake_topic, pubsub):
+    msgs = make_msgs("topic", 3)
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        blocking = await manager.subscribe("topic", max_queue_size=1)
+        other = await manager.subscribe("topic")
+        await fake_topic.publish(msgs)
+        await wait_until(lambda: other.queue_depth == 1)
+        await anyio.sleep(0.05)
+        # the blocked consumer holds up the topic until it makes room
+        assert other.queue_depth == 1
+        received = [(await blocking.receive()).data for _ in range(3)]
+        assert received == [msg.data for msg in msgs]
+        await wait_until(lambda: other.num_received == 3)
+
+
+@pytest.mark.anyio
+async def test_fanout_ends_consumers_when_daemon_closes(fake_topic, pubsub):
+    async with TopicSubscriptionManager(pubsub).run() as manager:
+        consumer = await manager.subscribe("topic")
+        await fake_topic.publish(make_msgs("topic", 1))
+        await fake_topic.streams[0].aclose()
+        assert [msg.seqno for msg in [msg async for msg in consumer]] == [b"\x00"]
+
+
+@pytest.mark.anyio
+async def test_fanout_requires_run(pubsub):
+    with pytest.raises(RuntimeError):
+        await TopicSubscriptionManager(pubsub).subscribe("topic")
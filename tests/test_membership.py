@@ -0,0 +1,84 @@
+import anyio
+import pytest
+
+from p2pclient.control import DaemonConnector
+from p2pclient.libp2p_stubs.peer.id import ID
+from p2pclient.membership import PeerEvent, TopicPeerTracker
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pubsub import PubSubClient
+
+PEER_A = ID(b"peer-a")
+PEER_B = ID(b"peer-b")
+
+
+class FakeMembership:
+    """Answers GET_TOPICS and LIST_PEERS from `peers`, a topic to peers mapping."""
+
+    def __init__(self, fake_daemon, peers):
+        self.fake_daemon = fake_daemon
+        self.peers = peers
+        self.subscribed = set(peers)
+        fake_daemon.handler = self.handle
+
+    async def handle(self, req, stream):
+        if req.pubsub.type == p2pd_pb.PSRequest.GET_TOPICS:
+            pubsub_resp = p2pd_pb.PSResponse(topics=sorted(self.subscribed))
+        else:
+            peer_ids = self.peers.get(req.pubsub.topic, ())
+            pubsub_resp = p2pd_pb.PSResponse(
+                peerIDs=[peer_id.to_bytes() for peer_id in peer_ids]
+            )
+        resp = p2pd_pb.Response(type=p2pd_pb.Response.OK, pubsub=pubsub_resp)
+        await self.fake_daemon.write_response(stream, resp)
+        return True
+
+
+@pytest.fixture
+def pubsub(fake_daemon):
+    return PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+
+
+@pytest.mark.anyio
+async def test_tracker_snapshot(fake_daemon, pubsub):
+    FakeMembership(fake_daemon, {"a": [PEER_A, PEER_B], "b": []})
+    tracker = TopicPeerTracker(pubsub, min_interval=60)
+    async with tracker.run():
+        assert tracker.topics == {"a", "b"}
+        assert tracker.peers("a") == {PEER_A, PEER_B}
+        assert tracker.has_peers("a")
+        assert not tracker.has_peers("b")
+        assert not tracker.has_peers("unknown")
+        num_requests = len(fake_daemon.requests)
+        tracker.peers("a")
+        assert len(fake_daemon.requests) == num_requests
+
+
+@pytest.mark.anyio
+async def test_tracker_events(fake_daemon, pubsub):
+    membership = FakeMembership(fake_daemon, {"a": [PEER_A]})
+    tracker = TopicPeerTracker(pubsub, min_interval=60)
+    async with tracker.run(), tracker.events() as events:
+        membership.peers["a"] = [PEER_B]
+        tracker.track("c")
+        membership.peers["c"] = [PEER_A]
+        with anyio.fail_after(5):
+            received = {await events.receive() for _ in range(3)}
+        assert received == {
+            PeerEvent("a", PEER_B, True),
+            PeerEvent("a", PEER_A, False),
+            PeerEvent("c", PEER_A, True),
+        }
+        assert tracker.peers("c") == {PEER_A}
+        assert tracker.interval == 60
+
+
+@pytest.mark.anyio
+async def test_tracker_backs_off_while_unchanged(fake_daemon, pubsub):
+    FakeMembership(fake_daemon, {"a": [PEER_A]})
+    tracker = TopicPeerTracker(pubsub, min_interval=0.01, max_interval=0.04)
+    async with tracker.run():
+        with anyio.fail_after(5):
+            while tracker.num_polls < 4:
+                await anyio.sleep(0.01)
+        assert tracker.interval == 0.04
+        assert not await tracker.poll()
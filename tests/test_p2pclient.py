@@ -3,15 +3,23 @@ import io
 import anyio
 import pytest
 from anyio.abc import SocketAttribute
+from async_generator import aclosing
 from google.protobuf.message import EncodeError
+from helpers import open_inbound_stream, wait_until
 from multiaddr import Multiaddr, protocols
 
 import p2pclient.pb.p2pd_pb2 as p2pd_pb
 from p2pclient import config
 from p2pclient.control import parse_conn_protocol
+from p2pclient.exceptions import ControlFailure
 from p2pclient.p2pclient import ControlClient, DaemonConnector
 from p2pclient.serialization import write_unsigned_varint
-from p2pclient.utils import read_pbmsg_safe, write_pbmsg
+from p2pclient.utils import (
+    get_unused_tcp_port,
+    read_pbmsg_safe,
+    write_pbmsg,
+    write_pbmsgs,
+)
 
 
 class MockReaderWriter(io.BytesIO):
@@ -23,8 +31,11 @@ class MockReaderWriter(io.BytesIO):
         await anyio.sleep(0)
         return self.read(n)
 
+    num_sends = 0
+
     async def send(self, b):
         await anyio.sleep(0)
+        self.num_sends += 1
         return self.write(b)
 
 
@@ -173,6 +184,7 @@ async def test_write_pbmsg(pb_msg, msg_bytes):
     s_write = MockReaderWriter()
     await write_pbmsg(s_write, pb_msg)
     assert msg_bytes == s_write.getvalue()
+    assert s_write.num_sends == 1
 
 
 @pytest.mark.parametrize(
@@ -189,3 +201,225 @@ async def test_write_pbmsg(pb_msg, msg_bytes):
 async def test_write_pbmsg_missing_fields(pb_msg):
     with pytest.raises(EncodeError):
         await write_pbmsg(MockReaderWriter(), pb_msg)
+
+
+@pytest.mark.anyio
+async def test_write_pbmsgs():
+    pb_msgs = [
+        p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY),
+        p2pd_pb.Request(type=p2pd_pb.Request.LIST_PEERS),
+        p2pd_pb.Response(type=p2pd_pb.Response.OK),
+    ]
+    s = MockReaderWriter()
+    await write_pbmsgs(s, pb_msgs)
+    assert s.num_sends == 1
+    s.seek(0, 0)
+    for expected in pb_msgs:
+        pb_msg = type(expected)()
+        await read_pbmsg_safe(s, pb_msg)
+        assert pb_msg == expected
+
+
+def make_listening_control():
+    port = get_unused_tcp_port()
+    control = ControlClient(
+        daemon_connector=DaemonConnector(),
+        listen_maddr=Multiaddr(f"/ip4/127.0.0.1/tcp/{port}"),
+    )
+    return control, port
+
+
+@pytest.mark.anyio
+async def test_dispatcher_keeps_payload_read_with_header():
+    control, port = make_listening_control()
+    payload = b"x" * 1000
+    received = []
+    done = anyio.Event()
+
+    async def handler(stream_info, stream):
+        received.append(stream_info.proto)
+        while sum(map(len, received[1:])) < len(payload):
+            received.append(await stream.receive())
+        done.set()
+
+    control.handlers["/proto"] = handler
+    async with control.listen():
+        async with await open_inbound_stream(port, "/proto", payload):
+            with anyio.fail_after(5):
+                await done.wait()
+    assert received[0] == "/proto"
+    assert b"".join(received[1:]) == payload
+
+
+@pytest.mark.anyio
+async def test_dispatcher_rejects_when_saturated():
+    control, port = make_listening_control()
+    started = anyio.Event()
+    release = anyio.Event()
+    rejected = False
+
+    async def handler(stream_info, stream):
+        started.set()
+        await release.wait()
+
+    control.handlers["/proto"] = handler
+    control.limit_handlers("/proto", max_concurrent=1)
+    async with control.listen():
+        async with await open_inbound_stream(port, "/proto"):
+            with anyio.fail_after(5):
+                await started.wait()
+            async with await open_inbound_stream(port, "/proto") as stream:
+                with anyio.fail_after(5):
+                    try:
+                        await stream.receive()
+                    except (anyio.EndOfStream, anyio.BrokenResourceError):
+                        rejected = True
+            release.set()
+    assert rejected
+    stats = control.handler_stats()["/proto"]
+    assert stats.num_admitted == 1
+    assert stats.num_rejected == 1
+
+
+async def is_closed_by_listener(stream):
+    with anyio.move_on_after(5):
+        try:
+            await stream.receive()
+        except (anyio.EndOfStream, anyio.BrokenResourceError):
+            return True
+    return False
+
+
+@pytest.mark.anyio
+async def test_dispatcher_closes_unknown_protocol():
+    control, port = make_listening_control()
+    done = anyio.Event()
+
+    async def handler(stream_info, stream):
+        done.set()
+
+    control.handlers["/known"] = handler
+    async with control.listen():
+        async with await open_inbound_stream(port, "/unknown") as stream:
+            closed = await is_closed_by_listener(stream)
+        # the listener still serves the other protocols
+        async with await open_inbound_stream(port, "/known"):
+            with anyio.move_on_after(5):
+                await done.wait()
+    assert closed
+    assert done.is_set()
+
+
+@pytest.mark.anyio
+async def test_accept(fake_daemon):
+    port = get_unused_tcp_port()
+    control = ControlClient(
+        daemon_connector=DaemonConnector(fake_daemon.control_maddr),
+        listen_maddr=Multiaddr(f"/ip4/127.0.0.1/tcp/{port}"),
+    )
+    payloads = []
+    pull = anyio.Event()
+
+    async def pull_streams():
+        async with aclosing(control.accept("/proto", max_pending=1)) as streams:
+            async for stream_info, stream in streams:
+                await pull.wait()
+                async with stream:
+                    payloads.append((stream_info.proto, await stream.receive()))
+                if len(payloads) == 3:
+                    return
+
+    async with control.listen():
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(pull_streams)
+            await wait_until(lambda: "/proto" in control.handlers)
+            inbound = [
+                await open_inbound_stream(port, "/proto", b"%d" % i) for i in range(3)
+            ]
+            # one stream is pulled and one is queued, the last one waits for room
+            await anyio.sleep(0.05)
+            pull.set()
+        for stream in inbound:
+            await stream.aclose()
+        # the daemon keeps routing /proto here, those streams are closed
+        async with await open_inbound_stream(port, "/proto") as stream:
+            closed = await is_closed_by_listener(stream)
+    assert sorted(payloads) == [("/proto", b"0"), ("/proto", b"1"), ("/proto", b"2")]
+    assert closed
+    assert fake_daemon.requests[0].streamHandler.proto == ["/proto"]
+
+
+async def noop_handler(stream_info, stream):
+    pass
+
+
+def make_stream_handler_replies(fake_daemon, accept_multi=True, reject=()):
+    async def handler(req, stream):
+        protos = list(req.streamHandler.proto)
+        if (len(protos) > 1 and not accept_multi) or set(protos) & set(reject):
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="no")
+            )
+        else:
+            resp = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    return handler
+
+
+PROTOS = {f"/proto/{i}": noop_handler for i in range(5)}
+
+
+@pytest.mark.anyio
+async def test_stream_handlers_one_request(fake_daemon):
+    fake_daemon.handler = make_stream_handler_replies(fake_daemon)
+    control = ControlClient(DaemonConnector(fake_daemon.control_maddr))
+    await control.stream_handlers(PROTOS)
+    assert control.handlers == PROTOS
+    assert len(fake_daemon.requests) == 1
+    assert list(fake_daemon.requests[0].streamHandler.proto) == list(PROTOS)
+
+
+@pytest.mark.anyio
+async def test_stream_handlers_fall_back_to_single_requests(fake_daemon):
+    fake_daemon.handler = make_stream_handler_replies(fake_daemon, accept_multi=False)
+    control = ControlClient(DaemonConnector(fake_daemon.control_maddr))
+    await control.stream_handlers(PROTOS)
+    assert control.handlers == PROTOS
+    assert len(fake_daemon.requests) == 1 + len(PROTOS)
+    assert sorted(req.streamHandler.proto[0] for req in fake_daemon.requests[1:]) == (
+        sorted(PROTOS)
+    )
+
+
+@pytest.mark.anyio
+async def test_stream_handlers_partly_registered(fake_daemon):
+    fake_daemon.handler = make_stream_handler_replies(
+        fake_daemon, accept_multi=False, reject=["/proto/3"]
+    )
+    control = ControlClient(DaemonConnector(fake_daemon.control_maddr))
+
+    async def previous_handler(stream_info, stream):
+        pass
+
+    control.handlers["/proto/3"] = previous_handler
+    with pytest.raises(ControlFailure, match=r"failed to register \['/proto/3'\]"):
+        await control.stream_handlers(PROTOS)
+    # the daemon routes the registered protocols here, they keep their handler
+    assert control.handlers == {**PROTOS, "/proto/3": previous_handler}
+
+
+@pytest.mark.anyio
+async def test_stream_handlers_installed_before_registration(fake_daemon):
+    installed = []
+    replies = make_stream_handler_replies(fake_daemon, accept_multi=False)
+
+    async def handler(req, stream):
+        installed.append(all(p in control.handlers for p in req.streamHandler.proto))
+        return await replies(req, stream)
+
+    fake_daemon.handler = handler
+    control = ControlClient(DaemonConnector(fake_daemon.control_maddr))
+    await control.stream_handlers(PROTOS)
+    assert installed == [True] * (1 + len(PROTOS))
@@ -10,11 +10,9 @@ from multiaddr import Multiaddr
 # Mark all tests in this module as integration tests
 pytestmark = pytest.mark.integration
 
-import p2pclient.pb.p2pd_pb2 as p2pd_pb
 from p2pclient.daemon import make_p2pd_pair_ip4, make_p2pd_pair_unix, try_until_success
 from p2pclient.exceptions import ControlFailure
 from p2pclient.libp2p_stubs.peer.id import ID
-from p2pclient.utils import read_pbmsg_safe
 
 # Mark all tests in this module as integration tests
 pytestmark = pytest.mark.integration
@@ -721,21 +719,17 @@ async def test_client_pubsub_subscribe(p2pcs):
     assert peer_id_1 in await p2pcs[0].pubsub_list_peers(topic)
     # test case: publish, and both clients receive data
     await p2pcs[0].pubsub_publish(topic, data)
-    pubsub_msg_0 = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_0, pubsub_msg_0)
+    pubsub_msg_0 = await stream_0.receive()
     assert pubsub_msg_0.data == data
-    pubsub_msg_1 = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_1, pubsub_msg_1)
+    pubsub_msg_1 = await stream_1.receive()
     assert pubsub_msg_1.data == data
     # test case: publish more data
     another_data_0 = b"another_data_0"
     another_data_1 = b"another_data_1"
     await p2pcs[0].pubsub_publish(topic, another_data_0)
     await p2pcs[0].pubsub_publish(topic, another_data_1)
-    pubsub_msg_1_0 = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_1, pubsub_msg_1_0)
-    pubsub_msg_1_1 = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_1, pubsub_msg_1_1)
+    pubsub_msg_1_0 = await stream_1.receive()
+    pubsub_msg_1_1 = await stream_1.receive()
     assert set([pubsub_msg_1_0.data, pubsub_msg_1_1.data]) == set(
         [another_data_0, another_data_1]
     )
@@ -744,18 +738,17 @@ async def test_client_pubsub_subscribe(p2pcs):
     await p2pcs[0].pubsub_subscribe(another_topic)
     stream_1_another = await p2pcs[1].pubsub_subscribe(another_topic)
     await p2pcs[0].pubsub_publish(another_topic, another_data_0)
-    pubsub_msg_1_another = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_1_another, pubsub_msg_1_another)
+    pubsub_msg_1_another = await stream_1_another.receive()
     assert pubsub_msg_1_another.data == another_data_0
+    assert pubsub_msg_1_another.topic_ids == (another_topic,)
     # test case: test `from`
-    assert ID(getattr(pubsub_msg_1_1, "from")) == peer_id_0
+    assert pubsub_msg_1_1.from_id == peer_id_0
     # test case: test `from`, when it is sent through 1 hop(p2pcs[1])
     stream_2 = await p2pcs[2].pubsub_subscribe(topic)
     another_data_2 = b"another_data_2"
     await p2pcs[0].pubsub_publish(topic, another_data_2)
-    pubsub_msg_2_0 = p2pd_pb.PSMessage()
-    await read_pbmsg_safe(stream_2, pubsub_msg_2_0)
-    assert ID(getattr(pubsub_msg_2_0, "from")) == peer_id_0
+    pubsub_msg_2_0 = await stream_2.receive()
+    assert pubsub_msg_2_0.from_id == peer_id_0
     # test case: unsubscribe by closing the stream
     await stream_0.aclose()
     await anyio.sleep(0)
@@ -0,0 +1,245 @@
+import anyio
+import pytest
+
+from p2pclient import pipeline as pipeline_module
+from p2pclient.control import DaemonConnector
+from p2pclient.exceptions import ControlFailure
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pipeline import PendingResponse, is_pipelinable, is_quick
+from p2pclient.pubsub import PubSubClient
+
+
+def make_publish_request(data):
+    pubsub_req = p2pd_pb.PSRequest(
+        type=p2pd_pb.PSRequest.PUBLISH, topic="topic", data=data
+    )
+    return p2pd_pb.Request(type=p2pd_pb.Request.PUBSUB, pubsub=pubsub_req)
+
+
+@pytest.mark.parametrize(
+    "req, expected",
+    (
+        (p2pd_pb.Request(type=p2pd_pb.Request.LIST_PEERS), True),
+        (make_publish_request(b"data"), True),
+        (p2pd_pb.Request(type=p2pd_pb.Request.STREAM_OPEN), False),
+        (
+            p2pd_pb.Request(
+                type=p2pd_pb.Request.PUBSUB,
+                pubsub=p2pd_pb.PSRequest(type=p2pd_pb.PSRequest.SUBSCRIBE),
+            ),
+            False,
+        ),
+        (
+            p2pd_pb.Request(
+                type=p2pd_pb.Request.DHT,
+                dht=p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.FIND_PROVIDERS),
+            ),
+            False,
+        ),
+        (
+            p2pd_pb.Request(
+                type=p2pd_pb.Request.DHT,
+                dht=p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.PUT_VALUE),
+            ),
+            True,
+        ),
+    ),
+)
+def test_is_pipelinable(req, expected):
+    assert is_pipelinable(req) == expected
+
+
+@pytest.mark.parametrize(
+    "req, expected",
+    (
+        (p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY), True),
+        (make_publish_request(b"data"), True),
+        (
+            p2pd_pb.Request(
+                type=p2pd_pb.Request.CONNMANAGER,
+                connManager=p2pd_pb.ConnManagerRequest(
+                    type=p2pd_pb.ConnManagerRequest.TAG_PEER
+                ),
+            ),
+            True,
+        ),
+        (p2pd_pb.Request(type=p2pd_pb.Request.CONNECT), False),
+        (
+            p2pd_pb.Request(
+                type=p2pd_pb.Request.DHT,
+                dht=p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.PUT_VALUE),
+            ),
+            False,
+        ),
+    ),
+)
+def test_is_quick(req, expected):
+    assert is_quick(req) == expected
+
+
+@pytest.mark.anyio
+async def test_pipelined_connector_shares_one_connection(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    pubsub = PubSubClient(connector)
+    async with connector.pipelined(max_in_flight=8):
+        async with anyio.create_task_group() as tg:
+            for i in range(50):
+                tg.start_soon(pubsub.publish, "topic", str(i).encode())
+    assert fake_daemon.num_connections == 1
+    assert sorted(int(req.pubsub.data) for req in fake_daemon.requests) == list(
+        range(50)
+    )
+
+
+@pytest.mark.anyio
+async def test_pipeline_matches_responses_in_order(fake_daemon):
+    async def echo_error(req, stream):
+        resp = p2pd_pb.Response(
+            type=p2pd_pb.Response.ERROR,
+            error=p2pd_pb.ErrorResponse(msg=req.pubsub.data.decode()),
+        )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = echo_error
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined() as pipeline:
+        pendings = [
+            await pipeline.submit(make_publish_request(str(i).encode()))
+            for i in range(20)
+        ]
+        resps = [await pending.wait() for pending in pendings]
+    assert [resp.error.msg for resp in resps] == [str(i) for i in range(20)]
+
+
+@pytest.mark.anyio
+async def test_pipeline_bounds_requests_in_flight(fake_daemon):
+    release = anyio.Event()
+
+    async def reply_after_release(req, stream):
+        await release.wait()
+        return await fake_daemon.reply_ok(req, stream)
+
+    fake_daemon.handler = reply_after_release
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined(max_in_flight=2) as pipeline:
+        await pipeline.submit(make_publish_request(b"0"))
+        await pipeline.submit(make_publish_request(b"1"))
+        with anyio.move_on_after(0.1) as scope:
+            await pipeline.submit(make_publish_request(b"2"))
+        assert scope.cancel_called
+        assert pipeline.num_in_flight == 2
+        release.set()
+        pending = await pipeline.submit(make_publish_request(b"3"))
+        await pending.wait()
+    assert pipeline.num_in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_pipeline_fails_pending_requests_when_daemon_hangs_up(fake_daemon):
+    async def hang_up(req, stream):
+        return False
+
+    fake_daemon.handler = hang_up
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined() as pipeline:
+        pending = await pipeline.submit(make_publish_request(b"data"))
+        with pytest.raises(anyio.IncompleteRead):
+            await pending.wait()
+        with pytest.raises(ControlFailure):
+            await pipeline.submit(make_publish_request(b"data"))
+
+
+@pytest.mark.anyio
+async def test_pipeline_submit_many(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined(max_in_flight=4) as pipeline:
+        reqs = [make_publish_request(str(i).encode()) for i in range(10)]
+        pendings = await pipeline.submit_many(reqs)
+        for pending in pendings:
+            assert (await pending.wait()).type == p2pd_pb.Response.OK
+    assert [req.pubsub.data for req in fake_daemon.requests] == [
+        str(i).encode() for i in range(10)
+    ]
+
+
+@pytest.mark.anyio
+async def test_pipeline_submit_many_to_given_pendings(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    done = []
+    async with connector.pipelined() as pipeline:
+        pendings = [PendingResponse() for _ in range(3)]
+        for pending in pendings:
+            pending.add_done_callback(done.append)
+        reqs = [make_publish_request(b"data") for _ in pendings]
+        assert await pipeline.submit_many(reqs, pendings) == pendings
+        with pytest.raises(ValueError):
+            await pipeline.submit_many(reqs, pendings[:1])
+    assert done == pendings
+    assert all(pending.result().type == p2pd_pb.Response.OK for pending in pendings)
+
+
+@pytest.mark.anyio
+async def test_pipelined_connector_routes_quick_requests_only(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined():
+        await connector.request(make_publish_request(b"0"))
+        await connector.request(p2pd_pb.Request(type=p2pd_pb.Request.CONNECT))
+        await connector.request(make_publish_request(b"1"))
+    # the dial got a connection of its own
+    assert fake_daemon.num_connections == 2
+
+
+@pytest.mark.anyio
+async def test_pipeline_waits_until_request_deadline(fake_daemon, monkeypatch):
+    monkeypatch.setattr(pipeline_module, "DEFAULT_READ_TIMEOUT", 0.05)
+
+    async def reply_late(req, stream):
+        await anyio.sleep(0.2)
+        return await fake_daemon.reply_ok(req, stream)
+
+    fake_daemon.handler = reply_late
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined():
+        resp = await connector.request(make_publish_request(b"data"), timeout=5)
+        assert resp.type == p2pd_pb.Response.OK
+        # without a deadline, the response may only stall for the default timeout
+        with pytest.raises(TimeoutError):
+            await connector.request(make_publish_request(b"data"))
+
+
+@pytest.mark.anyio
+async def test_pipeline_survives_caller_timeout(fake_daemon):
+    async def reply_first_late(req, stream):
+        if len(fake_daemon.requests) == 1:
+            await anyio.sleep(0.5)
+        return await fake_daemon.reply_ok(req, stream)
+
+    fake_daemon.handler = reply_first_late
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined() as pipeline:
+        with pytest.raises(TimeoutError):
+            await connector.request(make_publish_request(b"slow"), timeout=0.1)
+        # the late response is read and dropped, the next caller gets its own
+        resp = await connector.request(make_publish_request(b"next"))
+        assert resp.type == p2pd_pb.Response.OK
+        assert pipeline.usable
+    assert fake_daemon.num_connections == 1
+
+
+@pytest.mark.anyio
+async def test_pipelined_connector_falls_back_when_pipeline_failed(fake_daemon):
+    async def hang_up_first_connection(req, stream):
+        if fake_daemon.num_connections == 1:
+            return False
+        return await fake_daemon.reply_ok(req, stream)
+
+    fake_daemon.handler = hang_up_first_connection
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    async with connector.pipelined() as pipeline:
+        with pytest.raises(anyio.IncompleteRead):
+            await connector.request(make_publish_request(b"0"))
+        assert not pipeline.usable
+        resp = await connector.request(make_publish_request(b"1"))
+        assert resp.type == p2pd_pb.Response.OK
+    assert fake_daemon.num_connections == 2
@@ -0,0 +1,89 @@
+import anyio
+import pytest
+
+from p2pclient.control import DaemonConnector
+from p2pclient.exceptions import ControlFailure
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pool import ConnectionPool
+from p2pclient.utils import raise_if_failed, write_pbmsg
+
+REQ_LIST_PEERS = p2pd_pb.Request(type=p2pd_pb.Request.LIST_PEERS)
+
+
+@pytest.mark.anyio
+async def test_connector_without_pool_opens_a_connection_per_request(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    for _ in range(3):
+        resp = await connector.request(REQ_LIST_PEERS)
+        raise_if_failed(resp)
+    assert fake_daemon.num_connections == 3
+
+
+@pytest.mark.anyio
+async def test_connector_pool_reuses_connections(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr, pool_max_size=2)
+    for _ in range(5):
+        raise_if_failed(await connector.request(REQ_LIST_PEERS))
+    assert fake_daemon.num_connections == 1
+    assert len(fake_daemon.requests) == 5
+    assert connector.pool.num_reused == 4
+    await connector.aclose()
+    assert connector.pool.num_idle == 0
+
+
+@pytest.mark.anyio
+async def test_connector_pool_discards_connections_after_errors(fake_daemon):
+    async def reply_error(req, stream):
+        resp = p2pd_pb.Response(
+            type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="boom")
+        )
+        await write_pbmsg(stream, resp)
+        return True
+
+    fake_daemon.handler = reply_error
+    connector = DaemonConnector(fake_daemon.control_maddr, pool_max_size=2)
+    for _ in range(2):
+        with pytest.raises(ControlFailure):
+            raise_if_failed(await connector.request(REQ_LIST_PEERS))
+    assert fake_daemon.num_connections == 2
+    assert connector.pool.num_idle == 0
+
+
+@pytest.mark.anyio
+async def test_connector_pool_health_check_drops_closed_connections(fake_daemon):
+    async def reply_and_hang_up(req, stream):
+        await fake_daemon.reply_ok(req, stream)
+        return False
+
+    fake_daemon.handler = reply_and_hang_up
+    connector = DaemonConnector(fake_daemon.control_maddr, pool_max_size=2)
+    raise_if_failed(await connector.request(REQ_LIST_PEERS))
+    # let the daemon side close the connection
+    await anyio.sleep(0.1)
+    raise_if_failed(await connector.request(REQ_LIST_PEERS))
+    assert fake_daemon.num_connections == 2
+    assert connector.pool.num_reused == 0
+    await connector.aclose()
+
+
+@pytest.mark.anyio
+async def test_pool_idle_expiry_keeps_min_size(fake_daemon):
+    connector = DaemonConnector(fake_daemon.control_maddr)
+    pool = ConnectionPool(
+        connector.open_connection, min_size=1, max_size=4, idle_timeout=0.0
+    )
+    streams = [await pool.acquire() for _ in range(3)]
+    for stream in streams:
+        await pool.release(stream)
+    await anyio.sleep(0.01)
+    await pool.release(await pool.acquire())
+    assert pool.num_idle == 1
+    await pool.aclose()
+
+
+def test_pool_invalid_sizes():
+    async def connect():
+        raise NotImplementedError
+
+    with pytest.raises(ValueError):
+        ConnectionPool(connect, min_size=3, max_size=2)
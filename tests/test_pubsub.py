@@ -0,0 +1,214 @@
+import anyio
+import pytest
+from helpers import PEER_ID, PublishRecorder, make_msgs, make_subscribe_handler
+
+from p2pclient.control import DaemonConnector
+from p2pclient.exceptions import ControlFailure
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pubsub import PubSubClient
+from p2pclient.serialization import FramedStream
+from p2pclient.utils import encode_pbmsg
+
+
+@pytest.mark.anyio
+async def test_subscription_iterates_messages(fake_daemon):
+    msgs = make_msgs("topic", 3)
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with await pubsub.subscribe("topic") as sub:
+        received = [msg async for msg in sub]
+    assert [msg.data for msg in received] == [msg.data for msg in msgs]
+    assert all(msg.from_id == PEER_ID for msg in received)
+    assert all(msg.topic_ids == ("topic",) for msg in received)
+
+
+@pytest.mark.anyio
+async def test_subscription_receive_buffered(fake_daemon):
+    msgs = make_msgs("topic", 5)
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs, anyio.Event())
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with await pubsub.subscribe("topic") as sub:
+        first = await sub.receive()
+        # the rest came with the same read
+        rest = sub.receive_buffered()
+        assert [msg.seqno for msg in [first] + rest] == [msg.seqno for msg in msgs]
+        assert sub.receive_buffered() == []
+
+
+@pytest.mark.anyio
+async def test_subscription_close_unsubscribes(fake_daemon):
+    unsubscribed = anyio.Event()
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, [], unsubscribed)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with await pubsub.subscribe("topic"):
+        pass
+    with anyio.fail_after(5):
+        await unsubscribed.wait()
+
+
+@pytest.mark.anyio
+async def test_subscribe_error(fake_daemon):
+    async def reply_error(req, stream):
+        resp = p2pd_pb.Response(
+            type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="no pubsub")
+        )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = reply_error
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    with pytest.raises(ControlFailure):
+        await pubsub.subscribe("topic")
+
+
+@pytest.mark.anyio
+async def test_publisher_batches_publishes(fake_daemon, monkeypatch):
+    recorder = PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    num_msgs = 100
+    num_sends = 0
+    send = FramedStream.send
+
+    async def counting_send(self, item):
+        nonlocal num_sends
+        num_sends += 1
+        await send(self, item)
+
+    monkeypatch.setattr(FramedStream, "send", counting_send)
+    async with pubsub.publisher(max_batch_size=16) as publisher:
+        async with anyio.create_task_group() as tg:
+            for i in range(num_msgs):
+                tg.start_soon(publisher.publish, "topic", b"%d" % i)
+        await publisher.flush()
+        assert publisher.num_outstanding == 0
+        assert publisher.num_published == num_msgs
+    assert sorted(recorder.published) == sorted(b"%d" % i for i in range(num_msgs))
+    assert fake_daemon.num_connections == 1
+    assert num_sends <= num_msgs // 16 + 2
+
+
+@pytest.mark.anyio
+async def test_publisher_in_order_acks(fake_daemon):
+    PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with pubsub.publisher() as publisher:
+        pendings = [await publisher.publish("topic", b"%d" % i) for i in range(10)]
+        for pending in pendings:
+            assert (await pending.wait()).type == p2pd_pb.Response.OK
+
+
+@pytest.mark.anyio
+async def test_publisher_flush_reports_failures(fake_daemon):
+    PublishRecorder(fake_daemon, fail_data=b"bad")
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with pubsub.publisher() as publisher:
+        await publisher.publish("topic", b"good")
+        pending = await publisher.publish("topic", b"bad")
+        with pytest.raises(ControlFailure):
+            await publisher.flush()
+        assert (await pending.wait()).type == p2pd_pb.Response.ERROR
+        assert publisher.num_failed == 1
+        assert publisher.num_published == 1
+        # reported once
+        await publisher.flush()
+
+
+@pytest.mark.anyio
+async def test_publisher_closed(fake_daemon):
+    PublishRecorder(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with pubsub.publisher(num_connections=2) as publisher:
+        await publisher.publish("topic", b"data")
+    assert publisher.num_published == 1
+    assert fake_daemon.num_connections == 2
+    with pytest.raises(anyio.ClosedResourceError):
+        await publisher.publish("topic", b"data")
+
+
+class FakeTopics:
+    """Answers SUBSCRIBE requests, keeping each topic's connection to send on."""
+
+    def __init__(self, fake_daemon):
+        self.streams = {}
+        self.unsubscribed = []
+        fake_daemon.handler = self.handle
+
+    async def handle(self, req, stream):
+        topic = req.pubsub.topic
+        await stream.send(encode_pbmsg(p2pd_pb.Response(type=p2pd_pb.Response.OK)))
+        self.streams[topic] = stream
+        try:
+            await stream.receive()
+        except (
+            anyio.EndOfStream,
+            anyio.BrokenResourceError,
+            anyio.ClosedResourceError,
+        ):
+            pass
+        del self.streams[topic]
+        self.unsubscribed.append(topic)
+        return False
+
+    async def wait_subscribed(self, topic):
+        with anyio.fail_after(5):
+            while topic not in self.streams:
+                await anyio.sleep(0.01)
+
+    async def publish(self, topic, msgs):
+        await self.wait_subscribed(topic)
+        data = b"".join(encode_pbmsg(msg.to_pb()) for msg in msgs)
+        await self.streams[topic].send(data)
+
+
+@pytest.mark.anyio
+async def test_subscribe_many(fake_daemon):
+    fake_topics = FakeTopics(fake_daemon)
+    msgs = {topic: make_msgs(topic, 3) for topic in ("a", "b", "c")}
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with pubsub.subscribe_many(msgs) as sub:
+        assert sub.topics == ["a", "b", "c"]
+        for topic, topic_msgs in msgs.items():
+            await fake_topics.publish(topic, topic_msgs)
+        received = {"a": [], "b": [], "c": []}
+        for _ in range(9):
+            topic, msg = await sub.receive()
+            received[topic].append(msg.data)
+    assert received == {
+        topic: [msg.data for msg in topic_msgs] for topic, topic_msgs in msgs.items()
+    }
+    with anyio.fail_after(5):
+        while len(fake_topics.unsubscribed) < 3:
+            await anyio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_subscribe_many_add_and_remove_topics(fake_daemon):
+    fake_topics = FakeTopics(fake_daemon)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with pubsub.subscribe_many() as sub:
+        await sub.add_topic("a")
+        await sub.add_topic("b")
+        await sub.add_topic("a")
+        assert sub.topics == ["a", "b"]
+        await fake_topics.publish("a", make_msgs("a", 1))
+        topic, _ = await sub.receive()
+        assert topic == "a"
+
+        await fake_topics.wait_subscribed("b")
+        await sub.remove_topic("a")
+        assert sub.topics == ["b"]
+        await fake_topics.publish("b", make_msgs("b", 1))
+        topic, _ = await sub.receive()
+        assert topic == "b"
+
+        # the daemon ends a topic
+        await fake_topics.streams["b"].aclose()
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(sub.receive)
+            with anyio.fail_after(5):
+                while sub.topics:
+                    await anyio.sleep(0.01)
+            tg.cancel_scope.cancel()
+
+    with pytest.raises(anyio.ClosedResourceError):
+        await sub.receive()
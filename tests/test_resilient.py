@@ -0,0 +1,63 @@
+import anyio
+import pytest
+from helpers import make_msgs, make_subscribe_handler
+
+from p2pclient.control import DaemonConnector
+from p2pclient.dedup import DuplicateFilter
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.pubsub import PubSubClient
+from p2pclient.resilient import ResilientSubscription
+
+
+def make_flaky_handler(fake_daemon, replies):
+    """Answer each SUBSCRIBE with the next of `replies`: messages, or `None` to fail."""
+    replies = iter(replies)
+
+    async def handler(req, stream):
+        msgs = next(replies)
+        if msgs is None:
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="down")
+            )
+            await fake_daemon.write_response(stream, resp)
+            return False
+        unsubscribed = anyio.Event() if msgs[-1].seqno == b"\x03" else None
+        return await make_subscribe_handler(fake_daemon, msgs, unsubscribed)(
+            req, stream
+        )
+
+    return handler
+
+
+@pytest.mark.anyio
+async def test_resubscribes_after_eof(fake_daemon):
+    msgs = make_msgs("topic", 4)
+    fake_daemon.handler = make_flaky_handler(
+        fake_daemon, [msgs[:2], None, None, msgs[1:]]
+    )
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    dedup = DuplicateFilter()
+    sub = ResilientSubscription(pubsub, "topic", dedup=dedup, min_backoff=0.01)
+    async with sub:
+        with anyio.fail_after(5):
+            received = [(await sub.receive()).seqno for _ in range(4)]
+    assert received == [msg.seqno for msg in msgs]
+    # the message delivered again by the new subscription was dropped
+    assert dedup.num_dropped == 1
+    assert sub.num_resubscribes == 1
+    assert len(sub.outages) == 1
+    outage = sub.outages[0]
+    assert outage.num_attempts == 3
+    assert "down" in outage.error
+    assert sub.downtime == outage.duration > 0
+    assert not sub.connected
+
+
+@pytest.mark.anyio
+async def test_closed(fake_daemon):
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, [], anyio.Event())
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    async with ResilientSubscription(pubsub, "topic") as sub:
+        assert sub.connected
+    assert [msg async for msg in sub] == []
+    assert not sub.outages
@@ -3,7 +3,13 @@ import io
 import anyio
 import pytest
 
-from p2pclient.serialization import read_unsigned_varint, write_unsigned_varint
+from p2pclient.serialization import (
+    FramedReader,
+    decode_unsigned_varint,
+    encode_unsigned_varint,
+    read_unsigned_varint,
+    write_unsigned_varint,
+)
 
 pairs_int_varint_valid = (
     (0, b"\x00"),
@@ -24,12 +30,25 @@ pairs_int_varint_overflow = (
 
 
 class MockReaderWriter(io.BytesIO):
+    num_receives = 0
+
     async def receive_exactly(self, n):
         await anyio.sleep(0)
         return self.read(n)
 
+    async def receive(self, n=65536):
+        await anyio.sleep(0)
+        self.num_receives += 1
+        data = self.read(n)
+        if not data:
+            raise anyio.EndOfStream
+        return data
+
+    num_sends = 0
+
     async def send(self, b):
         await anyio.sleep(0)
+        self.num_sends += 1
         return self.write(b)
 
 
@@ -39,6 +58,30 @@ async def test_write_unsigned_varint(integer, var_integer):
     s = MockReaderWriter()
     await write_unsigned_varint(s, integer)
     assert s.getvalue() == var_integer
+    assert s.num_sends == 1
+
+
+@pytest.mark.parametrize("integer, var_integer", pairs_int_varint_valid)
+def test_encode_unsigned_varint(integer, var_integer):
+    assert encode_unsigned_varint(integer) == var_integer
+
+
+@pytest.mark.parametrize("integer, var_integer", pairs_int_varint_valid)
+def test_decode_unsigned_varint(integer, var_integer):
+    data = b"\xff" + var_integer + b"rest"
+    assert decode_unsigned_varint(data, 1) == (integer, 1 + len(var_integer))
+
+
+@pytest.mark.parametrize("var_integer", (b"", b"\x80", b"\xff\xff"))
+def test_decode_unsigned_varint_truncated(var_integer):
+    with pytest.raises(ValueError):
+        decode_unsigned_varint(var_integer)
+
+
+@pytest.mark.parametrize("var_integer", tuple(i[1] for i in pairs_int_varint_overflow))
+def test_decode_unsigned_varint_overflow(var_integer):
+    with pytest.raises(ValueError):
+        decode_unsigned_varint(var_integer)
 
 
 @pytest.mark.parametrize("integer", tuple(i[0] for i in pairs_int_varint_overflow))
@@ -86,3 +129,57 @@ async def test_read_write_unsigned_varint_max_bits_edge(max_bits):
         s.seek(0, 0)
         result = await read_unsigned_varint(s, max_bits=max_bits)
         assert integer == result
+
+
+def make_frames(*payloads):
+    return b"".join(encode_unsigned_varint(len(p)) + p for p in payloads)
+
+
+@pytest.mark.anyio
+async def test_framed_reader_read_frame():
+    payloads = (b"", b"a", b"b" * 200, b"c" * 70000)
+    s = MockReaderWriter(make_frames(*payloads) + b"rest")
+    reader = FramedReader(s)
+    for payload in payloads:
+        assert await reader.read_frame() == payload
+    # bytes read past the last frame are kept
+    assert reader.buffer == b"rest"
+    assert await reader.receive() == b"rest"
+    with pytest.raises(anyio.EndOfStream):
+        await reader.receive()
+
+
+@pytest.mark.anyio
+async def test_framed_reader_decodes_buffered_frames_without_io():
+    s = MockReaderWriter(make_frames(b"1", b"22", b"333") + b"\x05ab")
+    reader = FramedReader(s)
+    assert await reader.read_frame() == b"1"
+    assert s.num_receives == 1
+    assert reader.read_buffered_frame() == b"22"
+    assert reader.read_buffered_frame() == b"333"
+    # incomplete frames are left in the buffer
+    assert reader.read_buffered_frame() is None
+    assert reader.buffer == b"\x05ab"
+    assert s.num_receives == 1
+
+
+@pytest.mark.parametrize("integer, var_integer", pairs_int_varint_valid)
+@pytest.mark.anyio
+async def test_framed_reader_read_unsigned_varint(integer, var_integer):
+    reader = FramedReader(MockReaderWriter(var_integer))
+    assert await read_unsigned_varint(reader) == integer
+
+
+@pytest.mark.parametrize("var_integer", tuple(i[1] for i in pairs_int_varint_overflow))
+@pytest.mark.anyio
+async def test_framed_reader_read_unsigned_varint_overflow(var_integer):
+    reader = FramedReader(MockReaderWriter(var_integer))
+    with pytest.raises(ValueError):
+        await reader.read_unsigned_varint()
+
+
+@pytest.mark.anyio
+async def test_framed_reader_incomplete_frame():
+    reader = FramedReader(MockReaderWriter(b"\x05abc"))
+    with pytest.raises(anyio.IncompleteRead):
+        await reader.read_frame()
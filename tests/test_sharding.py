@@ -0,0 +1,129 @@
+import os
+import signal
+
+import anyio
+import pytest
+from helpers import open_inbound_stream, wait_until
+from multiaddr import Multiaddr
+
+from p2pclient.control import ControlClient, DaemonConnector
+from p2pclient.exceptions import ControlFailure
+from p2pclient.pb import p2pd_pb2 as p2pd_pb
+from p2pclient.sharding import ShardedListener
+from p2pclient.utils import get_unused_tcp_port
+
+NUM_WORKERS = 2
+
+
+async def reply_pid(stream_info, stream):
+    await stream.send(b"%d" % os.getpid())
+    await stream.aclose()
+
+
+async def reply_proto(stream_info, stream):
+    await stream.send(stream_info.proto.encode())
+    await stream.aclose()
+
+
+async def request(port, proto):
+    """Open an inbound stream, retrying while no worker is listening yet."""
+    with anyio.fail_after(30):
+        while True:
+            try:
+                stream = await open_inbound_stream(port, proto)
+            except OSError:
+                await anyio.sleep(0.05)
+                continue
+            async with stream:
+                return await stream.receive()
+
+
+@pytest.fixture
+def sharded(fake_daemon):
+    port = get_unused_tcp_port()
+    control = ControlClient(
+        daemon_connector=DaemonConnector(fake_daemon.control_maddr),
+        listen_maddr=Multiaddr(f"/ip4/127.0.0.1/tcp/{port}"),
+    )
+    return ShardedListener(control, num_workers=NUM_WORKERS, restart_delay=0.01), port
+
+
+@pytest.mark.anyio
+async def test_sharded_listener_spreads_streams(sharded):
+    sharded, port = sharded
+    await sharded.stream_handler("/pid", reply_pid)
+    async with sharded.listen():
+        pids = set()
+        with anyio.fail_after(30):
+            while len(pids) < NUM_WORKERS:
+                pids.add(int(await request(port, "/pid")))
+        assert pids == set(sharded.pids)
+        assert os.getpid() not in pids
+
+        # registered after the workers started
+        await sharded.stream_handlers({"/a": reply_proto, "/b": reply_proto})
+        assert await request(port, "/a") == b"/a"
+        assert await request(port, "/b") == b"/b"
+    assert sharded.pids == []
+
+
+@pytest.mark.anyio
+async def test_sharded_listener_restarts_workers(sharded):
+    sharded, port = sharded
+    await sharded.stream_handler("/pid", reply_pid)
+    async with sharded.listen():
+        await wait_until(lambda: len(sharded.pids) == NUM_WORKERS)
+        killed = sharded.pids[0]
+        os.kill(killed, signal.SIGKILL)
+        with anyio.fail_after(30):
+            while sharded.num_restarts < 1 or len(sharded.pids) < NUM_WORKERS:
+                await anyio.sleep(0.05)
+        assert killed not in sharded.pids
+        assert int(await request(port, "/pid")) in sharded.pids
+
+
+def test_sharded_listener_needs_tcp():
+    control = ControlClient(DaemonConnector(), listen_maddr=Multiaddr("/unix/tmp/sock"))
+    with pytest.raises(ValueError):
+        ShardedListener(control)
+
+
+@pytest.mark.anyio
+async def test_sharded_listener_replicates_registered_protocols(sharded, fake_daemon):
+    sharded, _ = sharded
+
+    async def reject_b(req, stream):
+        protos = list(req.streamHandler.proto)
+        if "/b" in protos:
+            resp = p2pd_pb.Response(
+                type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="no")
+            )
+        else:
+            resp = p2pd_pb.Response(type=p2pd_pb.Response.OK)
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    fake_daemon.handler = reject_b
+    with pytest.raises(ControlFailure):
+        await sharded.stream_handlers({"/a": reply_proto, "/b": reply_proto})
+    assert sharded.handlers == {"/a": reply_proto}
+
+
+@pytest.mark.anyio
+async def test_sharded_listener_undoes_rejected_handler(sharded, fake_daemon):
+    sharded, _ = sharded
+
+    async def reject(req, stream):
+        resp = p2pd_pb.Response(
+            type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="no")
+        )
+        await fake_daemon.write_response(stream, resp)
+        return True
+
+    await sharded.stream_handler("/a", reply_pid)
+    fake_daemon.handler = reject
+    with pytest.raises(ControlFailure):
+        await sharded.stream_handler("/a", reply_proto)
+    with pytest.raises(ControlFailure):
+        await sharded.stream_handler("/b", reply_proto)
+    assert sharded.handlers == {"/a": reply_pid}
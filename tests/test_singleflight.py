@@ -0,0 +1,102 @@
+import anyio
+import pytest
+
+from p2pclient.singleflight import SingleFlight
+
+
+class SlowCall:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.num_calls = 0
+        self.started = anyio.Event()
+        self.proceed = anyio.Event()
+
+    async def __call__(self):
+        self.num_calls += 1
+        self.started.set()
+        await self.proceed.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+@pytest.mark.anyio
+async def test_single_flight_shares_result():
+    single_flight = SingleFlight()
+    fn = SlowCall(result="result")
+    results = []
+
+    async def call():
+        results.append(await single_flight.do("key", fn))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(5):
+            tg.start_soon(call)
+        await fn.started.wait()
+        await anyio.sleep(0.01)
+        assert single_flight.num_in_flight == 1
+        fn.proceed.set()
+    assert results == ["result"] * 5
+    assert fn.num_calls == 1
+    assert single_flight.num_coalesced == 4
+    assert single_flight.num_in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_single_flight_shares_error():
+    single_flight = SingleFlight()
+    fn = SlowCall(error=ValueError("boom"))
+    errors = []
+
+    async def call():
+        try:
+            await single_flight.do("key", fn)
+        except ValueError as e:
+            errors.append(e)
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(3):
+            tg.start_soon(call)
+        await fn.started.wait()
+        await anyio.sleep(0.01)
+        fn.proceed.set()
+    assert len(errors) == 3
+    assert fn.num_calls == 1
+
+
+@pytest.mark.anyio
+async def test_single_flight_different_keys_are_not_shared():
+    single_flight = SingleFlight()
+
+    async def fn():
+        return "result"
+
+    assert await single_flight.do("a", fn) == "result"
+    assert await single_flight.do("b", fn) == "result"
+    assert single_flight.num_calls == 2
+    assert single_flight.num_coalesced == 0
+
+
+@pytest.mark.anyio
+async def test_single_flight_cancelled_leader_hands_off():
+    single_flight = SingleFlight()
+    fn = SlowCall(result="result")
+    results = []
+
+    async def follower():
+        results.append(await single_flight.do("key", fn))
+
+    async with anyio.create_task_group() as tg:
+        async with anyio.create_task_group() as leader_tg:
+            leader_tg.start_soon(single_flight.do, "key", fn)
+            await fn.started.wait()
+            tg.start_soon(follower)
+            await anyio.sleep(0.01)
+            fn.started = anyio.Event()
+            leader_tg.cancel_scope.cancel()
+        # the follower runs the call again instead of seeing the cancellation
+        await fn.started.wait()
+        fn.proceed.set()
+    assert results == ["result"]
+    assert fn.num_calls == 2
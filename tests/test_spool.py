@@ -0,0 +1,125 @@
+import anyio
+import pytest
+from helpers import make_msgs, make_subscribe_handler
+
+from p2pclient.control import DaemonConnector
+from p2pclient.exceptions import SlowConsumer
+from p2pclient.fanout import OverflowPolicy
+from p2pclient.pubsub import PubSubClient
+from p2pclient.spool import Spool, _RingFile
+
+NUM_MSGS = 5
+MSG_SIZE = len(make_msgs("topic", 1)[0].to_pb().SerializeToString())
+# room for two messages
+CAPACITY = 2 * (MSG_SIZE + 4) + 1
+
+
+def test_ring_file_wraps_around(tmp_path):
+    path = str(tmp_path / "spool")
+    ring = _RingFile(path, 16)
+    for i in range(10):
+        record = b"%d" % i * 5
+        assert ring.fits(len(record))
+        ring.append(record)
+        assert ring.read() == record
+        assert ring.read() is None
+        ring.commit(ring.read_offset)
+    assert ring.num_bytes == 0
+    ring.close()
+
+
+def test_ring_file_resumes_after_committed(tmp_path):
+    path = str(tmp_path / "spool")
+    ring = _RingFile(path, 64)
+    for record in (b"a", b"b", b"c"):
+        ring.append(record)
+    assert ring.read() == b"a"
+    ring.commit(ring.read_offset)
+    assert ring.read() == b"b"
+    ring.close()
+
+    ring = _RingFile(path, 64)
+    assert [ring.read(), ring.read(), ring.read()] == [b"b", b"c", None]
+    ring.close()
+    with pytest.raises(ValueError):
+        _RingFile(path, 128)
+
+
+@pytest.fixture
+def pubsub(fake_daemon):
+    return PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+
+
+async def wait_drained(spool):
+    with anyio.fail_after(5):
+        while spool.num_spooled + spool.num_dropped < NUM_MSGS:
+            await anyio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_spool_receives_in_order(fake_daemon, pubsub, tmp_path):
+    msgs = make_msgs("topic", NUM_MSGS)
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs)
+    spool = Spool(str(tmp_path / "spool"), capacity=CAPACITY)
+    async with await pubsub.subscribe("topic") as sub:
+        async with spool.run(sub):
+            received = []
+            async for msg in spool:
+                received.append(msg.seqno)
+                await spool.commit()
+    assert received == [msg.seqno for msg in msgs]
+    assert spool.num_dropped == 0
+
+
+@pytest.mark.anyio
+async def test_spool_resumes_after_last_commit(fake_daemon, pubsub, tmp_path):
+    msgs = make_msgs("topic", NUM_MSGS)
+    path = str(tmp_path / "spool")
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs)
+    async with await pubsub.subscribe("topic") as sub:
+        async with Spool(path).run(sub) as spool:
+            await wait_drained(spool)
+            await spool.receive()
+            await spool.commit()
+            await spool.receive()
+
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, [])
+    async with await pubsub.subscribe("topic") as sub:
+        async with Spool(path).run(sub) as spool:
+            received = [msg.seqno async for msg in spool]
+    assert received == [msg.seqno for msg in msgs[1:]]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "policy, expected",
+    ((OverflowPolicy.DROP_NEWEST, [0, 1]), (OverflowPolicy.DROP_OLDEST, [3, 4])),
+)
+async def test_spool_drops(fake_daemon, pubsub, tmp_path, policy, expected):
+    fake_daemon.handler = make_subscribe_handler(
+        fake_daemon, make_msgs("topic", NUM_MSGS)
+    )
+    spool = Spool(str(tmp_path / "spool"), capacity=CAPACITY, policy=policy)
+    async with await pubsub.subscribe("topic") as sub:
+        async with spool.run(sub):
+            await wait_drained(spool)
+            received = [msg.seqno[0] async for msg in spool]
+    assert received == expected
+    assert spool.num_dropped == NUM_MSGS - 2
+
+
+@pytest.mark.anyio
+async def test_spool_disconnects(fake_daemon, pubsub, tmp_path):
+    fake_daemon.handler = make_subscribe_handler(
+        fake_daemon, make_msgs("topic", NUM_MSGS), anyio.Event()
+    )
+    spool = Spool(
+        str(tmp_path / "spool"), capacity=CAPACITY, policy=OverflowPolicy.DISCONNECT
+    )
+    async with await pubsub.subscribe("topic") as sub:
+        async with spool.run(sub):
+            await spool.receive()
+            await spool.receive()
+            with pytest.raises(SlowConsumer):
+                with anyio.fail_after(5):
+                    await spool.receive()
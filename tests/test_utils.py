@@ -1,8 +1,21 @@
+import io
+import logging
+
 import pytest
 
+from p2pclient import tracing
 from p2pclient.exceptions import ControlFailure
 from p2pclient.pb import p2pd_pb2 as p2pd_pb
-from p2pclient.utils import raise_if_failed
+from p2pclient.utils import (
+    DEFAULT_READ_TIMEOUT,
+    deadline_after,
+    raise_if_failed,
+    read_pbmsg_safe,
+    read_timeout,
+    set_request_timeout,
+    time_left,
+    write_pbmsg,
+)
 
 
 def test_raise_if_failed_raises():
@@ -16,3 +29,102 @@ def test_raise_if_failed_not_raises():
     resp = p2pd_pb.Response()
     resp.type = p2pd_pb.Response.OK
     raise_if_failed(resp)
+
+
+class MockReaderWriter(io.BytesIO):
+    async def receive_exactly(self, n):
+        return self.read(n)
+
+    async def send(self, b):
+        return self.write(b)
+
+
+@pytest.fixture
+def frames():
+    frames = []
+    yield frames
+    tracing.uninstall_frame_observer()
+
+
+def test_utils_does_not_force_debug_logging():
+    assert logging.getLogger("p2pclient.utils").level == logging.NOTSET
+
+
+@pytest.mark.anyio
+async def test_frame_observer(frames):
+    tracing.install_frame_observer(
+        lambda *frame: frames.append(frame), sample_rate=1.0, max_bytes=4
+    )
+    s = MockReaderWriter()
+    pbmsg = p2pd_pb.Response(
+        type=p2pd_pb.Response.ERROR, error=p2pd_pb.ErrorResponse(msg="error message")
+    )
+    await write_pbmsg(s, pbmsg)
+    s.seek(0, 0)
+    await read_pbmsg_safe(s, p2pd_pb.Response())
+    msg_bytes = pbmsg.SerializeToString()
+    assert frames == [
+        (tracing.SEND, len(msg_bytes), msg_bytes[:4]),
+        (tracing.RECEIVE, len(msg_bytes), msg_bytes[:4]),
+    ]
+
+
+@pytest.mark.anyio
+async def test_frame_observer_sampling(frames):
+    tracing.install_frame_observer(lambda *frame: frames.append(frame), sample_rate=0.0)
+    await write_pbmsg(
+        MockReaderWriter(), p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY)
+    )
+    assert frames == []
+
+
+@pytest.mark.anyio
+async def test_frame_observer_uninstalled(frames):
+    tracing.install_frame_observer(lambda *frame: frames.append(frame))
+    tracing.uninstall_frame_observer()
+    await write_pbmsg(
+        MockReaderWriter(), p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY)
+    )
+    assert frames == []
+
+
+def test_frame_tracer_invalid_params():
+    with pytest.raises(ValueError):
+        tracing.FrameTracer(tracing.log_frame, sample_rate=1.5)
+    with pytest.raises(ValueError):
+        tracing.FrameTracer(tracing.log_frame, max_bytes=-1)
+
+
+@pytest.mark.anyio
+async def test_set_request_timeout():
+    connect_req = p2pd_pb.Request(
+        type=p2pd_pb.Request.CONNECT, connect=p2pd_pb.ConnectRequest(peer=b"peer")
+    )
+    set_request_timeout(connect_req, deadline_after(2.5))
+    # rounded up so that the daemon does not give up before the client
+    assert connect_req.connect.timeout == 3
+
+    dht_req = p2pd_pb.Request(
+        type=p2pd_pb.Request.DHT,
+        dht=p2pd_pb.DHTRequest(type=p2pd_pb.DHTRequest.GET_VALUE, key=b"key"),
+    )
+    set_request_timeout(dht_req, deadline_after(0.01))
+    assert dht_req.dht.timeout == 1
+
+    set_request_timeout(dht_req, deadline_after(None))
+    assert dht_req.dht.timeout == 1
+
+    identify_req = p2pd_pb.Request(type=p2pd_pb.Request.IDENTIFY)
+    set_request_timeout(identify_req, deadline_after(10))
+    assert not identify_req.HasField("connect")
+
+
+@pytest.mark.anyio
+async def test_deadline_helpers():
+    deadline = deadline_after(None)
+    assert time_left(deadline) is None
+    assert read_timeout(deadline) == DEFAULT_READ_TIMEOUT
+    deadline = deadline_after(10)
+    assert 0 < time_left(deadline) <= 10
+    assert read_timeout(deadline) <= 10
+    assert time_left(deadline_after(-1)) == 0
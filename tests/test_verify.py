@@ -0,0 +1,168 @@
+import anyio
+import multihash
+import pytest
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS, eddsa
+from helpers import make_subscribe_handler
+
+from p2pclient.control import DaemonConnector
+from p2pclient.datastructures import PubSubMessage
+from p2pclient.libp2p_stubs.crypto.pb import crypto_pb2 as crypto_pb
+from p2pclient.libp2p_stubs.crypto.rsa import create_new_key_pair
+from p2pclient.libp2p_stubs.peer.id import (
+    ID,
+    IDENTITY_MULTIHASH_CODE,
+    MAX_INLINE_KEY_LENGTH,
+)
+from p2pclient.pubsub import PubSubClient
+from p2pclient.verify import SignatureVerifier, _load_public_key, signed_bytes
+
+
+@pytest.fixture(scope="module")
+def rsa_key_pair():
+    return create_new_key_pair(bits=1024)
+
+
+def make_rsa_signed_msg(key_pair, data, seqno=b"\x01"):
+    msg = PubSubMessage(
+        from_id=ID.from_pubkey(key_pair.public_key),
+        data=data,
+        seqno=seqno,
+        topic_ids=["topic"],
+        key=key_pair.public_key.serialize(),
+    )
+    msg.signature = key_pair.private_key.sign(signed_bytes(msg))
+    return msg
+
+
+def make_ed25519_signed_msg(data):
+    private_key = ECC.generate(curve="ed25519")
+    key_pb_bytes = crypto_pb.PublicKey(
+        key_type=crypto_pb.Ed25519,
+        data=private_key.public_key().export_key(format="raw"),
+    ).SerializeToString()
+    from_id = ID(multihash.digest(key_pb_bytes, IDENTITY_MULTIHASH_CODE).encode())
+    # the key is inlined in the peer ID, so it is not sent along
+    msg = PubSubMessage(from_id=from_id, data=data, seqno=b"\x01", topic_ids=["t"])
+    msg.signature = eddsa.new(private_key, "rfc8032").sign(signed_bytes(msg))
+    return msg
+
+
+def make_key_signed_msg(key_type, key_data, data):
+    key_pb_bytes = crypto_pb.PublicKey(
+        key_type=key_type, data=key_data
+    ).SerializeToString()
+    algo = multihash.Func.sha2_256
+    if len(key_pb_bytes) <= MAX_INLINE_KEY_LENGTH:
+        algo = IDENTITY_MULTIHASH_CODE
+    from_id = ID(multihash.digest(key_pb_bytes, algo).encode())
+    return PubSubMessage(
+        from_id=from_id, data=data, seqno=b"\x01", topic_ids=["t"], key=key_pb_bytes
+    )
+
+
+def make_ecdsa_signed_msg(data):
+    private_key = ECC.generate(curve="P-256")
+    msg = make_key_signed_msg(
+        crypto_pb.ECDSA, private_key.public_key().export_key(format="DER"), data
+    )
+    signer = DSS.new(private_key, "fips-186-3", encoding="der")
+    msg.signature = signer.sign(SHA256.new(signed_bytes(msg)))
+    return msg
+
+
+@pytest.mark.anyio
+async def test_verify_rsa(rsa_key_pair):
+    valid = make_rsa_signed_msg(rsa_key_pair, b"data")
+    tampered = make_rsa_signed_msg(rsa_key_pair, b"data")
+    tampered.data = b"other data"
+    unsigned = make_rsa_signed_msg(rsa_key_pair, b"data")
+    unsigned.signature = b""
+    # a key that does not belong to the sender
+    wrong_sender = make_rsa_signed_msg(rsa_key_pair, b"data")
+    wrong_sender.from_id = ID.from_base58(
+        "QmcgpsyWgH8Y8ajJz1Cu72KnS5uo2Aa2LpzU7kinSupNK1"
+    )
+    msgs = [valid, tampered, unsigned, wrong_sender]
+    verifier = SignatureVerifier(max_batch_size=2)
+    await verifier.verify_many(msgs)
+    assert [msg.valid for msg in msgs] == [True, False, False, False]
+    assert verifier.num_valid == 1
+    assert verifier.num_invalid == 3
+
+
+@pytest.mark.anyio
+async def test_verify_ed25519_inlined_key():
+    valid = make_ed25519_signed_msg(b"data")
+    tampered = make_ed25519_signed_msg(b"data")
+    tampered.seqno = b"\x02"
+    msgs = [valid, tampered]
+    await SignatureVerifier().verify_many(msgs)
+    assert [msg.valid for msg in msgs] == [True, False]
+
+
+@pytest.mark.anyio
+async def test_verify_ecdsa():
+    valid = make_ecdsa_signed_msg(b"data")
+    tampered = make_ecdsa_signed_msg(b"data")
+    tampered.data = b"other data"
+    msgs = [valid, tampered]
+    await SignatureVerifier().verify_many(msgs)
+    assert [msg.valid for msg in msgs] == [True, False]
+
+
+@pytest.mark.anyio
+async def test_verify_unsupported_key_type():
+    # a compressed secp256k1 public key
+    msg = make_key_signed_msg(crypto_pb.Secp256k1, b"\x02" + b"\x01" * 32, b"data")
+    msg.signature = b"signature"
+    verifier = SignatureVerifier()
+    await verifier.verify_many([msg])
+    # not verified, rather than invalid
+    assert msg.valid is None
+    assert verifier.num_unverified == 1
+    assert verifier.num_invalid == 0
+
+
+@pytest.mark.anyio
+async def test_verify_in_worker_processes(rsa_key_pair):
+    msgs = [make_rsa_signed_msg(rsa_key_pair, b"%d" % i) for i in range(4)]
+    msgs[2].data = b"tampered"
+    await SignatureVerifier(use_processes=True, max_workers=2).verify_many(msgs)
+    assert [msg.valid for msg in msgs] == [True, True, False, True]
+
+
+@pytest.mark.anyio
+async def test_verified_subscription_keeps_order(fake_daemon, rsa_key_pair):
+    msgs = [make_rsa_signed_msg(rsa_key_pair, b"%d" % i) for i in range(20)]
+    msgs[7].data = b"tampered"
+    fake_daemon.handler = make_subscribe_handler(fake_daemon, msgs)
+    pubsub = PubSubClient(DaemonConnector(fake_daemon.control_maddr))
+    verifier = SignatureVerifier(max_batch_size=3, max_workers=4)
+    async with await pubsub.subscribe("topic") as sub:
+        async with verifier.verified(sub) as verified_msgs:
+            with anyio.fail_after(10):
+                received = [msg async for msg in verified_msgs]
+    assert [msg.data for msg in received] == [msg.data for msg in msgs]
+    assert [msg.valid for msg in received] == [i != 7 for i in range(20)]
+
+
+@pytest.mark.parametrize(
+    "key_type, key_data",
+    (
+        (
+            crypto_pb.Ed25519,
+            ECC.generate(curve="ed25519").public_key().export_key(format="raw"),
+        ),
+        (
+            crypto_pb.ECDSA,
+            ECC.generate(curve="P-256").public_key().export_key(format="DER"),
+        ),
+    ),
+)
+def test_loaded_public_key_serializes_back(key_type, key_data):
+    key_pb_bytes = crypto_pb.PublicKey(
+        key_type=key_type, data=key_data
+    ).SerializeToString()
+    assert _load_public_key(key_pb_bytes).serialize() == key_pb_bytes